@@ -0,0 +1,392 @@
+import asyncio
+from contextlib import asynccontextmanager
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from .SharedState import open_shared_database, process_alive, shared_state_path
+
+logger = logging.getLogger(__name__)
+
+# Threads started by the block holding the current slot (see hold_slot_until)
+slot_threads = contextvars.ContextVar("slot_threads", default=None)
+
+"""
+Function to keep the current admission slot, if any, until a model call running in a thread has finished
+A thread cannot be interrupted, so when the block holding the slot is left early (attempt timeout, lost hedge,
+client disconnect) the call goes on upstream: the slot is only released once it ends, so the number of calls
+in flight never exceeds the admission limits
+Parameters:
+    - future: asyncio future of the call running in a thread
+"""
+def hold_slot_until(future):
+    threads = slot_threads.get()
+    if threads is not None:
+        threads.append(future)
+
+# Priority lanes (lower runs first)
+# Each model has its own queue, so a lane only orders the requests waiting for the same model
+# (e.g. interactive text before batch items on the text models); lanes of different models never compete
+PRIORITY_CAPTIONING = 0
+PRIORITY_TEXT = 1
+PRIORITY_IMAGE_GENERATION = 2
+PRIORITY_BATCH = 3
+PRIORITY_IMAGE_JOB = 4
+
+class ModelSaturatedError(Exception):
+    """
+    Raised when a model has no free capacity for a request
+    status_code is 429 when the wait queue is full and 503 when the request's deadline passed while queued
+    """
+    def __init__(self, model_name, status_code, retry_after, message):
+        super().__init__(message)
+        self.model_name = model_name
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class SharedSlots:
+    """
+    Host-wide count of the model slots held by every worker process, kept in a SQLite database they share
+    Each worker has one row per model, and the rows of workers that exited without releasing their slots are dropped
+    Acquiring runs on the event loop with a busy timeout of a few milliseconds: when another worker holds the write
+    lock, the slot is reported as not acquired and the caller polls again
+    Releasing must not be lost, so it runs in a thread on a second connection that waits for the lock as long as needed
+    """
+    def __init__(self, sqlite_path, busy_timeout_seconds):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.release_lock = threading.Lock()
+        self.cleanup_interval_seconds = 5.0
+        self.last_cleanup = 0.0
+        self.busy = {}
+        self.connection = open_shared_database(sqlite_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS admission_slots (model TEXT NOT NULL, pid INTEGER NOT NULL, slots INTEGER NOT NULL, PRIMARY KEY (model, pid))"
+        )
+        # Rows left by an earlier process with the same pid
+        self.connection.execute("DELETE FROM admission_slots WHERE pid = ?", (self.pid,))
+        self.connection.execute(f"PRAGMA busy_timeout = {int(busy_timeout_seconds * 1000)}")
+        self.release_connection = open_shared_database(sqlite_path)
+
+    """
+    Function to take a slot of a model if fewer than limit are held across the host
+    Returns False when the slots are all held, or when the database is locked by another worker
+    Parameters:
+        - model_name: name of the model handle
+        - limit: host-wide concurrency limit of the model
+    """
+    def try_acquire(self, model_name, limit):
+        try:
+            self.remove_exited_workers()
+            return self.try_insert(model_name, limit)
+        except sqlite3.OperationalError:
+            self.busy[model_name] = self.busy.get(model_name, 0) + 1
+            return False
+
+    """
+    Function to count the slots of a model held across the host and take one if fewer than limit are held
+    Parameters:
+        - model_name: name of the model handle
+        - limit: host-wide concurrency limit of the model
+    """
+    def try_insert(self, model_name, limit):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                (held,) = self.connection.execute(
+                    "SELECT COALESCE(SUM(slots), 0) FROM admission_slots WHERE model = ?",
+                    (model_name,),
+                ).fetchone()
+                acquired = held < limit
+                if acquired:
+                    self.connection.execute(
+                        "INSERT INTO admission_slots (model, pid, slots) VALUES (?, ?, 1) "
+                        "ON CONFLICT (model, pid) DO UPDATE SET slots = slots + 1",
+                        (model_name, self.pid),
+                    )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return acquired
+
+    """
+    Function to give back a slot of a model (run in a thread, as it waits for the write lock)
+    Parameters:
+        - model_name: name of the model handle
+    """
+    def release(self, model_name):
+        try:
+            with self.release_lock:
+                self.release_connection.execute(
+                    "UPDATE admission_slots SET slots = slots - 1 WHERE model = ? AND pid = ? AND slots > 0",
+                    (model_name, self.pid),
+                )
+        except sqlite3.OperationalError as error:
+            # The slot stays counted until this worker exits
+            logger.error("Could not release a %s slot: %s", model_name, error)
+
+    """
+    Function to drop the slots of workers that are no longer running (at most every few seconds)
+    """
+    def remove_exited_workers(self):
+        now = time.monotonic()
+        if now - self.last_cleanup < self.cleanup_interval_seconds:
+            return
+        self.last_cleanup = now
+        with self.lock:
+            pids = [pid for (pid,) in self.connection.execute("SELECT DISTINCT pid FROM admission_slots")]
+            for pid in pids:
+                if pid != self.pid and not process_alive(pid):
+                    self.connection.execute("DELETE FROM admission_slots WHERE pid = ?", (pid,))
+
+    """
+    Function to count the slots of a model held across the host, or None when the database is locked
+    Parameters:
+        - model_name: name of the model handle
+    """
+    def held(self, model_name):
+        try:
+            with self.lock:
+                (held,) = self.connection.execute(
+                    "SELECT COALESCE(SUM(slots), 0) FROM admission_slots WHERE model = ?",
+                    (model_name,),
+                ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return held
+
+class ModelAdmission:
+    """
+    Concurrency limit for one model with a bounded, prioritised wait queue
+    Priority only orders the waiters of this model in this worker
+    With shared slots, the limit applies to the whole host: a request admitted by its worker then waits
+    for one of the model's host-wide slots, polling since a slot freed by another worker cannot wake it
+    """
+    def __init__(self, name, max_concurrency, max_queue, max_wait_seconds, shared_slots=None, shared_poll_seconds=0.05):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.shared_slots = shared_slots
+        self.shared_poll_seconds = shared_poll_seconds
+        self.active = 0
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.release_tasks = set()
+
+        # Counters used to size capacity
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait_seconds = 0.0
+        self.max_observed_wait_seconds = 0.0
+        self.total_service_seconds = 0.0
+        self.completed = 0
+        self.abandoned = 0
+
+    """
+    Function to count the waiters that are still queued (cancelled ones are removed lazily)
+    """
+    def queue_depth(self):
+        return sum(1 for _, _, future in self.waiters if not future.done())
+
+    """
+    Function to estimate how many seconds a rejected client should wait before retrying
+    """
+    def retry_after(self):
+        average_service_seconds = self.total_service_seconds / self.completed if self.completed else 1.0
+        estimate = average_service_seconds * (self.queue_depth() + 1) / self.max_concurrency
+        return max(1, math.ceil(estimate))
+
+    """
+    Function to wait for a free slot
+    Raises ModelSaturatedError immediately when the queue is full, or when the deadline passes while queued
+    Parameters:
+        - priority: lane of the request (lower is admitted first)
+        - deadline: optional absolute time.monotonic() deadline, defaults to now + max_wait_seconds
+    """
+    async def acquire(self, priority, deadline=None):
+        if deadline is None:
+            deadline = time.monotonic() + self.max_wait_seconds
+        await self.acquire_local(priority, deadline)
+        if self.shared_slots is None:
+            return
+
+        try:
+            while not self.shared_slots.try_acquire(self.name, self.max_concurrency):
+                if time.monotonic() + self.shared_poll_seconds >= deadline:
+                    self.timed_out += 1
+                    raise ModelSaturatedError(self.name, 503, self.retry_after(), f"Timed out waiting for the {self.name} model. Try again later.")
+                await asyncio.sleep(self.shared_poll_seconds)
+        except BaseException:
+            self.release_local()
+            raise
+
+    """
+    Function to wait for a free slot of this worker
+    Parameters:
+        - priority: lane of the request (lower is admitted first)
+        - deadline: absolute time.monotonic() deadline
+    """
+    async def acquire_local(self, priority, deadline):
+        started_at = time.monotonic()
+        if self.active < self.max_concurrency and self.queue_depth() == 0:
+            self.active += 1
+            self.admitted += 1
+            return
+
+        # Shed load straight away instead of queueing beyond the bound
+        if self.queue_depth() >= self.max_queue:
+            self.rejected += 1
+            raise ModelSaturatedError(self.name, 429, self.retry_after(), f"The {self.name} model is at capacity. Try again later.")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        try:
+            await asyncio.wait_for(future, timeout=max(0.0, deadline - started_at))
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise ModelSaturatedError(self.name, 503, self.retry_after(), f"Timed out waiting for the {self.name} model. Try again later.")
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release_local()
+            raise
+
+        wait_seconds = time.monotonic() - started_at
+        self.admitted += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_observed_wait_seconds = max(self.max_observed_wait_seconds, wait_seconds)
+
+    """
+    Function to free a slot
+    The host-wide slot is given back in a thread, and is given back even if the request is cancelled meanwhile
+    """
+    async def release(self):
+        try:
+            if self.shared_slots is not None:
+                await asyncio.shield(asyncio.get_running_loop().run_in_executor(None, self.shared_slots.release, self.name))
+        finally:
+            self.release_local()
+
+    """
+    Function to free a slot of this worker, handing it straight to the highest priority waiter if there is one
+    """
+    def release_local(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    """
+    Function to hold a slot for the duration of a block
+    Parameters:
+        - priority: lane of the request
+        - deadline: optional absolute time.monotonic() deadline
+    """
+    @asynccontextmanager
+    async def slot(self, priority, deadline=None):
+        await self.acquire(priority, deadline)
+        started_at = time.monotonic()
+        threads = []
+        token = slot_threads.set(threads)
+        try:
+            yield
+        finally:
+            slot_threads.reset(token)
+            running = [future for future in threads if not future.done()]
+            if running:
+                # Left early while a call still runs in a thread: release the slot in the background once it ends
+                self.abandoned += 1
+                task = asyncio.ensure_future(self.release_after(running, started_at))
+                self.release_tasks.add(task)
+                task.add_done_callback(self.release_tasks.discard)
+            else:
+                self.total_service_seconds += time.monotonic() - started_at
+                self.completed += 1
+                await self.release()
+
+    """
+    Function to free a slot once the calls left running in threads by its block have finished
+    Parameters:
+        - futures: asyncio futures of the calls
+        - started_at: time.monotonic() at which the slot was admitted
+    """
+    async def release_after(self, futures, started_at):
+        await asyncio.wait(futures)
+        # Nobody awaits these results any more: retrieve the errors so they are not reported as never retrieved
+        for future in futures:
+            if not future.cancelled():
+                future.exception()
+        self.total_service_seconds += time.monotonic() - started_at
+        self.completed += 1
+        await self.release()
+
+    """
+    Function to report concurrency, queue depth and wait times
+    """
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queue_depth": self.queue_depth(),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "average_wait_seconds": self.total_wait_seconds / self.admitted if self.admitted else 0.0,
+            "max_wait_seconds": self.max_observed_wait_seconds,
+            "average_service_seconds": self.total_service_seconds / self.completed if self.completed else 0.0,
+            "abandoned": self.abandoned,
+            "host_active": self.shared_slots.held(self.name) if self.shared_slots is not None else self.active,
+            "host_busy": self.shared_slots.busy.get(self.name, 0) if self.shared_slots is not None else 0,
+        }
+
+class AdmissionController:
+    """
+    Per-model admission limits configured from environment variables:
+    ADMISSION_<MODEL>_MAX_CONCURRENCY, ADMISSION_<MODEL>_MAX_QUEUE and ADMISSION_<MODEL>_MAX_WAIT_SECONDS
+    The concurrency limits are shared by the worker processes of the host when ADMISSION_SQLITE_PATH
+    (or SHARED_STATE_DIR) is set, polling every ADMISSION_SHARED_POLL_SECONDS for a host-wide slot and waiting
+    at most ADMISSION_SQLITE_BUSY_TIMEOUT_SECONDS for the database lock on each attempt
+    """
+    def __init__(self, defaults):
+        sqlite_path = os.environ.get("ADMISSION_SQLITE_PATH") or shared_state_path("admission")
+        busy_timeout_seconds = float(os.environ.get("ADMISSION_SQLITE_BUSY_TIMEOUT_SECONDS", "0.005"))
+        self.shared_slots = SharedSlots(sqlite_path, busy_timeout_seconds) if sqlite_path else None
+        shared_poll_seconds = float(os.environ.get("ADMISSION_SHARED_POLL_SECONDS", "0.05"))
+        self.models = {}
+        for model_name, (max_concurrency, max_queue, max_wait_seconds) in defaults.items():
+            prefix = f"ADMISSION_{model_name.upper()}"
+            self.models[model_name] = ModelAdmission(
+                model_name,
+                max_concurrency=int(os.environ.get(f"{prefix}_MAX_CONCURRENCY", str(max_concurrency))),
+                max_queue=int(os.environ.get(f"{prefix}_MAX_QUEUE", str(max_queue))),
+                max_wait_seconds=float(os.environ.get(f"{prefix}_MAX_WAIT_SECONDS", str(max_wait_seconds))),
+                shared_slots=self.shared_slots,
+                shared_poll_seconds=shared_poll_seconds,
+            )
+
+    """
+    Function to hold a slot of a model for the duration of a block
+    Parameters:
+        - model_name: name of the model handle
+        - priority: lane of the request
+        - deadline: optional absolute time.monotonic() deadline
+    """
+    def slot(self, model_name, priority, deadline=None):
+        return self.models[model_name].slot(priority, deadline)
+
+    """
+    Function to report the admission state of every model
+    """
+    def stats(self):
+        return {model_name: admission.stats() for model_name, admission in self.models.items()}
@@ -0,0 +1,197 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import time
+from .SharedState import open_shared_database, shared_state_path
+
+class BlobStore:
+    """
+    Bounded, content-addressed in-process store for binary payloads such as generated images
+    Blobs are identified by the SHA-256 of their bytes, expire after a TTL and the least recently
+    used blobs are evicted once the total size exceeds the byte budget
+    A blob can be pinned for a while (e.g. the images of an image job until the job expires): it is not evicted
+    to make room before then, even when that takes the store above the byte budget
+    When BLOB_STORE_SQLITE_PATH (or SHARED_STATE_DIR) is set, blobs are kept in a SQLite database instead,
+    so an image stored by one worker process can be fetched from any of them (the oldest are evicted first)
+    The SQLite reads and writes run in a thread, as a write may wait for the database lock held by another worker
+    """
+    def __init__(self):
+        self.max_bytes = int(os.environ.get("BLOB_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+        self.ttl_seconds = float(os.environ.get("BLOB_STORE_TTL_SECONDS", "3600"))
+        self.blobs = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+        # Optional store shared by the worker processes
+        self.connection = None
+        self.writes = 0
+        sqlite_path = os.environ.get("BLOB_STORE_SQLITE_PATH") or shared_state_path("blobs")
+        if sqlite_path:
+            self.connection = open_shared_database(sqlite_path)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS blobs (blob_id TEXT PRIMARY KEY, media_type TEXT NOT NULL, expires_at REAL NOT NULL, size INTEGER NOT NULL, data BLOB NOT NULL, pinned_until REAL NOT NULL DEFAULT 0)"
+            )
+            # Databases created before blobs could be pinned
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(blobs)")]
+            if "pinned_until" not in columns:
+                self.connection.execute("ALTER TABLE blobs ADD COLUMN pinned_until REAL NOT NULL DEFAULT 0")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS blobs_expires_at ON blobs (expires_at)")
+
+    """
+    Function to store a blob and return its id
+    Parameters:
+        - data: bytes to store
+        - media_type: content type served with the blob
+        - pinned_seconds: how long the blob must be kept, whatever the byte budget (its TTL is extended to match)
+    """
+    async def put(self, data, media_type, pinned_seconds=0):
+        if self.connection is not None:
+            return await asyncio.to_thread(self.put_shared, data, media_type, pinned_seconds)
+
+        blob_id = hashlib.sha256(data).hexdigest()
+        now = time.monotonic()
+        pinned_until = now + pinned_seconds if pinned_seconds > 0 else 0
+        expires_at = max(now + self.ttl_seconds, pinned_until)
+        with self.lock:
+            existing = self.blobs.pop(blob_id, None)
+            if existing is not None:
+                self.total_bytes -= len(existing["data"])
+                expires_at = max(expires_at, existing["expires_at"])
+                pinned_until = max(pinned_until, existing["pinned_until"])
+            self.blobs[blob_id] = {
+                "data": data,
+                "media_type": media_type,
+                "expires_at": expires_at,
+                "pinned_until": pinned_until,
+            }
+            self.total_bytes += len(data)
+            self.evict()
+        return blob_id
+
+    """
+    Function to store a blob in the shared store (run in a thread)
+    Parameters:
+        - data, media_type, pinned_seconds: same as put
+    """
+    def put_shared(self, data, media_type, pinned_seconds):
+        blob_id = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        pinned_until = now + pinned_seconds if pinned_seconds > 0 else 0
+        with self.lock:
+            # Storing the same bytes again keeps the longest TTL and pin
+            self.connection.execute(
+                "INSERT INTO blobs (blob_id, media_type, expires_at, size, data, pinned_until) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (blob_id) DO UPDATE SET media_type = excluded.media_type, "
+                "expires_at = MAX(expires_at, excluded.expires_at), pinned_until = MAX(pinned_until, excluded.pinned_until)",
+                (blob_id, media_type, max(now + self.ttl_seconds, pinned_until), len(data), data, pinned_until),
+            )
+            self.writes += 1
+            if self.writes % 10 == 0:
+                self.evict_shared()
+        return blob_id
+
+    """
+    Function to get a blob, returning None when it is unknown or expired
+    Parameters:
+        - blob_id: id returned by put
+    """
+    async def get(self, blob_id):
+        if self.connection is not None:
+            return await asyncio.to_thread(self.get_shared, blob_id)
+
+        with self.lock:
+            blob = self.blobs.get(blob_id)
+            if blob is None:
+                return None
+            if blob["expires_at"] <= time.monotonic():
+                del self.blobs[blob_id]
+                self.total_bytes -= len(blob["data"])
+                return None
+            self.blobs.move_to_end(blob_id)
+            return blob
+
+    """
+    Function to get a blob from the shared store (run in a thread)
+    Parameters:
+        - blob_id: id returned by put
+    """
+    def get_shared(self, blob_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT media_type, expires_at, data FROM blobs WHERE blob_id = ? AND expires_at > ?",
+                (blob_id, time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "data": row[2],
+            "media_type": row[0],
+            "expires_at": row[1],
+        }
+
+    """
+    Function to drop expired blobs and the least recently used unpinned ones above the byte budget (lock must be held)
+    """
+    def evict(self):
+        now = time.monotonic()
+        for blob_id in [blob_id for blob_id, blob in self.blobs.items() if blob["expires_at"] <= now]:
+            self.total_bytes -= len(self.blobs.pop(blob_id)["data"])
+            self.evictions += 1
+        if self.total_bytes <= self.max_bytes:
+            return
+        for blob_id in [blob_id for blob_id, blob in self.blobs.items() if blob["pinned_until"] <= now]:
+            self.total_bytes -= len(self.blobs.pop(blob_id)["data"])
+            self.evictions += 1
+            if self.total_bytes <= self.max_bytes:
+                break
+
+    """
+    Function to drop expired blobs and the oldest unpinned ones above the byte budget from the shared store (lock must be held)
+    """
+    def evict_shared(self):
+        now = time.time()
+        self.evictions += self.connection.execute("DELETE FROM blobs WHERE expires_at <= ?", (now,)).rowcount
+        (total_bytes,) = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        if total_bytes <= self.max_bytes:
+            return
+        excess_bytes = total_bytes - self.max_bytes
+        blob_ids = []
+        for blob_id, size in self.connection.execute("SELECT blob_id, size FROM blobs WHERE pinned_until <= ? ORDER BY expires_at", (now,)):
+            blob_ids.append(blob_id)
+            excess_bytes -= size
+            if excess_bytes <= 0:
+                break
+        self.connection.executemany("DELETE FROM blobs WHERE blob_id = ?", [(blob_id,) for blob_id in blob_ids])
+        self.evictions += len(blob_ids)
+
+    """
+    Function to report the store size
+    """
+    async def stats(self):
+        if self.connection is not None:
+            return await asyncio.to_thread(self.stats_shared)
+        with self.lock:
+            return {
+                "blobs": len(self.blobs),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "evictions": self.evictions,
+            }
+
+    """
+    Function to report the size of the shared store (run in a thread)
+    """
+    def stats_shared(self):
+        with self.lock:
+            self.total_bytes, blobs = self.connection.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM blobs").fetchone()
+            return {
+                "blobs": blobs,
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "evictions": self.evictions,
+            }
@@ -1,74 +1,177 @@
+import asyncio
 import base64
-import google.generativeai as genai
-from google.oauth2 import service_account
-import json
-import PIL.Image
-from pydantic import BaseModel, Field
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
-from vertexai.preview.vision_models import Image, ImageCaptioningModel, ImageTextModel, ImageGenerationModel
 import os
+import time
 from dotenv import load_dotenv
 load_dotenv()
-from typing_extensions import Annotated
-from uuid_extensions import uuid7, uuid7str
-from datetime import datetime
+from .AdmissionController import AdmissionController, ModelSaturatedError, PRIORITY_BATCH, PRIORITY_CAPTIONING, PRIORITY_IMAGE_GENERATION, PRIORITY_IMAGE_JOB, PRIORITY_TEXT
+from .BlobStore import BlobStore
+from .ImagePostprocessor import ImagePostprocessor
+from .ImagePreprocessor import ImagePreprocessor
+from .ImageJobQueue import ImageJobQueue
+from .ImageResultCache import ImageResultCache
+from .ImageValidator import ImageValidator
+from .Metrics import Metrics
+from .ModelRouter import ModelRouter
+from .RequestTiming import record_stage, stage
+from .ResilienceLayer import ResilienceLayer, is_retryable_error
+from .ResponseCache import ResponseCache, response_cache_from_env
+from .SafetyScreen import SafetyBlockedError, SafetyScreen, classify_safety_error
+from .SingleFlight import SingleFlight
+
+"""
+Function to create the model backend selected by the MODEL_BACKEND environment variable
+"vertex" (default) calls Vertex AI and Google AI, "simulator" answers locally for load tests
+Parameters:
+    - vertex_pro_vision_model_name: name of the Vertex multimodal model
+    - vertex_text_model_name: name of the Vertex text-only model
+"""
+def model_backend_from_env(vertex_pro_vision_model_name, vertex_text_model_name):
+    backend_name = os.environ.get("MODEL_BACKEND", "vertex").strip().lower()
+    if backend_name == "simulator":
+        from .SimulatorBackend import SimulatorBackend
+        return SimulatorBackend()
+    if backend_name != "vertex":
+        raise ValueError(f"Unknown MODEL_BACKEND {backend_name!r}, expected 'vertex' or 'simulator'")
+    from .VertexBackend import VertexBackend
+    return VertexBackend(vertex_pro_vision_model_name, vertex_text_model_name)
 
 class ContentGenerator:
     def __init__(self):
-        self.GCP_SA_KEY_STRING = os.environ.get("GCP_SA_KEY_STRING")
-        self.gcp_decoded_sa_key_string = base64.b64decode(self.GCP_SA_KEY_STRING)
-        self.gcp_sa_key_json = json.loads(self.gcp_decoded_sa_key_string)
-        self.credentials = service_account.Credentials.from_service_account_info(self.gcp_sa_key_json)
-        self.project_id = os.environ.get("GCP_PROJECT_ID")
-        self.location = os.environ.get("GCP_LOCATION")
-        self.GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-        genai.configure(api_key=self.GEMINI_API_KEY)
-        self.gemini_model = genai.GenerativeModel('gemini-pro-vision')
-        vertexai.init(project = self.project_id, credentials = self.credentials, location = self.location)
-        self.vertex_pro_vision_model = GenerativeModel(model_name="gemini-1.0-pro-vision")
-        self.vertex_image_captioning_model = ImageCaptioningModel.from_pretrained("imagetext@001")
-        self.vertex_image_generation_model = ImageGenerationModel.from_pretrained("imagegeneration@006")
+        self.vertex_pro_vision_model_name = "gemini-1.0-pro-vision"
+        # Cheaper and faster text-only model preferred for prompts without an image
+        self.vertex_text_model_name = os.environ.get("VERTEX_TEXT_MODEL_NAME", "gemini-1.0-pro")
+        # Generation settings for text content (None uses the model defaults)
+        self.text_generation_config = None
+
+        # Backend making the model calls (models are loaded on first use or by warm_up, not at construction)
+        self.backend = model_backend_from_env(self.vertex_pro_vision_model_name, self.vertex_text_model_name)
+
+        # Per-model concurrency limits with bounded priority queues: (max concurrency, max queue, max wait seconds)
+        # The limits of the thread pool backed models must stay below MODEL_THREAD_POOL_SIZE in total
+        self.admission = AdmissionController({
+            "gemini_model": (16, 64, 10),
+            "vertex_pro_vision_model": (16, 64, 10),
+            "vertex_text_model": (16, 64, 10),
+            "vertex_image_captioning_model": (12, 48, 5),
+            "vertex_image_generation_model": (4, 16, 30),
+        })
+        # Size the upstream connections of each model for the calls it may have in flight
+        self.backend.size_connection_pools({
+            model_name: model.max_concurrency
+            for model_name, model in self.admission.models.items()
+        })
+
+        # Timeouts, retries with jittered backoff, hedging and circuit breakers around every model call
+        # Values are the per-call timeouts in seconds
+        # A timed out image generation may still complete upstream, so it is not retried (it would be paid twice)
+        self.resilience = ResilienceLayer({
+            "gemini_model": 60,
+            "vertex_pro_vision_model": 60,
+            "vertex_text_model": 60,
+            "vertex_image_captioning_model": 30,
+            "vertex_image_generation_model": 120,
+        }, no_timeout_retry_models={"vertex_image_generation_model"})
+
+        # Streaming validator for uploaded images
+        self.image_validator = ImageValidator()
+
+        # Process pool backed downscaling and re-encoding of uploads before they are sent to the models
+        self.image_preprocessor = ImagePreprocessor()
+
+        # Variants of generated images (stripped metadata, WebP, AVIF, thumbnails), encoded in the same process pool
+        self.image_postprocessor = ImagePostprocessor(self.image_preprocessor.run_in_process)
+
+        # LRU + TTL cache of generated text keyed on the normalised final prompt and model settings
+        self.text_response_cache = response_cache_from_env("text_responses", "RESPONSE_CACHE")
+
+        # Cache of caption and image-to-text results keyed by the hash of the image bytes
+        self.image_result_cache = ImageResultCache()
+
+        # Coalescing of identical concurrent text and image generation requests
+        self.text_single_flight = SingleFlight("text")
+        self.image_generation_single_flight = SingleFlight("image_generation")
+
+        # Fan-out of batch text generation: items generated concurrently per batch, and attempts per item
+        # when the model is saturated (batches wait for capacity instead of failing)
+        self.batch_concurrency = int(os.environ.get("BATCH_MAX_CONCURRENCY", "8"))
+        self.batch_max_attempts = int(os.environ.get("BATCH_MAX_ATTEMPTS", "3"))
+
+        # Content-addressed store of generated images served by id instead of base 64 in the response body
+        self.image_blob_store = BlobStore()
+
+        # Asynchronous image generation jobs run by a bounded pool of worker tasks
+        # Job images wait for image generation capacity (up to IMAGE_JOB_MAX_ATTEMPTS admission attempts) instead of failing
+        self.image_jobs = ImageJobQueue(self.run_image_job)
+        self.image_job_max_attempts = int(os.environ.get("IMAGE_JOB_MAX_ATTEMPTS", "5"))
+
+        # Choice of the text generation model per request, with fallbacks: (model, max input tokens)
+        # Exact token counts of long prompts are cached since they cost an upstream call
+        self.router = ModelRouter(self.backend, self.resilience, ResponseCache("token_counts", 4096, 3600), {
+            "vertex_text_model": 30720,
+            "vertex_pro_vision_model": 12288,
+            "gemini_model": 12288,
+        })
+
+        # Pre-flight screening of image generation prompts against a blocklist and the prompts blocked upstream before
+        self.safety_screen = SafetyScreen()
+
+        # Prometheus metrics: request and stage latencies, upstream model latencies and pipeline counters
+        self.metrics = Metrics(self.admission, self.resilience, {
+            "text_responses": self.text_response_cache,
+            "image_results": self.image_result_cache,
+            "blocked_prompts": self.safety_screen.memo,
+        })
 
+    """
+    Function to load the backend's models in the background so the first requests do not pay for it
+    """
+    async def warm_up(self):
+        await self.backend.warm_up()
+
+    """
+    Function to retry the model loads that failed, in the background, until cancelled
+    """
+    async def retry_failed_loads(self):
+        await self.backend.retry_failed_loads()
+
+    """
+    Function to report which models are loaded
+    """
+    def model_status(self):
+        return self.backend.model_status()
 
     """
     Function to accept an image file and return a list of captions
     Parameters:
         - prompt: text prompt specified by user to assist in generating text content
         - content_type: number string to indicate if generated text should be a story, poem or song
+        - bypass_cache: skip the response cache and force a fresh generation
+        - priority: admission lane of the request
     """
-    def generate_text_content(self, prompt, content_type):
+    async def generate_text_content(self, prompt, content_type, bypass_cache=False, priority=PRIORITY_TEXT):
         try:
             warnings = []
-            
-
-            # Use gemini pro vision model to generate text from image based on prompt
-            genai.configure(api_key=self.GEMINI_API_KEY)
-            model = genai.GenerativeModel('gemini-pro-vision')
 
             # Specify in prompt if the text should be a story, poem or song
-            content_type_string = "song that rhymes"
-            if content_type == "1":
-                content_type_string = "story"
-            elif content_type == "2":
-                content_type_string = "poem that rhymes"
-            elif content_type == "3":
-                content_type_string = "play (formatted with characters, stage direction, scenes act, etc. do not format as a poem)"
-            else:
-                content_type_string = "song that rhymes"
-
-            final_prompt = f"Write a {content_type_string} with the following prompt: {prompt}. Include an appropriate title in bold for the content generated in the final response."
-
-            """
-            vertexai.init(project=project_id, credentials=credentials, location=location)
-            model = GenerativeModel(model_name="gemini-1.0-pro-vision")
-            """
-            response = self.vertex_pro_vision_model.generate_content(final_prompt)
+            final_prompt = self.build_text_prompt(prompt, content_type)
 
-            response_texts = []
+            # Return a cached result of the routed model for the same normalised prompt and settings unless bypassed
+            model_names = await self.router.route("text", final_prompt, content_type)
+            cache_key = self.build_text_cache_key(model_names[0], final_prompt)
+            if bypass_cache:
+                self.text_response_cache.record_bypass()
+            else:
+                cached_response = self.text_response_cache.get(cache_key)
+                if cached_response is not None:
+                    return cached_response
 
-            for candidate in response.candidates:
-                response_texts = [part.text for part in candidate.content.parts]
+            # Coalesce identical concurrent requests so that only one upstream call runs for all of them
+            with stage("model"):
+                response_texts, model_name = await self.text_single_flight.run(
+                    cache_key,
+                    lambda: self.request_text_content(final_prompt, priority, model_names),
+                )
 
             # Return warning if the model is unable to generate text content for prompt
             if len(response_texts) == 0:
@@ -77,16 +180,256 @@ class ContentGenerator:
                     "warnings": warnings
                 }
                         
-            # Return successful response
-            return {
+            # Cache the response under the model that generated it (a fallback model may have answered) and return it
+            result = {
                 "response": response_texts[0]
             }
+            self.text_response_cache.set(self.build_text_cache_key(model_name, final_prompt), result)
+            return result
+
+        # Let saturation errors through so the API can answer 429/503 with Retry-After
+        except ModelSaturatedError:
+            raise
         
         except Exception as error:
             return {
                 "error": str(error)
             }
+
+    """
+    Function to build the final text generation prompt
+    Parameters:
+        - prompt: text prompt specified by user to assist in generating text content
+        - content_type: number string to indicate if generated text should be a story, poem, play or song
+    """
+    def build_text_prompt(self, prompt, content_type):
+        content_type_string = "song that rhymes"
+        if content_type == "1":
+            content_type_string = "story"
+        elif content_type == "2":
+            content_type_string = "poem that rhymes"
+        elif content_type == "3":
+            content_type_string = "play (formatted with characters, stage direction, scenes act, etc. do not format as a poem)"
+        else:
+            content_type_string = "song that rhymes"
+
+        return f"Write a {content_type_string} with the following prompt: {prompt}. Include an appropriate title in bold for the content generated in the final response."
+
+    """
+    Function to build the cache (and coalescing) key of a text generation request
+    Results of different models are kept apart
+    Parameters:
+        - model_name: name of the model handle generating the text
+        - final_prompt: complete prompt sent to the model
+    """
+    def build_text_cache_key(self, model_name, final_prompt):
+        return ResponseCache.make_key(
+            model_name,
+            self.text_generation_config,
+            ResponseCache.normalise_prompt(final_prompt),
+        )
+
+    """
+    Function to generate text content and yield it in pieces as the model produces it
+    Yields dicts with a "response" text chunk, or a final "warnings"/"error" entry
+    The upstream stream is closed when the consumer stops iterating (e.g. the client disconnected)
+    Parameters:
+        - prompt: text prompt specified by user to assist in generating text content
+        - content_type: number string to indicate if generated text should be a story, poem or song
+        - bypass_cache: skip the response cache and force a fresh generation
+    """
+    async def stream_text_content(self, prompt, content_type, bypass_cache=False):
+        final_prompt = self.build_text_prompt(prompt, content_type)
+        model_names = await self.router.route("text", final_prompt, content_type)
+        cache_key = self.build_text_cache_key(model_names[0], final_prompt)
+
+        # Replay a cached result of the routed model as a single chunk
+        if bypass_cache:
+            self.text_response_cache.record_bypass()
+        else:
+            cached_response = self.text_response_cache.get(cache_key)
+            if cached_response is not None:
+                yield cached_response
+                return
+
+        # Pick the first routed model whose circuit is closed, then hold a model slot for the whole stream
+        # Streams are not retried or moved to another model since partial text may already have been sent
+        # (ModelSaturatedError and CircuitOpenError propagate to the caller)
+        model_name = self.first_available_model(model_names)
+        async with self.admission.slot(model_name, PRIORITY_TEXT):
+            text_stream = self.backend.stream_text(final_prompt, self.text_generation_config, model_name)
+
+            # Forward each chunk as soon as it arrives and cache the complete text once the stream ends
+            async for chunk in self.forward_text_stream(text_stream, model_name):
+                if "complete_text" in chunk:
+                    self.text_response_cache.set(self.build_text_cache_key(model_name, final_prompt), {"response": chunk["complete_text"]})
+                else:
+                    yield chunk
+
+    """
+    Function to forward text chunks from a backend text stream
+    Yields {"response": chunk}, then {"complete_text": full_text} on success or a "warnings"/"error" entry
+    The "model" stage of the request is the time to the first chunk
+    Parameters:
+        - text_stream: async generator of text chunks returned by the backend
+        - model_name: name of the model handle producing the stream
+    """
+    async def forward_text_stream(self, text_stream, model_name):
+        response_texts = []
+        started_at = time.perf_counter()
+        try:
+            with self.metrics.time_upstream(model_name):
+                async for text in text_stream:
+                    if not response_texts:
+                        record_stage("model", time.perf_counter() - started_at)
+                    response_texts.append(text)
+                    yield {
+                        "response": text
+                    }
+        except Exception as error:
+            if is_retryable_error(error):
+                self.router.record(model_name, time.perf_counter() - started_at, False)
+            yield {
+                "error": str(error)
+            }
+            return
+        finally:
+            # Propagate cancellation upstream by closing the model stream
+            await text_stream.aclose()
+        self.router.record(model_name, time.perf_counter() - started_at, True)
+
+        # Return warning if the model is unable to generate text content
+        if len(response_texts) == 0:
+            yield {
+                "warnings": ["Sorry. We are having trouble generating text content for this image. Try again."]
+            }
+            return
+
+        yield {
+            "complete_text": "".join(response_texts)
+        }
+
+    """
+    Function to make the upstream text generation call and return the generated texts and the model that answered
+    Parameters:
+        - final_prompt: complete prompt sent to the model
+        - priority: admission lane of the request
+        - model_names: routed models in order of preference
+    """
+    async def request_text_content(self, final_prompt, priority, model_names):
+        async def call_model(model_name):
+            async with self.admission.slot(model_name, priority):
+                with self.metrics.time_upstream(model_name):
+                    return await self.backend.generate_text(final_prompt, self.text_generation_config, model_name)
+
+        # Text generation is idempotent, so slow attempts can be hedged to cut tail latency
+        return await self.route_call(model_names, call_model, hedge=True)
+
+    """
+    Function to call the routed models in order of preference until one returns a result
+    Returns (result, name of the model that returned it)
+    The next model is tried when a model is saturated, its circuit is open or its retries ran out on transient errors,
+    other errors are raised straight away
+    Parameters:
+        - model_names: routed models in order of preference (ModelRouter.route)
+        - call_model: async function of the model name making one upstream call
+        - hedge: whether slow attempts are hedged
+    """
+    async def route_call(self, model_names, call_model, hedge=False):
+        for position, model_name in enumerate(model_names):
+            started_at = time.perf_counter()
+            try:
+                result = await self.resilience.call(model_name, lambda: call_model(model_name), hedge=hedge)
+            except Exception as error:
+                # Saturation is a local limit, so only transient upstream errors count against the model
+                if is_retryable_error(error):
+                    self.router.record(model_name, time.perf_counter() - started_at, False)
+                if position + 1 < len(model_names) and (isinstance(error, ModelSaturatedError) or is_retryable_error(error)):
+                    continue
+                raise
+            self.router.record(model_name, time.perf_counter() - started_at, True, fallback=position > 0)
+            return result, model_name
+
+    """
+    Function to return the first model whose circuit lets calls through
+    Raises CircuitOpenError of the last model when all circuits are open
+    Parameters:
+        - model_names: routed models in order of preference
+    """
+    def first_available_model(self, model_names):
+        for position, model_name in enumerate(model_names):
+            try:
+                self.resilience.callers[model_name].check_circuit()
+                return model_name
+            except ModelSaturatedError:
+                if position + 1 == len(model_names):
+                    raise
         
+    """
+    Function to generate text content for a batch of prompts and yield each result as soon as it completes
+    At most batch_concurrency items are in flight, and they run in the batch admission lane so interactive
+    requests are admitted first while the same per-model limits apply
+    Yields dicts with the item "index" and a "response", "warnings" or "error" entry (in completion order)
+    Parameters:
+        - items: list of (prompt, content_type, bypass_cache) tuples
+    """
+    async def generate_text_batch(self, items):
+        results = asyncio.Queue()
+        next_index = iter(range(len(items)))
+
+        async def generate_item(index):
+            prompt, content_type, bypass_cache = items[index]
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    return await self.generate_text_content(prompt, content_type, bypass_cache, PRIORITY_BATCH)
+                except ModelSaturatedError as error:
+                    # Wait for capacity as advised by the admission controller, then report the item as failed
+                    if attempt >= self.batch_max_attempts:
+                        return {
+                            "error": str(error),
+                            "status_code": error.status_code,
+                            "retry_after": error.retry_after
+                        }
+                    await asyncio.sleep(error.retry_after)
+
+        async def worker():
+            for index in next_index:
+                try:
+                    result = await generate_item(index)
+                except Exception as error:
+                    result = {
+                        "error": str(error)
+                    }
+                await results.put({"index": index, **result})
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(self.batch_concurrency, len(items)))]
+        try:
+            for _ in range(len(items)):
+                yield await results.get()
+        finally:
+            # Stop generating when the consumer goes away (e.g. the client disconnected)
+            for task in workers:
+                task.cancel()
+
+    """
+    Function to compute the perceptual fingerprint of an upload, before it is preprocessed, so near-duplicates
+    of cached images are answered without resizing or re-encoding them
+    Returns None when perceptual matching is disabled or the image is too uniform to be matched safely
+    Parameters:
+        - upload: result of ImageValidator.read_upload for the uploaded image
+    """
+    async def perceptual_fingerprint(self, upload):
+        if not self.image_result_cache.perceptual_hash_enabled:
+            return None
+        with stage("preprocess"):
+            return await self.image_preprocessor.fingerprint(
+                upload["image_bytes"],
+                self.image_result_cache.perceptual_hash_min_stddev,
+                self.image_result_cache.perceptual_hash_min_bits,
+            )
+
     """
     Function to accept an image file and return a list of captions
     Parameters:
@@ -95,25 +438,14 @@ class ContentGenerator:
     async def generate_image_captions(self, image):
         try:
 
-            # Initialise an empty list for probable warnings
-            warnings = []
-
-            # Check for appropriate file extension
-            file_extension = str(image.content_type).split("/")[-1]
-            allowed_file_extensions = ["jpeg", "jpg", "png"]
-            if file_extension.lower() not in allowed_file_extensions:
-                warnings.append("Only images with extensions jpeg, jpg and png are allowed.")
-
-            # Check for appropriate file size
-            file_size = image.size
-            if file_size >= 27000000:
-                warnings.append("File size is too large. Choose a file of a size lower than 20 MB.")
+            # Read the upload incrementally, sniffing the real format and dimensions from its header
+            # Non-images, oversized files and decompression bombs are rejected before being fully buffered
+            upload = await self.image_validator.read_upload(image)
 
             # Check for image warnings and return warning response if present
-            if len(warnings) > 0:
-                print("bad")
+            if "warnings" in upload:
                 return {
-                    "warnings": warnings
+                    "warnings": upload["warnings"]
                 }
             
             """
@@ -121,30 +453,65 @@ class ContentGenerator:
             model = ImageCaptioningModel.from_pretrained("imagetext@001")
             """
 
-            # Create temporary image path in /tmp directory to write file
-            # Append a UUID (version 7) to the end of the file name to prevent collisions
-            temp_image_path = f"/tmp/image_temp_{uuid7()}.jpeg"
-            with open(temp_image_path, "wb") as buffer:
-                buffer.write(await image.read())
+            # Return cached captions when the exact same image bytes have been captioned before
+            cache_parameters = ("imagetext@001", 3, "en")
+            cache_key = self.image_result_cache.make_key("captions", upload["sha256"], *cache_parameters)
+            cached_response = self.image_result_cache.get(cache_key)
+            if cached_response is not None:
+                return {
+                    "response": cached_response["response"],
+                    "image_bytes": {
+                        "original": len(upload["image_bytes"]),
+                        "sent": 0
+                    }
+                }
 
-            # Load image in appropriate format for vertex to handle
-            image = Image.load_from_file(temp_image_path)
+            # Return cached captions of a visually identical image (re-encoded or resized copy)
+            fingerprint = await self.perceptual_fingerprint(upload)
+            cached_response = self.image_result_cache.get_similar(fingerprint, "captions", *cache_parameters)
+            if cached_response is not None:
+                return {
+                    "response": cached_response["response"],
+                    "image_bytes": {
+                        "original": len(upload["image_bytes"]),
+                        "sent": 0
+                    }
+                }
 
-            # Get captions for image
-            captions = self.vertex_image_captioning_model.get_captions(
-                image=image,
-                number_of_results=3,
-                language="en",
-            )
+            # Downscale, normalise orientation and re-encode the upload off the event loop
+            # The captioning model only accepts JPEG and PNG, so always re-encode as JPEG for it
+            with stage("preprocess"):
+                processed = await self.image_preprocessor.preprocess(
+                    upload["image_bytes"],
+                    upload["mime_type"],
+                    output_format="JPEG",
+                )
 
-            # Remove file from /tmp directory
-            os.remove(temp_image_path)
+            # Get captions for image once the captioning model has a free slot
+            async def call_model():
+                async with self.admission.slot("vertex_image_captioning_model", PRIORITY_CAPTIONING):
+                    with self.metrics.time_upstream("vertex_image_captioning_model"):
+                        return await self.backend.get_captions(processed["image_bytes"], number_of_results=3, language="en")
 
-            # Return successful response
+            with stage("model"):
+                captions = await self.resilience.call("vertex_image_captioning_model", call_model)
+
+            # Cache captions for this image
+            self.image_result_cache.set(cache_key, {"response": captions}, upload["sha256"], fingerprint)
+
+            # Return successful response with the original and sent image sizes
             return {
-                "response": captions
+                "response": captions,
+                "image_bytes": {
+                    "original": processed["original_bytes"],
+                    "sent": processed["sent_bytes"]
+                }
             }
 
+        # Let saturation errors through so the API can answer 429/503 with Retry-After
+        except ModelSaturatedError:
+            raise
+
         # Return exception error
         except Exception as error:
             return {
@@ -162,33 +529,16 @@ class ContentGenerator:
             # Initialise an empty list for probable warnings
             warnings = []
 
-            # Check for appropriate file extension
-            file_extension = str(image.content_type).split("/")[-1]
-            allowed_file_extensions = ["jpeg", "jpg", "png"]
-            if file_extension.lower() not in allowed_file_extensions:
-                warnings.append("Only images with extensions jpeg, jpg and png are allowed.")
-
-            # Check for appropriate file size
-            file_size = image.size
-            if file_size >= 27000000:
-                warnings.append("File size is too large. Choose a file of a size lower than 20 MB.")
+            # Read the upload incrementally, sniffing the real format and dimensions from its header
+            # Non-images, oversized files and decompression bombs are rejected before being fully buffered
+            upload = await self.image_validator.read_upload(image)
 
             # Check for image warnings and return warning response if present
-            if len(warnings) > 0:
-                print("bad")
+            if "warnings" in upload:
                 return {
-                    "warnings": warnings
+                    "warnings": upload["warnings"]
                 }
             
-            # Create temporary image path in /tmp directory to write file
-            # Append a UUID (version 7) to the end of the file name to prevent collisions
-            temp_image_path = f"/tmp/image_temp_{uuid7()}.jpeg"
-            with open(temp_image_path, "wb") as buffer:
-                buffer.write(await image.read())
-            
-            # Load image in appropriate format for vertex to handle
-            image = Image.load_from_file(temp_image_path)
-            
             # Use gemini pro vision model to generate text from image based on prompt
             """
             genai.configure(api_key=GEMINI_API_KEY)
@@ -196,23 +546,49 @@ class ContentGenerator:
             """
 
             # Specify in prompt if the text should be a story, poem or song
-            if content_type == "1":
-                content_type_string = "story"
-            elif content_type == "2":
-                content_type_string = "poem"
-            else:
-                content_type_string = "song that rhymes"
+            final_prompt = self.build_image_text_prompt(prompt, content_type)
+
+            # Return a cached result of the routed model when the same image bytes were used with the same prompt before
+            model_names = await self.router.route("image", final_prompt, content_type)
+            cache_parameters = (model_names[0], ResponseCache.normalise_prompt(final_prompt))
+            cache_key = self.image_result_cache.make_key("text_from_image", upload["sha256"], *cache_parameters)
+            cached_response = self.image_result_cache.get(cache_key)
+            if cached_response is not None:
+                return {
+                    "response": cached_response["response"],
+                    "image_bytes": {
+                        "original": len(upload["image_bytes"]),
+                        "sent": 0
+                    }
+                }
 
-            final_prompt = f"Write a {content_type_string} about this image with the following prompt: {prompt}. Include an appropriate title in bold for the content generated in the final response."
+            # Return a cached result of a visually identical image used with the same prompt
+            fingerprint = await self.perceptual_fingerprint(upload)
+            cached_response = self.image_result_cache.get_similar(fingerprint, "text_from_image", *cache_parameters)
+            if cached_response is not None:
+                return {
+                    "response": cached_response["response"],
+                    "image_bytes": {
+                        "original": len(upload["image_bytes"]),
+                        "sent": 0
+                    }
+                }
 
-            response = self.gemini_model.generate_content([final_prompt, PIL.Image.open(temp_image_path)])
-            response_texts = []
+            # Downscale, normalise orientation and re-encode the upload off the event loop
+            with stage("preprocess"):
+                processed = await self.image_preprocessor.preprocess(
+                    upload["image_bytes"],
+                    upload["mime_type"],
+                )
 
-            # Remove file from /tmp directory
-            os.remove(temp_image_path)
+            # Pass the processed bytes to the model in memory, so the image is never written to disk
+            async def call_model(model_name):
+                async with self.admission.slot(model_name, PRIORITY_TEXT):
+                    with self.metrics.time_upstream(model_name):
+                        return await self.backend.generate_text_from_image(final_prompt, processed["image_bytes"], processed["mime_type"], model_name)
 
-            for candidate in response.candidates:
-                response_texts = [part.text for part in candidate.content.parts]
+            with stage("model"):
+                response_texts, model_name = await self.route_call(model_names, call_model)
 
             # Return warning if the model is unable to generate content for the image
             if len(response_texts) == 0:
@@ -221,103 +597,349 @@ class ContentGenerator:
                     "warnings": warnings
                 }
             
-            # Return successful response
+            # Cache the generated text for this image and prompt under the model that generated it
+            if model_name != model_names[0]:
+                cache_key = self.image_result_cache.make_key("text_from_image", upload["sha256"], model_name, cache_parameters[1])
+            self.image_result_cache.set(cache_key, {"response": response_texts[0]}, upload["sha256"], fingerprint)
+
+            # Return successful response with the original and sent image sizes
             return {
-                "response": response_texts[0]
+                "response": response_texts[0],
+                "image_bytes": {
+                    "original": processed["original_bytes"],
+                    "sent": processed["sent_bytes"]
+                }
             }
 
+        # Let saturation errors through so the API can answer 429/503 with Retry-After
+        except ModelSaturatedError:
+            raise
+
         # Return exception error
         except Exception as error:
             return {
                 "error": str(error)
             }
         
+    """
+    Function to build the final prompt for text generated about an image
+    Parameters:
+        - prompt: text provided by user to assist in text content generation
+        - content_type: number string to indicate if generated text should be a story, poem or song
+    """
+    def build_image_text_prompt(self, prompt, content_type):
+        if content_type == "1":
+            content_type_string = "story"
+        elif content_type == "2":
+            content_type_string = "poem"
+        else:
+            content_type_string = "song that rhymes"
+
+        return f"Write a {content_type_string} about this image with the following prompt: {prompt}. Include an appropriate title in bold for the content generated in the final response."
+
+    """
+    Function to generate text about an uploaded image and yield it in pieces as the model produces it
+    Yields dicts with a "response" text chunk, or a final "warnings"/"error" entry
+    Parameters:
+        - upload: result of ImageValidator.read_upload for the uploaded image
+        - content_type: number string to indicate if generated text should be a story, poem or song
+        - prompt: text provided by user to assist in text content generation
+    """
+    async def stream_text_from_image(self, upload, content_type, prompt):
+        # Return image warnings before anything is sent upstream
+        if "warnings" in upload:
+            yield {
+                "warnings": upload["warnings"]
+            }
+            return
+
+        final_prompt = self.build_image_text_prompt(prompt, content_type)
+        model_names = await self.router.route("image", final_prompt, content_type)
+        cache_parameters = (model_names[0], ResponseCache.normalise_prompt(final_prompt))
+        cache_key = self.image_result_cache.make_key("text_from_image", upload["sha256"], *cache_parameters)
+
+        # Replay a cached result of the routed model for the same image and prompt as a single chunk
+        cached_response = self.image_result_cache.get(cache_key)
+        if cached_response is not None:
+            yield cached_response
+            return
+
+        try:
+            # Replay a cached result of a visually identical image used with the same prompt
+            fingerprint = await self.perceptual_fingerprint(upload)
+            cached_response = self.image_result_cache.get_similar(fingerprint, "text_from_image", *cache_parameters)
+            if cached_response is not None:
+                yield cached_response
+                return
+
+            # Downscale, normalise orientation and re-encode the upload off the event loop
+            with stage("preprocess"):
+                processed = await self.image_preprocessor.preprocess(
+                    upload["image_bytes"],
+                    upload["mime_type"],
+                )
+
+        except Exception as error:
+            yield {
+                "error": str(error)
+            }
+            return
+
+        # Pick the first routed model whose circuit is closed, then hold a model slot for the whole stream
+        model_name = self.first_available_model(model_names)
+        if model_name != model_names[0]:
+            cache_key = self.image_result_cache.make_key("text_from_image", upload["sha256"], model_name, cache_parameters[1])
+        async with self.admission.slot(model_name, PRIORITY_TEXT):
+            text_stream = self.backend.stream_text_from_image(final_prompt, processed["image_bytes"], processed["mime_type"], model_name)
+
+            # Forward each chunk as soon as it arrives and cache the complete text once the stream ends
+            async for chunk in self.forward_text_stream(text_stream, model_name):
+                if "complete_text" in chunk:
+                    self.image_result_cache.set(cache_key, {"response": chunk["complete_text"]}, upload["sha256"], fingerprint)
+                else:
+                    yield chunk
+
     """
     Function to accept a prompt to generate an images
     Parameters:
         - prompt: text to generate images
         - style: art style key
         - orientation: image orientation/ratio key
+        - delivery: "base64" to return the images inline or "url" to return ids of images kept in the blob store
+        - variants: optional variant names (see IMAGE_VARIANTS); each image is then returned as a dict of its variants
     """    
-    async def generate_image_from_text(self, prompt, style, orientation):
+    async def generate_image_from_text(self, prompt, style, orientation, delivery="base64", variants=None):
         try:
             # Initialise an empty list for probable warnings
             warnings = []
 
-            # Define style type based on style(key)
-            style_text = "sketch"
-            if style.strip() == "1":
-                style_text = "real life photography"
-            if style.strip() == "2":
-                style_text = "an oil painting"
-            elif style.strip() == "3":
-                style_text = "an acrylic painting"
-            elif style.strip() == "4":
-                style_text = "a watercolor"
-            elif style.strip() == "5":
-                style_text = "a digital art piece"
-            else:
-                style_text = "sketch"
+            # Check the requested variants can be produced before calling the model
+            if variants is not None:
+                variants = list(dict.fromkeys(variants))
+                unsupported = self.image_postprocessor.unsupported_variants(variants)
+                if unsupported:
+                    warnings.append(f"Image variants not supported by this server: {', '.join(unsupported)}.")
+                    return {
+                        "warnings": warnings
+                    }
 
-            # Define image ratio based based on orientation (key)
-            ratio = "4:3"
-            # Square
-            if orientation == "1":
-                ratio = "1:1"
-            # Portrait
-            elif orientation == "2": 
-                ratio = "3:4"
-            # Landscape
-            else:
-                ratio = "4:3"
-            
-            # Use style and prompt text to define final prompt
-            final_prompt = f"{style_text} of {prompt}"
+            # Use style and prompt text to define final prompt and image ratio
+            final_prompt, ratio = self.build_image_prompt(prompt, style, orientation)
+
+            # Reject prompts known to be blocked without calling the model
+            with stage("screen"):
+                self.safety_screen.screen(final_prompt)
 
             # Generate three images with prompt
-            images = self.vertex_image_generation_model.generate_images(
-                prompt=final_prompt,
-                number_of_images=3,
-                language="en",
-                aspect_ratio=ratio,
-                safety_filter_level="block_some",
-                person_generation="allow_adult",
+            # Identical concurrent requests (same normalised prompt, style and orientation) share one upstream call
+            coalescing_key = ResponseCache.make_key(
+                "imagegeneration@006",
+                ResponseCache.normalise_prompt(final_prompt),
+                ratio,
             )
-
-            # Encode images as base 64 strings
-            images_base64 = []
-            for image in images:
-                temp_image_path = f"/tmp/image_temp_{uuid7()}.png"
-                image.save(temp_image_path, include_generation_parameters=False)
-                with open(temp_image_path, "rb") as image_file:
-                    images_base64.append(base64.b64encode(image_file.read()).decode('utf-8'))
-                os.remove(temp_image_path)
+            with stage("model"):
+                images_bytes = await self.image_generation_single_flight.run(
+                    coalescing_key,
+                    lambda: self.request_images(final_prompt, ratio),
+                )
 
             # Return general warning if the model is unable to generate images for the prompt
-            if not images:
+            if not images_bytes:
                 warnings.append("Sorry. We are having trouble generating images for this prompt. Try again.")
                 return {
                     "warnings": warnings
                 }
+
+            # Encode the requested variants of every image in parallel
+            if variants is not None:
+                with stage("postprocess"):
+                    images = await self.image_postprocessor.postprocess(images_bytes, variants)
+                with stage("encode"):
+                    if delivery == "url":
+                        images = [
+                            {
+                                variant: {"id": await self.image_blob_store.put(variant_bytes, mime_type), "media_type": mime_type}
+                                for variant, (variant_bytes, mime_type) in image.items()
+                            }
+                            for image in images
+                        ]
+                    else:
+                        images = [
+                            {
+                                variant: {"data": base64.b64encode(memoryview(variant_bytes)).decode("ascii"), "media_type": mime_type}
+                                for variant, (variant_bytes, mime_type) in image.items()
+                            }
+                            for image in images
+                        ]
+                return {
+                    "response": images
+                }
+
+            # Keep the images in the blob store and return their ids, so the response body stays small
+            if delivery == "url":
+                with stage("encode"):
+                    image_ids = [
+                        await self.image_blob_store.put(image_bytes, "image/png")
+                        for image_bytes in images_bytes
+                    ]
+                return {
+                    "response": image_ids
+                }
+
+            # Encode images as base 64 strings straight from the PNG bytes returned by the model
+            # A memoryview avoids copying the buffer before encoding and nothing is written to disk
+            with stage("encode"):
+                images_base64 = [
+                    base64.b64encode(memoryview(image_bytes)).decode("ascii")
+                    for image_bytes in images_bytes
+                ]
             
             # Return successful response
             return {
                 "response": images_base64
             }
 
+        # Let saturation errors through so the API can answer 429/503 with Retry-After
+        except ModelSaturatedError:
+            raise
+
+        # Return warning if the prompt violates the safety policy
+        except SafetyBlockedError as error:
+            return {
+                "warnings": [str(error)]
+            }
+
         # Return exception error
         except Exception as error:
-            # Return warning if prompt violates ethical concerns
-            if str(error) == "400 Image generation failed with the following error: \
-                The prompt could not be submitted. Your current safety settings for person/face generation prohibited one or more words in this prompt. If you think this was an error, send feedback.":
-                return {
-                    "warnings": ["Child content detected and blocked. Please ensure that your prompt does not solicit inappropriate content."]
-                }
-            if str(error == "400 Image generation failed with the following error: \
-                   The prompt could not be submitted. This prompt contains sensitive words that violate Google's Responsible AI practices. Try rephrasing the prompt. If you think this was an error, send feedback."):
+            return {
+                "error": str(error)
+            }
+
+    """
+    Function to build the final image generation prompt and the image ratio
+    Parameters:
+        - prompt: text to generate images
+        - style: art style key
+        - orientation: image orientation/ratio key
+    """
+    def build_image_prompt(self, prompt, style, orientation):
+        # Define style type based on style(key)
+        style_text = "sketch"
+        if style.strip() == "1":
+            style_text = "real life photography"
+        if style.strip() == "2":
+            style_text = "an oil painting"
+        elif style.strip() == "3":
+            style_text = "an acrylic painting"
+        elif style.strip() == "4":
+            style_text = "a watercolor"
+        elif style.strip() == "5":
+            style_text = "a digital art piece"
+        else:
+            style_text = "sketch"
+
+        # Define image ratio based based on orientation (key)
+        ratio = "4:3"
+        # Square
+        if orientation == "1":
+            ratio = "1:1"
+        # Portrait
+        elif orientation == "2": 
+            ratio = "3:4"
+        # Landscape
+        else:
+            ratio = "4:3"
+
+        return f"{style_text} of {prompt}", ratio
+
+    """
+    Function to screen an image generation request before it is queued, raising SafetyBlockedError when it is known to be blocked
+    Parameters:
+        - prompt: text to generate images
+        - style: art style key
+        - orientation: image orientation/ratio key
+    """
+    def screen_image_prompt(self, prompt, style, orientation):
+        final_prompt, _ = self.build_image_prompt(prompt, style, orientation)
+        self.safety_screen.screen(final_prompt)
+
+    """
+    Function to run an image generation job, adding its images to the job once they are generated
+    The three images are requested in one call, in the image job lane so interactive image generation is admitted first,
+    and are pinned in the blob store until the job expires
+    Parameters:
+        - job: job record created by ImageJobQueue.submit
+    """
+    async def run_image_job(self, job):
+        request = job["request"]
+        final_prompt, ratio = self.build_image_prompt(request["prompt"], request["style"], request["orientation"])
+
+        # Jobs are screened when submitted, the prompt may have been blocked upstream since
+        try:
+            self.safety_screen.screen(final_prompt)
+        except SafetyBlockedError as error:
+            return {
+                "warnings": [str(error)]
+            }
+
+        # Wait and try again while image generation is saturated, as nobody is waiting on the connection
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                images_bytes = await self.request_images(final_prompt, ratio, priority=PRIORITY_IMAGE_JOB)
+                break
+            except SafetyBlockedError as error:
                 return {
-                    "warnings": ["Content blocked for ethical reasons. Please ensure that your prompt does not elicit drugs, violence or sensual content."]
+                    "warnings": [str(error)]
                 }
+            except ModelSaturatedError as error:
+                if attempt >= self.image_job_max_attempts:
+                    raise
+                await asyncio.sleep(error.retry_after)
+
+        # Finished jobs expire ttl_seconds after they end, which is right after their images are stored
+        for image_bytes in images_bytes:
+            image_id = await self.image_blob_store.put(image_bytes, "image/png", pinned_seconds=self.image_jobs.ttl_seconds)
+            await self.image_jobs.add_image(job, image_id)
+
+        if not images_bytes:
             return {
-                "error": str(error)
-            }
\ No newline at end of file
+                "warnings": ["Sorry. We are having trouble generating images for this prompt. Try again."]
+            }
+        if len(images_bytes) < 3:
+            return {
+                "warnings": [f"{3 - len(images_bytes)} of the images could not be generated."]
+            }
+        return {}
+
+    """
+    Function to make the upstream image generation call and return the PNG bytes of the images
+    Parameters:
+        - final_prompt: complete prompt sent to the model
+        - ratio: image aspect ratio
+        - number_of_images: number of images to generate
+        - priority: admission lane of the call
+    Raises SafetyBlockedError when the safety filters block the prompt
+    """
+    async def request_images(self, final_prompt, ratio, number_of_images=3, priority=PRIORITY_IMAGE_GENERATION):
+        async def call_model():
+            async with self.admission.slot("vertex_image_generation_model", priority):
+                with self.metrics.time_upstream("vertex_image_generation_model"):
+                    return await self.backend.generate_images(
+                        final_prompt,
+                        number_of_images=number_of_images,
+                        aspect_ratio=ratio,
+                        safety_filter_level="block_some",
+                        person_generation="allow_adult",
+                    )
+
+        try:
+            return await self.resilience.call("vertex_image_generation_model", call_model)
+        except Exception as error:
+            # Remember prompts blocked by the safety filters so repeats are rejected by the pre-flight screening
+            category = classify_safety_error(error)
+            if category is None:
+                raise
+            self.safety_screen.record_upstream_block(final_prompt, category)
+            raise SafetyBlockedError(category, "upstream") from error
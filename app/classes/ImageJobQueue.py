@@ -0,0 +1,399 @@
+import asyncio
+from collections import OrderedDict
+import datetime
+import ipaddress
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+from uuid_extensions import uuid7str
+from .AdmissionController import ModelSaturatedError
+from .SharedState import open_shared_database, process_alive, shared_state_path
+
+logger = logging.getLogger(__name__)
+
+class ImageJobQueue:
+    """
+    Queue of asynchronous image generation jobs run by a bounded pool of worker tasks
+    Jobs are identified by a UUID (version 7), report the images finished so far while they run,
+    can notify a webhook when they end and expire a while after they end
+    When IMAGE_JOB_SQLITE_PATH (or SHARED_STATE_DIR) is set, job records are also written to a SQLite table
+    shared by the worker processes: a job runs in the worker that accepted it but can be polled from any of them,
+    and the queue bound applies to the jobs queued across the host
+    The SQLite queries run in a thread, as a write may wait for the database lock held by another worker
+    Configured from environment variables:
+    IMAGE_JOB_WORKERS, IMAGE_JOB_MAX_QUEUE, IMAGE_JOB_TTL_SECONDS, IMAGE_JOB_MAX_JOBS,
+    IMAGE_JOB_WEBHOOK_TIMEOUT_SECONDS, IMAGE_JOB_WEBHOOK_MAX_ATTEMPTS, IMAGE_JOB_WEBHOOK_ALLOWED_HOSTS and
+    IMAGE_JOB_WEBHOOK_ALLOW_PRIVATE_ADDRESSES
+    """
+    def __init__(self, runner):
+        self.runner = runner
+        self.workers_count = int(os.environ.get("IMAGE_JOB_WORKERS", "4"))
+        self.max_queue = int(os.environ.get("IMAGE_JOB_MAX_QUEUE", "100"))
+        self.ttl_seconds = float(os.environ.get("IMAGE_JOB_TTL_SECONDS", "3600"))
+        self.max_jobs = int(os.environ.get("IMAGE_JOB_MAX_JOBS", "10000"))
+        self.webhook_timeout_seconds = float(os.environ.get("IMAGE_JOB_WEBHOOK_TIMEOUT_SECONDS", "10"))
+        self.webhook_max_attempts = int(os.environ.get("IMAGE_JOB_WEBHOOK_MAX_ATTEMPTS", "3"))
+        allowed_hosts = os.environ.get("IMAGE_JOB_WEBHOOK_ALLOWED_HOSTS", "")
+        self.webhook_allowed_hosts = {host.strip().lower() for host in allowed_hosts.split(",") if host.strip()}
+        self.webhook_allow_private_addresses = os.environ.get("IMAGE_JOB_WEBHOOK_ALLOW_PRIVATE_ADDRESSES", "false").lower() == "true"
+
+        self.jobs = OrderedDict()
+        self.queue = None
+        self.workers = []
+        self.webhook_tasks = set()
+        # httpx transport of the webhook deliveries (None for the default one)
+        self.webhook_transport = None
+
+        # Optional job table shared by the worker processes
+        self.connection = None
+        self.connection_lock = threading.Lock()
+        sqlite_path = os.environ.get("IMAGE_JOB_SQLITE_PATH") or shared_state_path("image_jobs")
+        if sqlite_path:
+            self.connection = open_shared_database(sqlite_path)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS image_jobs (job_id TEXT PRIMARY KEY, pid INTEGER NOT NULL, status TEXT NOT NULL, expires_at REAL, record TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS image_jobs_status ON image_jobs (status)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS image_jobs_expires_at ON image_jobs (expires_at)")
+
+        # Counters
+        self.submitted = 0
+        self.rejected = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.expired = 0
+        self.webhook_failures = 0
+
+    """
+    Function to check whether an address can be the target of a webhook
+    Loopback, private, link-local, reserved, multicast and other non-public addresses are refused,
+    so a webhook cannot be used to reach the host itself, its network or the cloud metadata service
+    Parameters:
+        - address: IP address returned by the resolver
+    """
+    def is_public_address(self, address):
+        address = ipaddress.ip_address(address.split("%")[0])
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        return address.is_global and not (
+            address.is_loopback or address.is_private or address.is_link_local
+            or address.is_reserved or address.is_multicast or address.is_unspecified
+        )
+
+    """
+    Function to check that a webhook URL is http(s), when an allow list is configured, on an allowed host,
+    and that its host only resolves to public addresses
+    Returns one of the checked addresses, which the delivery connects to, or None when private addresses are allowed
+    Raises ValueError when the URL is refused
+    Parameters:
+        - webhook_url: URL given by the client
+    """
+    async def validate_webhook_url(self, webhook_url):
+        parsed = urlparse(webhook_url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ValueError("webhook_url must be an http or https URL.")
+        if self.webhook_allowed_hosts and parsed.hostname.lower() not in self.webhook_allowed_hosts:
+            raise ValueError("webhook_url host is not allowed.")
+        if self.webhook_allow_private_addresses:
+            return None
+
+        # Resolve the host without blocking the event loop and refuse it when any of its addresses is not public
+        try:
+            port = parsed.port or (443 if parsed.scheme == "https" else 80)
+            addresses = await asyncio.get_running_loop().getaddrinfo(parsed.hostname, port, type=socket.SOCK_STREAM)
+        except (socket.gaierror, ValueError):
+            raise ValueError("webhook_url host could not be resolved.")
+        if not addresses or not all(self.is_public_address(sockaddr[0]) for _, _, _, _, sockaddr in addresses):
+            raise ValueError("webhook_url host is not allowed.")
+        return addresses[0][4][0]
+
+    """
+    Function to build the request of a webhook delivery that connects to an address checked by validate_webhook_url
+    rather than letting the HTTP client resolve the host again, which a DNS record changed in between (DNS rebinding)
+    could point to a private address. The Host header and the TLS server name (SNI, also used to verify the
+    certificate) keep the host of the webhook URL
+    Returns the URL to post to, its headers and its httpx extensions
+    Parameters:
+        - webhook_url: URL given by the client
+        - address: address returned by validate_webhook_url, or None to let the client resolve the host
+    """
+    def pin_webhook_request(self, webhook_url, address):
+        if address is None:
+            return webhook_url, {}, {}
+        parsed = urlparse(webhook_url)
+        host = f"[{address}]" if ":" in address else address
+        netloc = f"{host}:{parsed.port}" if parsed.port else host
+        host_header = parsed.netloc.rpartition("@")[2]
+        extensions = {"sni_hostname": parsed.hostname} if parsed.scheme == "https" else {}
+        return parsed._replace(netloc=netloc).geturl(), {"Host": host_header}, extensions
+
+    """
+    Function to start the worker tasks on the running event loop (once)
+    """
+    def start(self):
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.workers_count)]
+
+    """
+    Function to cancel the worker tasks
+    """
+    def shutdown(self):
+        for task in self.workers + list(self.webhook_tasks):
+            task.cancel()
+        self.workers = []
+        self.queue = None
+
+    """
+    Function to queue a job and return it
+    Raises ModelSaturatedError (429) when the queue is full and ValueError when the webhook URL is refused
+    Parameters:
+        - request: parameters passed to the runner
+        - webhook_url: optional URL notified with the job status when the job ends
+    """
+    async def submit(self, request, webhook_url=None):
+        if webhook_url is not None:
+            await self.validate_webhook_url(webhook_url)
+        self.start()
+        await self.expire()
+
+        if self.queue.full() or await self.shared_queue_full():
+            self.rejected += 1
+            raise ModelSaturatedError("image_generation_jobs", 429, 30, "Too many image generation jobs are queued. Try again later.")
+
+        now = time.time()
+        job = {
+            "job_id": uuid7str(),
+            "status": "queued",
+            "request": request,
+            "webhook_url": webhook_url,
+            "images": [],
+            "warnings": [],
+            "error": None,
+            "created_at": int(now),
+            "started_at": None,
+            "finished_at": None,
+            "expires_at": None,
+        }
+        self.jobs[job["job_id"]] = job
+        await self.save(job)
+        self.queue.put_nowait(job)
+        self.submitted += 1
+        return job
+
+    """
+    Function to run a query on the shared table in a thread and return its rows
+    Parameters:
+        - query: SQL statement
+        - parameters: values bound to the statement
+    """
+    async def execute(self, query, parameters=()):
+        def run():
+            with self.connection_lock:
+                return self.connection.execute(query, parameters).fetchall()
+        return await asyncio.to_thread(run)
+
+    """
+    Function to check whether max_queue jobs are already queued across the worker processes
+    """
+    async def shared_queue_full(self):
+        if self.connection is None:
+            return False
+        # Jobs left queued by workers that exited are not counted
+        queued = sum(
+            count
+            for pid, count in await self.execute("SELECT pid, COUNT(*) FROM image_jobs WHERE status = 'queued' GROUP BY pid")
+            if process_alive(pid)
+        )
+        return queued >= self.max_queue
+
+    """
+    Function to write a job record to the shared table
+    Parameters:
+        - job: job record
+    """
+    async def save(self, job):
+        if self.connection is None:
+            return
+        # The record is serialised here, as the job keeps changing on the event loop
+        await self.execute(
+            "INSERT OR REPLACE INTO image_jobs (job_id, pid, status, expires_at, record) VALUES (?, ?, ?, ?, ?)",
+            (job["job_id"], os.getpid(), job["status"], job["expires_at"], json.dumps(job)),
+        )
+
+    """
+    Function to read a job run by another worker process from the shared table
+    An unfinished job whose worker exited is reported as failed
+    Parameters:
+        - job_id: id returned by submit
+    """
+    async def load(self, job_id):
+        if self.connection is None:
+            return None
+        rows = await self.execute(
+            "SELECT pid, record FROM image_jobs WHERE job_id = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (job_id, time.time()),
+        )
+        if not rows:
+            return None
+        pid, record = rows[0]
+        job = json.loads(record)
+        if job["finished_at"] is None and not process_alive(pid):
+            job["status"] = "failed"
+            job["error"] = "The worker running the job exited."
+        return job
+
+    """
+    Function to get a job, returning None when it is unknown or expired
+    Parameters:
+        - job_id: id returned by submit
+    """
+    async def get(self, job_id):
+        await self.expire()
+        job = self.jobs.get(job_id)
+        if job is None:
+            job = await self.load(job_id)
+        return job
+
+    """
+    Function to add a finished image to a running job
+    Parameters:
+        - job: job being run
+        - image_id: blob store id of the image
+    """
+    async def add_image(self, job, image_id):
+        job["images"].append(image_id)
+        await self.save(job)
+
+    """
+    Function to drop jobs that ended more than ttl_seconds ago, and the oldest ended jobs above max_jobs
+    """
+    async def expire(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job["expires_at"] is not None and job["expires_at"] <= now]:
+            del self.jobs[job_id]
+            self.expired += 1
+        if len(self.jobs) > self.max_jobs:
+            for job_id in [job_id for job_id, job in self.jobs.items() if job["finished_at"] is not None][:len(self.jobs) - self.max_jobs]:
+                del self.jobs[job_id]
+                self.expired += 1
+        if self.connection is not None:
+            await self.execute("DELETE FROM image_jobs WHERE expires_at <= ?", (now,))
+
+    """
+    Function run by each worker task: take queued jobs and run them one at a time
+    """
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            job["status"] = "running"
+            job["started_at"] = int(time.time())
+            try:
+                await self.save(job)
+                result = await self.runner(job)
+                if job["images"]:
+                    job["status"] = "succeeded"
+                    self.succeeded += 1
+                else:
+                    job["status"] = "failed"
+                    self.failed += 1
+                job["warnings"] = result.get("warnings", [])
+                job["error"] = result.get("error")
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                job["status"] = "failed"
+                job["error"] = str(error)
+                self.failed += 1
+            job["finished_at"] = int(time.time())
+            job["expires_at"] = job["finished_at"] + self.ttl_seconds
+            try:
+                await self.save(job)
+            except sqlite3.OperationalError as error:
+                logger.warning("Could not save job %s: %s", job["job_id"], error)
+            # Deliver the webhook in the background so a slow receiver does not hold the worker
+            if job["webhook_url"] is not None:
+                task = asyncio.ensure_future(self.notify_webhook(job))
+                self.webhook_tasks.add(task)
+                task.add_done_callback(self.webhook_tasks.discard)
+
+    """
+    Function to describe a job for the API and the webhook
+    Parameters:
+        - job: job record
+    """
+    def describe(self, job):
+        return {
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "images": [
+                {
+                    "id": image_id,
+                    "url": f"/images/{image_id}"
+                }
+                for image_id in job["images"]
+            ],
+            "warnings": job["warnings"],
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+            "expires_at": int(job["expires_at"]) if job["expires_at"] is not None else None,
+        }
+
+    """
+    Function to POST the job status to its webhook, retrying failed deliveries with backoff
+    Parameters:
+        - job: job that ended
+    """
+    async def notify_webhook(self, job):
+        import httpx
+        payload = {
+            **self.describe(job),
+            "timestamp": int(datetime.datetime.now().timestamp())
+        }
+        async with httpx.AsyncClient(
+            timeout=self.webhook_timeout_seconds, follow_redirects=False, transport=self.webhook_transport
+        ) as client:
+            for attempt in range(1, self.webhook_max_attempts + 1):
+                # The host is checked again before each delivery, as its DNS records may have changed since submission,
+                # and the delivery connects to the address that was checked
+                try:
+                    address = await self.validate_webhook_url(job["webhook_url"])
+                except ValueError as error:
+                    logger.warning("Not delivering the webhook of job %s: %s", job["job_id"], error)
+                    break
+                url, headers, extensions = self.pin_webhook_request(job["webhook_url"], address)
+                try:
+                    response = await client.post(url, json=payload, headers=headers, extensions=extensions)
+                    if response.status_code < 500:
+                        return
+                except httpx.HTTPError as error:
+                    logger.info("Webhook delivery of job %s failed: %s", job["job_id"], error)
+                if attempt < self.webhook_max_attempts:
+                    await asyncio.sleep(2 ** attempt)
+        self.webhook_failures += 1
+        logger.warning("Giving up delivering the webhook of job %s", job["job_id"])
+
+    """
+    Function to report the queue state and counters
+    """
+    def stats(self):
+        return {
+            "workers": self.workers_count,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "max_queue": self.max_queue,
+            "jobs": len(self.jobs),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "expired": self.expired,
+            "webhook_failures": self.webhook_failures,
+        }
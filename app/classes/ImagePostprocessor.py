@@ -0,0 +1,193 @@
+import asyncio
+import io
+import os
+import threading
+import time
+import PIL.Image
+import PIL.features
+
+# Variants that can be requested for a generated image, in the order they are returned
+IMAGE_VARIANTS = ("original", "stripped", "webp", "avif", "thumbnail")
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG chunks kept when stripping metadata: image data and the chunks that change how colours are displayed
+PNG_KEPT_CHUNKS = {b"IHDR", b"PLTE", b"IDAT", b"IEND", b"tRNS", b"gAMA", b"cHRM", b"sRGB", b"iCCP", b"sBIT", b"cICP"}
+
+"""
+Function to drop the metadata chunks (text, EXIF, timestamps, ...) of a PNG without decoding it
+Returns None when the bytes are not a PNG
+Parameters:
+    - image_bytes: encoded image
+"""
+def strip_png_metadata(image_bytes):
+    if not image_bytes.startswith(PNG_SIGNATURE):
+        return None
+    view = memoryview(image_bytes)
+    chunks = [PNG_SIGNATURE]
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(image_bytes):
+        length = int.from_bytes(view[offset:offset + 4], "big")
+        chunk_type = bytes(view[offset + 4:offset + 8])
+        chunk_end = offset + 12 + length
+        if chunk_type in PNG_KEPT_CHUNKS:
+            chunks.append(view[offset:chunk_end])
+        offset = chunk_end
+        if chunk_type == b"IEND":
+            break
+    return b"".join(chunks)
+
+"""
+Function to encode an image in a format without carrying over its metadata
+Parameters:
+    - image: decoded image
+    - output_format: "PNG", "WEBP" or "AVIF"
+    - quality: encoder quality (1-100), unused for PNG
+    - avif_speed: AVIF encoder speed (0 slowest and smallest, 10 fastest)
+"""
+def encode_image(image, output_format, quality, avif_speed):
+    output = io.BytesIO()
+    if output_format == "WEBP":
+        image.save(output, format="WEBP", quality=quality, method=4)
+    elif output_format == "AVIF":
+        # Parallelism comes from the process pool, one encoder thread per process avoids oversubscribing the cores
+        image.save(output, format="AVIF", quality=quality, speed=avif_speed, max_threads=1)
+    else:
+        image.save(output, format="PNG")
+    return output.getvalue()
+
+"""
+Function to produce the requested variants of a generated image
+Runs inside a worker process, so it only takes and returns plain picklable values
+The image is decoded at most once, whatever the number of variants
+Returns a list of (variant, image_bytes, mime_type, encode_seconds)
+Parameters:
+    - image_bytes: image returned by the model
+    - variants: variant names, excluding "original"
+    - settings: formats, qualities and thumbnail size of the variants
+"""
+def postprocess_image_bytes(image_bytes, variants, settings):
+    results = []
+    image = None
+    for variant in variants:
+        started_at = time.perf_counter()
+        if variant == "stripped":
+            stripped_bytes = strip_png_metadata(image_bytes)
+            if stripped_bytes is not None:
+                results.append((variant, stripped_bytes, "image/png", time.perf_counter() - started_at))
+                continue
+
+        if image is None:
+            image = PIL.Image.open(io.BytesIO(image_bytes))
+            image.load()
+
+        if variant == "stripped":
+            output_format, quality, variant_image = "PNG", None, image
+        elif variant == "webp":
+            output_format, quality, variant_image = "WEBP", settings["webp_quality"], image
+        elif variant == "avif":
+            output_format, quality, variant_image = "AVIF", settings["avif_quality"], image
+        else:
+            output_format, quality = settings["thumbnail_format"], settings["thumbnail_quality"]
+            variant_image = image.copy()
+            variant_image.thumbnail((settings["thumbnail_size"], settings["thumbnail_size"]), PIL.Image.Resampling.LANCZOS)
+
+        variant_bytes = encode_image(variant_image, output_format, quality, settings["avif_speed"])
+        results.append((variant, variant_bytes, PIL.Image.MIME[output_format], time.perf_counter() - started_at))
+    return results
+
+class ImagePostprocessor:
+    """
+    Encodes the variants of generated images (metadata-stripped PNG, WebP, AVIF and thumbnails) in a process pool,
+    one task per image so the images of a request are encoded in parallel (see ImagePreprocessor.run_in_process)
+    Configured from environment variables:
+    IMAGE_VARIANT_WEBP_QUALITY, IMAGE_VARIANT_AVIF_QUALITY, IMAGE_VARIANT_AVIF_SPEED, IMAGE_VARIANT_THUMBNAIL_SIZE,
+    IMAGE_VARIANT_THUMBNAIL_FORMAT and IMAGE_VARIANT_THUMBNAIL_QUALITY
+    """
+    def __init__(self, run_in_process):
+        self.run_in_process = run_in_process
+        self.settings = {
+            "webp_quality": int(os.environ.get("IMAGE_VARIANT_WEBP_QUALITY", "80")),
+            "avif_quality": int(os.environ.get("IMAGE_VARIANT_AVIF_QUALITY", "60")),
+            "avif_speed": int(os.environ.get("IMAGE_VARIANT_AVIF_SPEED", "8")),
+            "thumbnail_size": int(os.environ.get("IMAGE_VARIANT_THUMBNAIL_SIZE", "256")),
+            "thumbnail_format": os.environ.get("IMAGE_VARIANT_THUMBNAIL_FORMAT", "WEBP").upper(),
+            "thumbnail_quality": int(os.environ.get("IMAGE_VARIANT_THUMBNAIL_QUALITY", "75")),
+        }
+
+        # AVIF needs a Pillow build with libavif
+        try:
+            self.avif_supported = PIL.features.check("avif")
+        except ValueError:
+            self.avif_supported = False
+
+        # Counters per variant
+        self.lock = threading.Lock()
+        self.images_processed = 0
+        self.variants = {
+            variant: {"images": 0, "bytes": 0, "encode_seconds": 0.0}
+            for variant in IMAGE_VARIANTS
+        }
+
+    """
+    Function to return the requested variants that this server cannot produce
+    Parameters:
+        - variants: requested variant names
+    """
+    def unsupported_variants(self, variants):
+        unsupported = []
+        if "avif" in variants and not self.avif_supported:
+            unsupported.append("avif")
+        if "thumbnail" in variants and self.settings["thumbnail_format"] == "AVIF" and not self.avif_supported:
+            unsupported.append("thumbnail")
+        return unsupported
+
+    """
+    Function to produce the requested variants of generated images, encoding the images in parallel in the process pool
+    Returns one dict per image mapping each variant to (image_bytes, mime_type)
+    Parameters:
+        - images_bytes: images returned by the model
+        - variants: requested variant names
+    """
+    async def postprocess(self, images_bytes, variants):
+        encoded_variants = [variant for variant in variants if variant != "original"]
+        if encoded_variants:
+            results = await asyncio.gather(*[
+                self.run_in_process(postprocess_image_bytes, image_bytes, encoded_variants, self.settings)
+                for image_bytes in images_bytes
+            ])
+        else:
+            results = [[] for _ in images_bytes]
+
+        images = []
+        with self.lock:
+            self.images_processed += len(images_bytes)
+            for image_bytes, image_results in zip(images_bytes, results):
+                encoded = {variant: (variant_bytes, mime_type) for variant, variant_bytes, mime_type, _ in image_results}
+                if "original" in variants:
+                    encoded["original"] = (image_bytes, "image/png")
+                for variant, variant_bytes, _, encode_seconds in image_results:
+                    self.variants[variant]["encode_seconds"] += encode_seconds
+                for variant, (variant_bytes, _) in encoded.items():
+                    self.variants[variant]["images"] += 1
+                    self.variants[variant]["bytes"] += len(variant_bytes)
+                images.append({variant: encoded[variant] for variant in variants})
+        return images
+
+    """
+    Function to report the variants produced, their bytes and the time spent encoding them
+    """
+    def stats(self):
+        with self.lock:
+            return {
+                "images_processed": self.images_processed,
+                "avif_supported": self.avif_supported,
+                "variants": {
+                    variant: {
+                        "images": counters["images"],
+                        "bytes": counters["bytes"],
+                        "encode_seconds": round(counters["encode_seconds"], 3),
+                    }
+                    for variant, counters in self.variants.items()
+                },
+            }
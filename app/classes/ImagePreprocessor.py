@@ -0,0 +1,255 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import io
+import multiprocessing
+import os
+import PIL.Image
+import PIL.ImageOps
+
+# EXIF tag that stores the camera orientation
+EXIF_ORIENTATION_TAG = 0x0112
+
+"""
+Function to scale an image with 16 or 32-bit grey levels to 8 bits (a plain conversion clips them to white)
+Parameters:
+    - image: decoded image in one of the "I" modes
+"""
+def scale_to_8_bit(image):
+    return image.convert("I").point(lambda value: value * (1 / 256)).convert("L")
+
+"""
+Function to flatten the transparency of an image onto a white background
+Parameters:
+    - image: decoded image with an alpha channel or a palette
+"""
+def flatten_onto_white(image):
+    image = image.convert("RGBA")
+    background = PIL.Image.new("RGB", image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel("A"))
+    return background
+
+"""
+Function to compute the perceptual fingerprint of an image: a 64-bit difference hash (dHash) with the image's
+aspect ratio, size class and mean colour, which dHash ignores
+Re-encoded or resized copies of the same picture produce hashes within a few bits of each other
+Returns None for near-constant images (flat backgrounds, near-blank pages): their hashes are all or nearly all
+the same bit whatever the content, so they would match unrelated images
+Parameters:
+    - image_bytes: encoded image
+    - min_stddev: smallest standard deviation of the hashed grey levels (0-255) of an image that is fingerprinted
+    - min_bits: smallest number of set (and of unset) bits of a hash that is kept
+"""
+def compute_perceptual_fingerprint(image_bytes, min_stddev, min_bits):
+    with PIL.Image.open(io.BytesIO(image_bytes)) as image:
+        # Size as displayed, after the EXIF rotation
+        width, height = image.size
+        if image.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+            width, height = height, width
+
+        # Decode at a reduced scale where the decoder supports it, the hash only needs 9x8 pixels
+        image.draft("RGB", (64, 64))
+        image = PIL.ImageOps.exif_transpose(image)
+        if image.mode.startswith("I"):
+            image = scale_to_8_bit(image)
+        if image.mode in ("RGBA", "LA", "PA", "P"):
+            # Flatten transparency onto white so images that only differ in their alpha channel do not look alike
+            image = flatten_onto_white(image)
+        image = image.convert("RGB")
+        mean_colour = image.resize((1, 1), PIL.Image.Resampling.BOX).getpixel((0, 0))
+        pixels = list(image.convert("L").resize((9, 8), PIL.Image.Resampling.LANCZOS).getdata())
+
+    # Skip near-constant images
+    mean = sum(pixels) / len(pixels)
+    if (sum((pixel - mean) ** 2 for pixel in pixels) / len(pixels)) ** 0.5 < min_stddev:
+        return None
+
+    perceptual_hash = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            perceptual_hash = (perceptual_hash << 1) | (1 if left > right else 0)
+    if min(perceptual_hash.bit_count(), 64 - perceptual_hash.bit_count()) < min_bits:
+        return None
+
+    return {
+        "hash": perceptual_hash,
+        "aspect_ratio": width / height,
+        # Longest side rounded down to a power of two
+        "size_class": max(width, height).bit_length(),
+        "mean_colour": list(mean_colour),
+    }
+
+"""
+Function to downscale, normalise orientation and re-encode an image
+Runs inside a worker process, so it only takes and returns plain picklable values
+Returns (image_bytes, mime_type), or (None, None) when the image can be sent unchanged
+Parameters:
+    - image_bytes: encoded image uploaded by user
+    - max_dimension: largest allowed width or height in pixels
+    - output_format: "JPEG" or "WEBP"
+    - quality: encoder quality (1-100)
+"""
+def preprocess_image_bytes(image_bytes, max_dimension, output_format, quality):
+    with PIL.Image.open(io.BytesIO(image_bytes)) as image:
+        orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        oversized = max(image.size) > max_dimension
+
+        # Leave images that are already small and upright untouched
+        if not oversized and orientation == 1:
+            return None, None
+
+        # Ask the JPEG decoder to decode at a reduced scale when it can (much cheaper than a full decode)
+        if oversized and image.format == "JPEG":
+            image.draft("RGB", (max_dimension, max_dimension))
+
+        # Rotate pixels according to the EXIF orientation, then bound the longest side
+        image = PIL.ImageOps.exif_transpose(image)
+        if image.mode.startswith("I"):
+            image = scale_to_8_bit(image)
+        image.thumbnail((max_dimension, max_dimension), PIL.Image.Resampling.LANCZOS)
+
+        # Flatten transparency onto white since JPEG has no alpha channel
+        if output_format == "JPEG" and image.mode != "RGB":
+            if image.mode in ("RGBA", "LA", "PA", "P"):
+                image = flatten_onto_white(image)
+            else:
+                image = image.convert("RGB")
+
+        output = io.BytesIO()
+        if output_format == "JPEG":
+            image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            image.save(output, format=output_format, quality=quality, method=4)
+        return output.getvalue(), PIL.Image.MIME[output_format]
+
+class ImagePreprocessor:
+    """
+    Downscales, re-orients and re-encodes uploads, and fingerprints them, in a process pool shared with the
+    image postprocessor
+    A worker that dies (killed for memory, crashed in a decoder) breaks the whole pool: it is then replaced
+    and the task retried once. Until a task succeeds again, readiness runs a trivial task to check the new pool
+    """
+    def __init__(self):
+        self.max_dimension = int(os.environ.get("IMAGE_MAX_DIMENSION", "1536"))
+        self.output_format = os.environ.get("IMAGE_REENCODE_FORMAT", "JPEG").upper()
+        self.quality = int(os.environ.get("IMAGE_REENCODE_QUALITY", "85"))
+        self.process_pool_size = int(os.environ.get("IMAGE_PROCESS_POOL_SIZE", str(os.cpu_count() or 1)))
+        # Worker processes are started lazily, after the model clients have started threads and gRPC channels,
+        # so they come from a fork server (or are spawned) instead of forking this process
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.process_context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            self.process_context.set_forkserver_preload(["app.classes.ImagePreprocessor", "app.classes.ImagePostprocessor"])
+        self.process_executor = ProcessPoolExecutor(max_workers=self.process_pool_size, mp_context=self.process_context)
+        self.process_pool_restarts = 0
+        self.process_pool_failures = 0
+
+        # Running totals of bytes received from clients and bytes sent to the models
+        self.images_processed = 0
+        self.original_bytes_total = 0
+        self.sent_bytes_total = 0
+
+    """
+    Function to replace a broken process pool (once, whoever notices it first)
+    Parameters:
+        - executor: pool that raised BrokenProcessPool
+    """
+    def replace_broken_executor(self, executor):
+        if executor is not self.process_executor:
+            return
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.process_executor = ProcessPoolExecutor(max_workers=self.process_pool_size, mp_context=self.process_context)
+        self.process_pool_restarts += 1
+        self.process_pool_failures += 1
+
+    """
+    Function to run a function in the process pool, replacing the pool and retrying once when it is broken
+    Parameters:
+        - function: picklable module-level function
+        - args: picklable arguments
+    """
+    async def run_in_process(self, function, *args):
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self.process_executor
+            try:
+                result = await loop.run_in_executor(executor, function, *args)
+            except BrokenProcessPool:
+                self.replace_broken_executor(executor)
+                if attempt == 1:
+                    raise
+                continue
+            self.process_pool_failures = 0
+            return result
+
+    """
+    Function to check whether the process pool works
+    When the pool broke since the last successful task, a trivial task is run (replacing the pool if needed)
+    Parameters:
+        - timeout_seconds: how long the trivial task may take, including starting a worker
+    """
+    async def check_process_pool(self, timeout_seconds=10):
+        if self.process_pool_failures == 0 and not getattr(self.process_executor, "_broken", False):
+            return True
+        try:
+            await asyncio.wait_for(self.run_in_process(os.getpid), timeout_seconds)
+        except (BrokenProcessPool, asyncio.TimeoutError):
+            return False
+        return True
+
+    """
+    Function to preprocess an uploaded image in the process pool, off the event loop
+    Returns a dict with the bytes to send upstream, their mime type and the original/sent byte counts
+    Parameters:
+        - image_bytes: validated image bytes
+        - mime_type: sniffed mime type of the upload
+        - output_format: optional override of the configured re-encoding format
+    """
+    async def preprocess(self, image_bytes, mime_type, output_format=None):
+        processed_bytes, processed_mime_type = await self.run_in_process(
+            preprocess_image_bytes,
+            image_bytes,
+            self.max_dimension,
+            output_format or self.output_format,
+            self.quality,
+        )
+
+        # Send the original bytes when no resize or rotation was needed
+        if processed_bytes is None:
+            processed_bytes = image_bytes
+            processed_mime_type = mime_type
+
+        self.images_processed += 1
+        self.original_bytes_total += len(image_bytes)
+        self.sent_bytes_total += len(processed_bytes)
+
+        return {
+            "image_bytes": processed_bytes,
+            "mime_type": processed_mime_type,
+            "original_bytes": len(image_bytes),
+            "sent_bytes": len(processed_bytes),
+        }
+
+    """
+    Function to compute the perceptual fingerprint of an uploaded image in the process pool (see compute_perceptual_fingerprint)
+    Parameters:
+        - image_bytes: validated image bytes
+        - min_stddev: smallest standard deviation of the hashed grey levels of an image that is fingerprinted
+        - min_bits: smallest number of set (and of unset) bits of a hash that is kept
+    """
+    async def fingerprint(self, image_bytes, min_stddev, min_bits):
+        return await self.run_in_process(compute_perceptual_fingerprint, image_bytes, min_stddev, min_bits)
+
+    """
+    Function to report the cumulative byte savings of the preprocessing stage
+    """
+    def stats(self):
+        return {
+            "images_processed": self.images_processed,
+            "original_bytes_total": self.original_bytes_total,
+            "sent_bytes_total": self.sent_bytes_total,
+            "process_pool_restarts": self.process_pool_restarts,
+            "process_pool_failures": self.process_pool_failures,
+        }
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+import math
+import os
+import threading
+from .ResponseCache import ResponseCache, response_cache_from_env
+
+class ImageResultCache:
+    """
+    Cache of model results for uploaded images, keyed by the SHA-256 of the image bytes
+    When perceptual hashing is enabled, a bounded index maps perceptual fingerprints to the SHA-256 of
+    images already seen, so re-encoded or slightly resized copies resolve to the same cached results
+    A near-duplicate must also have the same aspect ratio, size class and mean colour, and near-constant images
+    are never fingerprinted (see compute_perceptual_fingerprint)
+    """
+    def __init__(self):
+        self.results = response_cache_from_env("image_results", "IMAGE_CACHE")
+        self.perceptual_hash_enabled = os.environ.get("IMAGE_CACHE_PERCEPTUAL_HASH", "false").lower() == "true"
+        self.perceptual_hash_max_distance = int(os.environ.get("IMAGE_CACHE_PERCEPTUAL_HASH_MAX_DISTANCE", "4"))
+        self.perceptual_hash_min_stddev = float(os.environ.get("IMAGE_CACHE_PERCEPTUAL_HASH_MIN_STDDEV", "8"))
+        self.perceptual_hash_min_bits = int(os.environ.get("IMAGE_CACHE_PERCEPTUAL_HASH_MIN_BITS", "8"))
+        self.perceptual_hash_max_aspect_difference = float(os.environ.get("IMAGE_CACHE_PERCEPTUAL_HASH_MAX_ASPECT_DIFFERENCE", "0.02"))
+        self.perceptual_hash_max_colour_difference = int(os.environ.get("IMAGE_CACHE_PERCEPTUAL_HASH_MAX_COLOUR_DIFFERENCE", "16"))
+        self.perceptual_index_max_entries = self.results.max_entries
+        self.perceptual_index = OrderedDict()
+        self.lock = threading.Lock()
+        self.perceptual_hits = 0
+
+    """
+    Function to build the cache key of a result for an image
+    Parameters:
+        - operation: name of the model operation (e.g. "captions")
+        - image_sha256: SHA-256 hex digest of the image bytes
+        - parts: remaining values the result depends on (model name, prompt, ...)
+    """
+    def make_key(self, operation, image_sha256, *parts):
+        return ResponseCache.make_key(operation, image_sha256, *parts)
+
+    """
+    Function to look up a cached result, returning None on a miss
+    Parameters:
+        - key: cache key built with make_key
+    """
+    def get(self, key):
+        return self.results.get(key)
+
+    """
+    Function to store a result for an image
+    Parameters:
+        - key: cache key built with make_key
+        - value: JSON-serialisable result
+        - image_sha256: SHA-256 hex digest of the image bytes
+        - fingerprint: perceptual fingerprint of the image, if computed
+    """
+    def set(self, key, value, image_sha256, fingerprint=None):
+        self.results.set(key, value)
+        if fingerprint is not None:
+            with self.lock:
+                self.perceptual_index[fingerprint["hash"]] = (image_sha256, fingerprint)
+                self.perceptual_index.move_to_end(fingerprint["hash"])
+                while len(self.perceptual_index) > self.perceptual_index_max_entries:
+                    self.perceptual_index.popitem(last=False)
+
+    """
+    Function to check whether two fingerprints with close hashes can be the same picture
+    Parameters:
+        - known, candidate: fingerprints returned by compute_perceptual_fingerprint
+    """
+    def same_picture(self, known, candidate):
+        if known["size_class"] != candidate["size_class"]:
+            return False
+        if abs(math.log(known["aspect_ratio"] / candidate["aspect_ratio"])) > self.perceptual_hash_max_aspect_difference:
+            return False
+        return all(
+            abs(known_channel - candidate_channel) <= self.perceptual_hash_max_colour_difference
+            for known_channel, candidate_channel in zip(known["mean_colour"], candidate["mean_colour"])
+        )
+
+    """
+    Function to find a previously seen image whose fingerprint is close to the given one
+    Returns the SHA-256 of the most similar image, or None
+    Parameters:
+        - fingerprint: perceptual fingerprint of the new image
+    """
+    def find_similar_image(self, fingerprint):
+        best_sha256 = None
+        best_distance = self.perceptual_hash_max_distance + 1
+        with self.lock:
+            for known_hash, (image_sha256, known_fingerprint) in self.perceptual_index.items():
+                distance = (known_hash ^ fingerprint["hash"]).bit_count()
+                if distance < best_distance and self.same_picture(known_fingerprint, fingerprint):
+                    best_sha256 = image_sha256
+                    best_distance = distance
+                    if distance == 0:
+                        break
+        return best_sha256
+
+    """
+    Function to look up a cached result for a similar image
+    Parameters:
+        - fingerprint: perceptual fingerprint of the new image (None when it has none)
+        - operation, parts: same values passed to make_key for the new image
+    """
+    def get_similar(self, fingerprint, operation, *parts):
+        if fingerprint is None:
+            return None
+        similar_sha256 = self.find_similar_image(fingerprint)
+        if similar_sha256 is None:
+            return None
+        value = self.results.get(self.make_key(operation, similar_sha256, *parts))
+        if value is not None:
+            with self.lock:
+                self.perceptual_hits += 1
+        return value
+
+    """
+    Function to report cache size and hit/miss counters
+    """
+    def stats(self):
+        stats = self.results.stats()
+        with self.lock:
+            stats["perceptual_hash_enabled"] = self.perceptual_hash_enabled
+            stats["perceptual_index_entries"] = len(self.perceptual_index)
+            stats["perceptual_hits"] = self.perceptual_hits
+        return stats
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import struct
+import time
+from .RequestTiming import record_stage
+
+# Magic bytes used to sniff the real image format regardless of the client supplied content type
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+
+# JPEG start of frame markers carry the image dimensions (SOF0-SOF15 excluding DHT, JPG and DAC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+class ImageValidator:
+    def __init__(self):
+        self.max_image_bytes = int(os.environ.get("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+        self.max_image_pixels = int(os.environ.get("MAX_IMAGE_PIXELS", "50000000"))
+        self.chunk_size = int(os.environ.get("IMAGE_READ_CHUNK_SIZE", str(64 * 1024)))
+        # Largest prefix scanned for the JPEG frame header (EXIF blocks and thumbnails come before it)
+        self.max_header_bytes = int(os.environ.get("MAX_IMAGE_HEADER_BYTES", str(512 * 1024)))
+
+    """
+    Function to identify an image format from its leading bytes
+    Parameters:
+        - header: first bytes of the uploaded file
+    """
+    def sniff_format(self, header):
+        if header.startswith(PNG_SIGNATURE):
+            return "png"
+        if header.startswith(JPEG_SIGNATURE):
+            return "jpeg"
+        return None
+
+    """
+    Function to read image dimensions from the header only, without decoding any pixel data
+    Returns (width, height), or None if more bytes are needed
+    Parameters:
+        - data: bytes received so far
+        - image_format: sniffed image format ("png" or "jpeg")
+    """
+    def read_dimensions(self, data, image_format):
+        if image_format == "png":
+            # IHDR is always the first chunk: signature(8) + length(4) + type(4) + width(4) + height(4)
+            if len(data) < 24:
+                return None
+            if data[12:16] != b"IHDR":
+                raise ValueError("Invalid PNG header.")
+            width, height = struct.unpack(">II", data[16:24])
+            return width, height
+
+        # Walk the JPEG marker segments until a start of frame marker is reached
+        offset = 2
+        while offset + 4 <= len(data):
+            if data[offset] != 0xFF:
+                raise ValueError("Invalid JPEG header.")
+            marker = data[offset + 1]
+            # Skip fill bytes and standalone markers that have no length field
+            if marker == 0xFF:
+                offset += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                offset += 2
+                continue
+            segment_length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+            if marker in JPEG_SOF_MARKERS:
+                if offset + 9 > len(data):
+                    return None
+                height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+                return width, height
+            if marker == 0xDA:
+                raise ValueError("Invalid JPEG header.")
+            offset += 2 + segment_length
+        return None
+
+    """
+    Function to check the leading bytes of an upload: format, header and pixel count
+    Returns ((image_format, (width, height)), None) once the header is complete, (None, warning) when the upload
+    must be rejected and (None, None) while more bytes are needed
+    Parameters:
+        - data: bytes received so far
+    """
+    def check_header(self, data):
+        if len(data) < len(PNG_SIGNATURE):
+            return None, None
+        image_format = self.sniff_format(bytes(data[:len(PNG_SIGNATURE)]))
+        if image_format is None:
+            return None, "Only images with extensions jpeg, jpg and png are allowed."
+        try:
+            dimensions = self.read_dimensions(data, image_format)
+        except ValueError:
+            return None, "The uploaded file is not a valid jpeg or png image."
+        if dimensions is None:
+            if len(data) > self.max_header_bytes:
+                return None, "The uploaded file is not a valid jpeg or png image."
+            return None, None
+        if dimensions[0] * dimensions[1] > self.max_image_pixels:
+            return None, "Image resolution is too large. Choose an image with fewer pixels."
+        return (image_format, dimensions), None
+
+    """
+    Function to read and validate an uploaded image incrementally
+    The read is aborted as soon as the content is found not to be a JPEG/PNG, the header reports
+    too many pixels or the byte cap is exceeded (UploadSizeLimitMiddleware makes the same checks on the request
+    stream, before the body is spooled, for the upload endpoints)
+    A SHA-256 of the content is computed as the chunks arrive for use as a cache key
+    Parameters:
+        - image: File uploaded by user
+    """
+    async def read_upload(self, image):
+        started_at = time.perf_counter()
+        read_seconds = 0.0
+        try:
+            buffer = bytearray()
+            hasher = hashlib.sha256()
+            image_format = None
+            dimensions = None
+
+            while True:
+                read_started_at = time.perf_counter()
+                chunk = await image.read(self.chunk_size)
+                read_seconds += time.perf_counter() - read_started_at
+                if not chunk:
+                    break
+                buffer += chunk
+                hasher.update(chunk)
+
+                # Check the magic bytes and parse the dimensions from the header before the rest of the body is read
+                if dimensions is None:
+                    header, warning = self.check_header(buffer)
+                    if warning is not None:
+                        return {
+                            "warnings": [warning]
+                        }
+                    if header is not None:
+                        image_format, dimensions = header
+
+                # Abort the read once the byte cap is exceeded
+                if len(buffer) > self.max_image_bytes:
+                    return {
+                        "warnings": [f"File size is too large. Choose a file of a size lower than {self.max_image_bytes // (1024 * 1024)} MB."]
+                    }
+
+            if image_format is None or dimensions is None:
+                return {
+                    "warnings": ["The uploaded file is not a valid jpeg or png image."]
+                }
+
+            return {
+                "image_bytes": bytes(buffer),
+                "mime_type": f"image/{image_format}",
+                "sha256": hasher.hexdigest(),
+                "width": dimensions[0],
+                "height": dimensions[1],
+            }
+        finally:
+            # Split the time between receiving the upload and validating it
+            record_stage("upload_read", read_seconds)
+            record_stage("validation", time.perf_counter() - started_at - read_seconds)
@@ -0,0 +1,128 @@
+import asyncio
+from contextlib import contextmanager
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Histogram buckets in seconds: requests range from cached answers to image generation,
+# stages from header parsing to model calls
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class PipelineCollector:
+    """
+    Prometheus collector reading the admission, resilience and cache counters of the content generator at scrape time
+    """
+    def __init__(self, admission, resilience, caches):
+        self.admission = admission
+        self.resilience = resilience
+        self.caches = caches
+
+    def collect(self):
+        active = GaugeMetricFamily("model_admission_active", "Model calls holding an admission slot", labels=["model"])
+        queue_depth = GaugeMetricFamily("model_admission_queue_depth", "Requests waiting for an admission slot", labels=["model"])
+        rejected = CounterMetricFamily("model_admission_rejected", "Requests rejected because the wait queue was full", labels=["model"])
+        timed_out = CounterMetricFamily("model_admission_timed_out", "Requests whose deadline passed while queued", labels=["model"])
+        for model_name, stats in self.admission.stats().items():
+            active.add_metric([model_name], stats["active"])
+            queue_depth.add_metric([model_name], stats["queue_depth"])
+            rejected.add_metric([model_name], stats["rejected"])
+            timed_out.add_metric([model_name], stats["timed_out"])
+        yield from (active, queue_depth, rejected, timed_out)
+
+        circuit_open = GaugeMetricFamily("model_circuit_open", "Whether the model's circuit breaker is open (1) or not (0)", labels=["model"])
+        retries = CounterMetricFamily("model_upstream_retries", "Retried upstream model calls", labels=["model"])
+        short_circuited = CounterMetricFamily("model_upstream_short_circuited", "Calls failed fast by an open circuit", labels=["model"])
+        for model_name, stats in self.resilience.stats().items():
+            circuit_open.add_metric([model_name], 1 if stats["circuit_state"] == "open" else 0)
+            retries.add_metric([model_name], stats["retries"])
+            short_circuited.add_metric([model_name], stats["short_circuited"])
+        yield from (circuit_open, retries, short_circuited)
+
+        hits = CounterMetricFamily("cache_hits", "Cache lookups answered from the cache", labels=["cache"])
+        misses = CounterMetricFamily("cache_misses", "Cache lookups that missed", labels=["cache"])
+        entries = GaugeMetricFamily("cache_entries", "Entries held in memory", labels=["cache"])
+        for cache_name, cache in self.caches.items():
+            stats = cache.stats()
+            hits.add_metric([cache_name], stats["hits"] + stats["disk_hits"])
+            misses.add_metric([cache_name], stats["misses"])
+            entries.add_metric([cache_name], stats["entries"])
+        yield from (hits, misses, entries)
+
+class Metrics:
+    """
+    Prometheus metrics of the API, kept in a registry of their own and exposed by GET /metrics
+    """
+    def __init__(self, admission, resilience, caches):
+        self.registry = CollectorRegistry()
+        self.requests = Counter(
+            "http_requests",
+            "Handled HTTP requests",
+            ["endpoint", "method", "status", "outcome"],
+            registry=self.registry,
+        )
+        self.request_seconds = Histogram(
+            "http_request_duration_seconds",
+            "Time to handle an HTTP request, including streaming the response",
+            ["endpoint", "outcome"],
+            buckets=REQUEST_BUCKETS,
+            registry=self.registry,
+        )
+        self.stage_seconds = Histogram(
+            "request_stage_duration_seconds",
+            "Time spent in each stage of a request (upload_read, validation, preprocess, screen, model, postprocess, encode)",
+            ["endpoint", "stage"],
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.upstream_seconds = Histogram(
+            "model_upstream_duration_seconds",
+            "Duration of one upstream model call attempt, excluding the admission wait",
+            ["model", "outcome"],
+            buckets=REQUEST_BUCKETS,
+            registry=self.registry,
+        )
+        self.registry.register(PipelineCollector(admission, resilience, caches))
+
+    """
+    Function to record a finished request and its stages
+    Parameters:
+        - endpoint: route path template (e.g. /images/{image_id})
+        - method: HTTP method
+        - status: HTTP status code
+        - timing: RequestTiming of the request
+        - seconds: time to handle the request
+    """
+    def observe_request(self, endpoint, method, status, timing, seconds):
+        self.requests.labels(endpoint, method, str(status), timing.outcome).inc()
+        self.request_seconds.labels(endpoint, timing.outcome).observe(seconds)
+        for stage_name, stage_seconds in timing.stages.items():
+            self.stage_seconds.labels(endpoint, stage_name).observe(stage_seconds)
+
+    """
+    Function to time one upstream model call attempt
+    Parameters:
+        - model_name: name of the model handle
+    """
+    @contextmanager
+    def time_upstream(self, model_name):
+        started_at = time.perf_counter()
+        outcome = "success"
+        try:
+            yield
+        # Attempts cancelled by a timeout, a hedge or a disconnected client are told apart from failures
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome = "cancelled"
+            raise
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            self.upstream_seconds.labels(model_name, outcome).observe(time.perf_counter() - started_at)
+
+    """
+    Function to render the metrics in the Prometheus text format
+    Returns the body and its content type
+    """
+    def render(self):
+        return generate_latest(self.registry), CONTENT_TYPE_LATEST
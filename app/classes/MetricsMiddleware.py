@@ -0,0 +1,45 @@
+import time
+from .RequestTiming import RequestTiming, current_request_timing
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every request, adds a Server-Timing header with the stages recorded so far,
+    records the request in the Prometheus metrics and optionally profiles it
+    The endpoint label is the route path template, so ids in paths do not create new series
+    """
+    def __init__(self, app, metrics, profiler):
+        self.app = app
+        self.metrics = metrics
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = current_request_timing.set(timing)
+        state = {"status": 500}
+
+        # Add the stage timings to the response headers (streams only include the stages before the first byte)
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        profile = self.profiler.start(scope)
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            seconds = time.perf_counter() - timing.started_at
+            route = scope.get("route")
+            endpoint = getattr(route, "path", "unmatched")
+            if timing.outcome is None:
+                timing.outcome = "response" if state["status"] < 400 else "error"
+            if profile is not None:
+                self.profiler.stop(profile, endpoint, seconds)
+            self.metrics.observe_request(endpoint, scope["method"], state["status"], timing, seconds)
+            current_request_timing.reset(token)
@@ -0,0 +1,130 @@
+class ModelBackend:
+    """
+    Interface of the model capabilities used by ContentGenerator
+    Models are named after their handles in the admission and resilience layers:
+        - vertex_text_model, vertex_pro_vision_model: text generation (generate_text / stream_text)
+        - gemini_model, vertex_pro_vision_model: text generation about an image (generate_text_from_image / stream_text_from_image)
+        - vertex_image_captioning_model: image captioning (get_captions)
+        - vertex_image_generation_model: image generation (generate_images)
+    """
+
+    # Models able to generate text from a text-only prompt and from a prompt with an image
+    text_models = ("vertex_text_model", "vertex_pro_vision_model")
+    image_text_models = ("gemini_model", "vertex_pro_vision_model")
+
+    """
+    Function to generate text for a prompt and return the text parts of the response
+    Parameters:
+        - prompt: complete prompt sent to the model
+        - generation_config: generation settings (None uses the model defaults)
+        - model_name: one of text_models
+    """
+    async def generate_text(self, prompt, generation_config=None, model_name="vertex_pro_vision_model"):
+        raise NotImplementedError
+
+    """
+    Function to generate text for a prompt and yield text chunks as they are produced
+    Parameters:
+        - prompt: complete prompt sent to the model
+        - generation_config: generation settings (None uses the model defaults)
+        - model_name: one of text_models
+    """
+    def stream_text(self, prompt, generation_config=None, model_name="vertex_pro_vision_model"):
+        raise NotImplementedError
+
+    """
+    Function to generate text about an image and return the text parts of the response
+    Parameters:
+        - prompt: complete prompt sent to the model
+        - image_bytes: encoded image
+        - mime_type: mime type of the image
+        - model_name: one of image_text_models
+    """
+    async def generate_text_from_image(self, prompt, image_bytes, mime_type, model_name="gemini_model"):
+        raise NotImplementedError
+
+    """
+    Function to generate text about an image and yield text chunks as they are produced
+    Parameters:
+        - prompt: complete prompt sent to the model
+        - image_bytes: encoded image
+        - mime_type: mime type of the image
+        - model_name: one of image_text_models
+    """
+    def stream_text_from_image(self, prompt, image_bytes, mime_type, model_name="gemini_model"):
+        raise NotImplementedError
+
+    """
+    Function to count the tokens of a prompt
+    Parameters:
+        - prompt: complete prompt sent to the model
+        - model_name: model whose tokenizer is used
+    """
+    async def count_tokens(self, prompt, model_name):
+        raise NotImplementedError
+
+    """
+    Function to return captions for an image
+    Parameters:
+        - image_bytes: encoded JPEG or PNG image
+        - number_of_results: number of captions
+        - language: caption language
+    """
+    async def get_captions(self, image_bytes, number_of_results, language):
+        raise NotImplementedError
+
+    """
+    Function to generate images for a prompt and return their PNG bytes
+    Parameters:
+        - prompt: complete prompt sent to the model
+        - number_of_images: number of images to generate
+        - aspect_ratio: image aspect ratio (e.g. "1:1")
+        - safety_filter_level: safety filter setting
+        - person_generation: person generation setting
+    """
+    async def generate_images(self, prompt, number_of_images, aspect_ratio, safety_filter_level, person_generation):
+        raise NotImplementedError
+
+    """
+    Function to prepare the backend before traffic arrives
+    """
+    async def warm_up(self):
+        pass
+
+    """
+    Function to retry the model loads that failed, in the background, until cancelled
+    """
+    async def retry_failed_loads(self):
+        pass
+
+    """
+    Function to report which models are ready
+    """
+    def model_status(self):
+        return {}
+
+    """
+    Function to size the upstream connection pools from the admission limits
+    Parameters:
+        - max_concurrency: dict of model handle name to the calls it may have in flight
+    """
+    def size_connection_pools(self, max_concurrency):
+        pass
+
+    """
+    Function to report backend counters
+    """
+    def stats(self):
+        return {}
+
+    """
+    Function to release the backend's resources
+    """
+    def shutdown(self):
+        pass
+
+    """
+    Function to release the backend's resources that belong to the event loop (e.g. async connections)
+    """
+    async def close(self):
+        pass
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+import time
+
+class ModelHandle:
+    """
+    Lazily loaded handle to a model client
+    The loader runs once, on first use or from a background warm-up, and the handle reports whether
+    the model is ready so a failed load (e.g. bad credentials) only affects the endpoints that need it
+    """
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.model = None
+        self.error = None
+        self.load_seconds = None
+        self.lock = threading.Lock()
+
+    """
+    Function to return the model, loading it first if needed (blocking)
+    A failed load is retried on the next call
+    """
+    def get(self):
+        if self.model is not None:
+            return self.model
+        with self.lock:
+            if self.model is None:
+                started_at = time.perf_counter()
+                try:
+                    self.model = self.loader()
+                    self.error = None
+                except Exception as error:
+                    self.error = str(error)
+                    raise
+                finally:
+                    self.load_seconds = time.perf_counter() - started_at
+        return self.model
+
+    """
+    Function to return the model from async code, loading it in the given executor if needed
+    Parameters:
+        - executor: executor used to run the blocking load
+    """
+    async def get_async(self, executor):
+        if self.model is not None:
+            return self.model
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.get)
+
+    """
+    Function to report whether the model is loaded
+    """
+    def status(self):
+        return {
+            "ready": self.model is not None,
+            "error": self.error,
+            "load_seconds": self.load_seconds,
+        }
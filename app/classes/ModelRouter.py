@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from .ResponseCache import ResponseCache
+
+class ModelRouteStats:
+    """
+    Exponentially weighted latency and error rate of the calls routed to one model
+    When a model gets no call for quiet_seconds (e.g. after being demoted), its averages are forgotten rather than
+    trusted: the model counts as unknown again, and the next recent_calls samples decide whether it is demoted
+    """
+    def __init__(self, alpha, quiet_seconds):
+        self.alpha = alpha
+        self.quiet_seconds = quiet_seconds
+        self.latency_seconds = None
+        self.error_rate = 0.0
+        self.recent_calls = 0
+        self.calls = 0
+        self.failures = 0
+        self.sampled_at = time.monotonic()
+
+    """
+    Function to forget the averages when the last call is older than quiet_seconds
+    """
+    def forget_if_quiet(self):
+        if self.quiet_seconds > 0 and self.recent_calls and time.monotonic() - self.sampled_at > self.quiet_seconds:
+            self.latency_seconds = None
+            self.error_rate = 0.0
+            self.recent_calls = 0
+
+    """
+    Function to record the outcome of a call
+    Parameters:
+        - seconds: duration of the call, retries included
+        - success: whether the call returned a result
+    """
+    def record(self, seconds, success):
+        self.forget_if_quiet()
+        self.sampled_at = time.monotonic()
+        self.recent_calls += 1
+        self.calls += 1
+        if not success:
+            self.failures += 1
+        self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha * (0.0 if success else 1.0)
+        if success:
+            if self.latency_seconds is None:
+                self.latency_seconds = seconds
+            else:
+                self.latency_seconds = (1 - self.alpha) * self.latency_seconds + self.alpha * seconds
+
+class ModelRouter:
+    """
+    Picks the models a text generation request is sent to, in order of preference, from:
+        - the modality: text-only prompts go to the text candidates, prompts with an image to the vision candidates
+        - the content type: a content type can be pinned to a preferred model
+        - the prompt length: models whose input limit the prompt exceeds are skipped (estimated from the length,
+          counted by the model's tokenizer near the limit, with counts cached)
+        - live stats: models with an open circuit, a high error rate or a slow average latency are moved last,
+          until they get no call for a while and their averages are forgotten (see ModelRouteStats)
+    The later models in the list are the fallbacks when the preferred one is saturated or failing
+    Configured from environment variables:
+    ROUTING_TEXT_CANDIDATES, ROUTING_IMAGE_CANDIDATES, ROUTING_CONTENT_TYPE_MODELS, ROUTING_<MODEL>_MAX_INPUT_TOKENS,
+    ROUTING_SLOW_SECONDS, ROUTING_MAX_ERROR_RATE, ROUTING_MIN_CALLS, ROUTING_EWMA_ALPHA and ROUTING_STATS_QUIET_SECONDS
+    """
+    def __init__(self, backend, resilience, token_count_cache, max_input_tokens):
+        self.backend = backend
+        self.resilience = resilience
+        self.token_count_cache = token_count_cache
+        self.candidates = {
+            "text": self.read_candidates("ROUTING_TEXT_CANDIDATES", "vertex_text_model,vertex_pro_vision_model", backend.text_models),
+            "image": self.read_candidates("ROUTING_IMAGE_CANDIDATES", "gemini_model,vertex_pro_vision_model", backend.image_text_models),
+        }
+
+        # Content type keys pinned to a model, e.g. "3=vertex_pro_vision_model"
+        self.content_type_models = {}
+        for rule in os.environ.get("ROUTING_CONTENT_TYPE_MODELS", "").split(","):
+            if "=" in rule:
+                content_type, model_name = rule.split("=", 1)
+                self.content_type_models[content_type.strip()] = model_name.strip()
+
+        self.max_input_tokens = {
+            model_name: int(os.environ.get(f"ROUTING_{model_name.upper()}_MAX_INPUT_TOKENS", str(limit)))
+            for model_name, limit in max_input_tokens.items()
+        }
+        self.slow_seconds = float(os.environ.get("ROUTING_SLOW_SECONDS", "20"))
+        self.max_error_rate = float(os.environ.get("ROUTING_MAX_ERROR_RATE", "0.5"))
+        self.min_calls = int(os.environ.get("ROUTING_MIN_CALLS", "5"))
+        alpha = float(os.environ.get("ROUTING_EWMA_ALPHA", "0.2"))
+        quiet_seconds = float(os.environ.get("ROUTING_STATS_QUIET_SECONDS", "60"))
+        self.route_stats = {model_name: ModelRouteStats(alpha, quiet_seconds) for model_name in self.max_input_tokens}
+        self.lock = threading.Lock()
+
+        # Counters
+        self.routed = {model_name: 0 for model_name in self.max_input_tokens}
+        self.fallbacks = 0
+        self.token_counts = 0
+
+    """
+    Function to read an ordered list of candidate models from an environment variable
+    Parameters:
+        - name: environment variable
+        - default: comma-separated default
+        - allowed: models able to serve the modality
+    """
+    def read_candidates(self, name, default, allowed):
+        candidates = [model_name.strip() for model_name in os.environ.get(name, default).split(",") if model_name.strip()]
+        unknown = [model_name for model_name in candidates if model_name not in allowed]
+        if unknown or not candidates:
+            raise ValueError(f"{name} must list models among {', '.join(allowed)}")
+        return candidates
+
+    """
+    Function to get the number of tokens of a prompt
+    The length based estimate is used unless the prompt is close to the smallest input limit, in which case
+    the tokens are counted by the model (cached by prompt, since the Gemini models share a tokenizer)
+    Parameters:
+        - prompt: complete prompt sent to the model
+        - model_name: model used to count the tokens
+    """
+    async def prompt_tokens(self, prompt, model_name):
+        estimate = len(prompt) // 4
+        if estimate < 0.8 * min(self.max_input_tokens.values()):
+            return estimate
+
+        cache_key = ResponseCache.make_key("count_tokens", prompt)
+        cached_count = self.token_count_cache.get(cache_key)
+        if cached_count is not None:
+            return cached_count
+        try:
+            count = await self.backend.count_tokens(prompt, model_name)
+        except Exception:
+            return estimate
+        self.token_counts += 1
+        self.token_count_cache.set(cache_key, count)
+        return count
+
+    """
+    Function to check whether a model should only be used as a last resort (lock must be held)
+    Parameters:
+        - model_name: name of the model handle
+    """
+    def is_degraded(self, model_name):
+        if self.resilience.callers[model_name].circuit_breaker.state == "open":
+            return True
+        stats = self.route_stats[model_name]
+        stats.forget_if_quiet()
+        if stats.recent_calls < self.min_calls:
+            return False
+        if stats.error_rate > self.max_error_rate:
+            return True
+        return stats.latency_seconds is not None and stats.latency_seconds > self.slow_seconds
+
+    """
+    Function to order the models a request is sent to
+    Parameters:
+        - modality: "text" or "image"
+        - prompt: complete prompt sent to the model
+        - content_type: content type key of the request
+    """
+    async def route(self, modality, prompt, content_type=None):
+        candidates = list(self.candidates[modality])
+
+        # Move the model pinned to the content type first
+        pinned_model = self.content_type_models.get(content_type)
+        if pinned_model in candidates:
+            candidates.remove(pinned_model)
+            candidates.insert(0, pinned_model)
+
+        # Skip models whose input limit the prompt exceeds (keeping the largest one if none fits)
+        tokens = await self.prompt_tokens(prompt, candidates[0])
+        fitting = [model_name for model_name in candidates if tokens <= self.max_input_tokens[model_name]]
+        if not fitting:
+            fitting = [max(candidates, key=lambda model_name: self.max_input_tokens[model_name])]
+
+        # Keep the preference order, but send to slow or failing models only when the others fail too
+        with self.lock:
+            healthy = [model_name for model_name in fitting if not self.is_degraded(model_name)]
+        return healthy + [model_name for model_name in fitting if model_name not in healthy]
+
+    """
+    Function to record the outcome of a routed call
+    Parameters:
+        - model_name: model the call was sent to
+        - seconds: duration of the call
+        - success: whether the call returned a result
+        - fallback: whether the model was not the first choice
+    """
+    def record(self, model_name, seconds, success, fallback=False):
+        with self.lock:
+            self.route_stats[model_name].record(seconds, success)
+            if success:
+                self.routed[model_name] += 1
+            if fallback:
+                self.fallbacks += 1
+
+    """
+    Function to report the routing rules and the live stats of each model
+    """
+    def stats(self):
+        with self.lock:
+            return {
+                "candidates": self.candidates,
+                "content_type_models": self.content_type_models,
+                "fallbacks": self.fallbacks,
+                "token_counts": self.token_counts,
+                "models": {
+                    model_name: {
+                        "degraded": self.is_degraded(model_name),
+                        "routed": self.routed[model_name],
+                        "calls": stats.calls,
+                        "recent_calls": stats.recent_calls,
+                        "failures": stats.failures,
+                        "error_rate": stats.error_rate,
+                        "latency_seconds": stats.latency_seconds,
+                        "max_input_tokens": self.max_input_tokens[model_name],
+                    }
+                    for model_name, stats in self.route_stats.items()
+                },
+            }
@@ -0,0 +1,112 @@
+import cProfile
+import datetime
+import logging
+import os
+import random
+import re
+
+logger = logging.getLogger(__name__)
+
+class RequestProfiler:
+    """
+    Opt-in profiler of single requests, configured from environment variables:
+        - PROFILER_SAMPLE_RATE: share of requests profiled at random (0 disables sampling)
+        - PROFILER_TOKEN: requests sent with an "X-Profile: <token>" header are always profiled (unset disables it)
+        - PROFILER_MIN_SECONDS: profiles of requests faster than this are discarded
+        - PROFILER_OUTPUT_DIR: directory the cProfile files are written to
+        - PROFILER_MAX_FILES: oldest files are removed beyond this count
+    The profiler runs on the event loop thread, so one request is profiled at a time and the profile also
+    contains whatever other requests ran on the loop meanwhile (calls made in thread pools are not included)
+    """
+    def __init__(self):
+        self.sample_rate = float(os.environ.get("PROFILER_SAMPLE_RATE", "0"))
+        self.token = os.environ.get("PROFILER_TOKEN") or None
+        self.min_seconds = float(os.environ.get("PROFILER_MIN_SECONDS", "1"))
+        self.output_dir = os.environ.get("PROFILER_OUTPUT_DIR", "profiles")
+        self.max_files = int(os.environ.get("PROFILER_MAX_FILES", "100"))
+        self.enabled = self.sample_rate > 0 or self.token is not None
+        self.active = False
+
+        # Counters
+        self.profiled = 0
+        self.saved = 0
+
+    """
+    Function to decide whether a request is profiled
+    Parameters:
+        - scope: ASGI scope of the request
+    """
+    def should_profile(self, scope):
+        if not self.enabled or self.active:
+            return False
+        if self.token is not None:
+            for name, value in scope["headers"]:
+                if name == b"x-profile":
+                    return value.decode("latin-1") == self.token
+        return random.random() < self.sample_rate
+
+    """
+    Function to start profiling a request, returning the profile or None when the request is not profiled
+    Parameters:
+        - scope: ASGI scope of the request
+    """
+    def start(self, scope):
+        if not self.should_profile(scope):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (e.g. a debugger) is already attached to the thread
+            return None
+        self.active = True
+        self.profiled += 1
+        return profile
+
+    """
+    Function to stop a profile and write it to the output directory when the request was slow enough
+    Parameters:
+        - profile: profile returned by start
+        - endpoint: route path template of the request
+        - seconds: time taken by the request
+    """
+    def stop(self, profile, endpoint, seconds):
+        profile.disable()
+        self.active = False
+        if seconds < self.min_seconds:
+            return
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            endpoint_name = re.sub(r"[^A-Za-z0-9]+", "-", endpoint).strip("-") or "root"
+            timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+            path = os.path.join(self.output_dir, f"{timestamp}-{endpoint_name}-{int(seconds * 1000)}ms.prof")
+            profile.dump_stats(path)
+            self.saved += 1
+            logger.info("Saved profile of a %.3f s %s request to %s", seconds, endpoint, path)
+            self.remove_old_files()
+        except OSError as error:
+            logger.warning("Could not save request profile: %s", error)
+
+    """
+    Function to keep at most max_files profiles in the output directory
+    """
+    def remove_old_files(self):
+        paths = sorted(
+            os.path.join(self.output_dir, name)
+            for name in os.listdir(self.output_dir)
+            if name.endswith(".prof")
+        )
+        for path in paths[:max(0, len(paths) - self.max_files)]:
+            os.remove(path)
+
+    """
+    Function to report the profiler settings and counters
+    """
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "min_seconds": self.min_seconds,
+            "profiled": self.profiled,
+            "saved": self.saved,
+        }
@@ -0,0 +1,66 @@
+from contextlib import contextmanager
+import contextvars
+import time
+
+# Timing of the request being handled, set by MetricsMiddleware for the duration of each request
+current_request_timing = contextvars.ContextVar("current_request_timing", default=None)
+
+class RequestTiming:
+    """
+    Stage durations and outcome of one request, reported in the Server-Timing header and in /metrics
+    """
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = {}
+        self.outcome = None
+
+    """
+    Function to add time spent in a stage (repeated stages are summed)
+    Parameters:
+        - name: stage name
+        - seconds: time spent
+    """
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    """
+    Function to format the stages as a Server-Timing header value (durations in milliseconds)
+    """
+    def server_timing(self):
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started_at) * 1000:.1f}")
+        return ", ".join(entries)
+
+"""
+Function to add time spent in a stage to the current request, if any
+Parameters:
+    - name: stage name
+    - seconds: time spent
+"""
+def record_stage(name, seconds):
+    timing = current_request_timing.get()
+    if timing is not None:
+        timing.add(name, seconds)
+
+"""
+Function to time a block as a stage of the current request
+Parameters:
+    - name: stage name
+"""
+@contextmanager
+def stage(name):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started_at)
+
+"""
+Function to set the outcome (response, warnings, error or rejected) of the current request
+Parameters:
+    - outcome: outcome label
+"""
+def record_outcome(outcome):
+    timing = current_request_timing.get()
+    if timing is not None:
+        timing.outcome = outcome
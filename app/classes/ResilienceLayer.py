@@ -0,0 +1,273 @@
+import asyncio
+import os
+import random
+import time
+from .AdmissionController import ModelSaturatedError
+
+# HTTP status codes of upstream errors that are worth retrying
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class CircuitOpenError(ModelSaturatedError):
+    """
+    Raised without calling upstream while a model's circuit breaker is open
+    """
+    def __init__(self, model_name, retry_after):
+        super().__init__(model_name, 503, retry_after, f"The {model_name} model is temporarily unavailable. Try again later.")
+
+"""
+Function to decide whether an upstream error is transient and the call can be retried
+Parameters:
+    - error: exception raised by the upstream call
+"""
+def is_retryable_error(error):
+    if isinstance(error, ModelSaturatedError):
+        return False
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    # google.api_core exceptions expose the HTTP status as an integer "code"
+    status_code = getattr(error, "code", None)
+    if not isinstance(status_code, int):
+        status_code = getattr(error, "status_code", None)
+    return isinstance(status_code, int) and status_code in RETRYABLE_STATUS_CODES
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive transient failures and fails fast for reset_seconds,
+    then lets a single trial call through (half open) to decide whether to close again
+    """
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.times_opened = 0
+
+    """
+    Function to check whether a call may go upstream
+    """
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = "half_open"
+            self.trial_in_flight = False
+        if self.state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    """
+    Function to estimate how long until the breaker lets calls through again
+    """
+    def retry_after(self):
+        return max(1, int(self.reset_seconds - (time.monotonic() - self.opened_at)) + 1)
+
+    def record_success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                self.times_opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+    """
+    Function to release a half open trial that ended without a verdict (e.g. a non-transient error)
+    """
+    def record_neutral(self):
+        self.trial_in_flight = False
+
+class ResilientCaller:
+    """
+    Wraps the upstream calls of one model with timeouts, retries with exponential backoff and full jitter,
+    optional hedging and a circuit breaker
+    Timed out attempts are not retried when retry_timeouts is false: for a non-idempotent or expensive call
+    (image generation) the timed out call may still be running upstream, and a retry would pay for it twice
+    """
+    def __init__(self, name, timeout_seconds, max_attempts, base_delay_seconds, max_delay_seconds, hedge_after_seconds, circuit_breaker, retry_timeouts=True):
+        self.name = name
+        self.timeout_seconds = timeout_seconds
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.hedge_after_seconds = hedge_after_seconds
+        self.circuit_breaker = circuit_breaker
+        self.retry_timeouts = retry_timeouts
+
+        # Counters
+        self.calls = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.short_circuited = 0
+        self.failures = 0
+
+    """
+    Function to compute the backoff before a retry (full jitter)
+    Parameters:
+        - attempt: number of the attempt that just failed, starting at 1
+    """
+    def backoff_seconds(self, attempt):
+        return random.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** (attempt - 1)))
+
+    """
+    Function to run one attempt with a timeout
+    Parameters:
+        - function: coroutine function making the upstream call
+    """
+    async def attempt(self, function):
+        try:
+            return await asyncio.wait_for(function(), timeout=self.timeout_seconds)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    """
+    Function to run one attempt, starting a second identical attempt if the first has not finished
+    after hedge_after_seconds; the first successful attempt wins and the other is cancelled
+    Parameters:
+        - function: coroutine function making the upstream call
+    """
+    async def hedged_attempt(self, function):
+        primary = asyncio.ensure_future(self.attempt(function))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_after_seconds)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            return primary.result()
+
+        self.hedges += 1
+        hedge = asyncio.ensure_future(self.attempt(function))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    """
+    Function to fail fast while the circuit is open, for calls that cannot go through call() (e.g. streams)
+    """
+    def check_circuit(self):
+        if self.circuit_breaker.state == "open" and time.monotonic() - self.circuit_breaker.opened_at < self.circuit_breaker.reset_seconds:
+            self.short_circuited += 1
+            raise CircuitOpenError(self.name, self.circuit_breaker.retry_after())
+
+    """
+    Function to call upstream through the resilience layer
+    Parameters:
+        - function: coroutine function with no arguments making the upstream call
+        - hedge: whether to hedge slow attempts (only for idempotent calls)
+    """
+    async def call(self, function, hedge=False):
+        self.calls += 1
+        attempt_number = 0
+        while True:
+            attempt_number += 1
+            if not self.circuit_breaker.allow():
+                self.short_circuited += 1
+                raise CircuitOpenError(self.name, self.circuit_breaker.retry_after())
+            try:
+                if hedge and self.hedge_after_seconds > 0:
+                    result = await self.hedged_attempt(function)
+                else:
+                    result = await self.attempt(function)
+            except Exception as error:
+                if not is_retryable_error(error):
+                    self.circuit_breaker.record_neutral()
+                    raise
+                self.failures += 1
+                self.circuit_breaker.record_failure()
+                if attempt_number >= self.max_attempts:
+                    raise
+                if isinstance(error, asyncio.TimeoutError) and not self.retry_timeouts:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(self.backoff_seconds(attempt_number))
+                continue
+            except BaseException:
+                # Cancelled (client disconnect, lost hedge, outer timeout): no verdict, but free a half open trial
+                # so the breaker does not wait forever for its result
+                self.circuit_breaker.record_neutral()
+                raise
+            self.circuit_breaker.record_success()
+            return result
+
+    """
+    Function to report the breaker state and counters
+    """
+    def stats(self):
+        return {
+            "circuit_state": self.circuit_breaker.state,
+            "circuit_times_opened": self.circuit_breaker.times_opened,
+            "calls": self.calls,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "short_circuited": self.short_circuited,
+        }
+
+class ResilienceLayer:
+    """
+    Per-model resilient callers configured from environment variables:
+    RESILIENCE_<MODEL>_TIMEOUT_SECONDS, RESILIENCE_<MODEL>_MAX_ATTEMPTS, RESILIENCE_<MODEL>_HEDGE_AFTER_SECONDS,
+    RESILIENCE_<MODEL>_RETRY_TIMEOUTS, RESILIENCE_BASE_DELAY_SECONDS, RESILIENCE_MAX_DELAY_SECONDS, RESILIENCE_BREAKER_FAILURE_THRESHOLD
+    and RESILIENCE_BREAKER_RESET_SECONDS
+    """
+    def __init__(self, timeouts, no_timeout_retry_models=()):
+        base_delay_seconds = float(os.environ.get("RESILIENCE_BASE_DELAY_SECONDS", "0.5"))
+        max_delay_seconds = float(os.environ.get("RESILIENCE_MAX_DELAY_SECONDS", "8"))
+        failure_threshold = int(os.environ.get("RESILIENCE_BREAKER_FAILURE_THRESHOLD", "5"))
+        reset_seconds = float(os.environ.get("RESILIENCE_BREAKER_RESET_SECONDS", "30"))
+        self.callers = {}
+        for model_name, timeout_seconds in timeouts.items():
+            prefix = f"RESILIENCE_{model_name.upper()}"
+            self.callers[model_name] = ResilientCaller(
+                model_name,
+                timeout_seconds=float(os.environ.get(f"{prefix}_TIMEOUT_SECONDS", str(timeout_seconds))),
+                max_attempts=int(os.environ.get(f"{prefix}_MAX_ATTEMPTS", "3")),
+                base_delay_seconds=base_delay_seconds,
+                max_delay_seconds=max_delay_seconds,
+                hedge_after_seconds=float(os.environ.get(f"{prefix}_HEDGE_AFTER_SECONDS", "0")),
+                circuit_breaker=CircuitBreaker(failure_threshold, reset_seconds),
+                retry_timeouts=os.environ.get(
+                    f"{prefix}_RETRY_TIMEOUTS", "false" if model_name in no_timeout_retry_models else "true"
+                ).lower() == "true",
+            )
+
+    """
+    Function to call a model through its resilient caller
+    Parameters:
+        - model_name: name of the model handle
+        - function: coroutine function with no arguments making the upstream call
+        - hedge: whether to hedge slow attempts
+    """
+    async def call(self, model_name, function, hedge=False):
+        return await self.callers[model_name].call(function, hedge)
+
+    """
+    Function to report the state of every model's resilient caller
+    """
+    def stats(self):
+        return {model_name: caller.stats() for model_name, caller in self.callers.items()}
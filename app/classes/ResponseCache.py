@@ -0,0 +1,220 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from .SharedState import open_shared_database, shared_state_path
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    """
+    Size-bounded LRU cache with TTL eviction for JSON-serialisable model results
+    When a SQLite path is given, entries are also written to a local on-disk store which is consulted
+    on in-memory misses, so results survive evictions and restarts and are shared by the worker processes
+    The on-disk tier is best effort and runs on the caller's thread (often the event loop), so a write waits at most
+    CACHE_SQLITE_BUSY_TIMEOUT_SECONDS for the lock of another worker: a read or write that fails is logged and
+    counted (a read as a miss), and the cache carries on from memory. The periodic trim of the table runs in a thread
+    """
+    def __init__(self, name, max_entries, ttl_seconds, sqlite_path=None, max_disk_entries=100000):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Hit/miss counters
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+        # Optional on-disk tier
+        self.connection = None
+        self.disk_writes = 0
+        self.disk_errors = 0
+        self.sqlite_path = sqlite_path
+        self.trimming = False
+        if sqlite_path:
+            self.connection = open_shared_database(sqlite_path)
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.name} (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {self.name}_expires_at ON {self.name} (expires_at)")
+            busy_timeout_seconds = float(os.environ.get("CACHE_SQLITE_BUSY_TIMEOUT_SECONDS", "0.005"))
+            self.connection.execute(f"PRAGMA busy_timeout = {int(busy_timeout_seconds * 1000)}")
+
+    """
+    Function to build a cache key from the parts that determine a model result
+    Parameters:
+        - parts: JSON-serialisable values (model name, settings, normalised prompt, ...)
+    """
+    @staticmethod
+    def make_key(*parts):
+        serialised = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(serialised.encode("utf-8")).hexdigest()
+
+    """
+    Function to normalise a prompt so that trivially different spellings share a cache entry
+    Parameters:
+        - prompt: text prompt
+    """
+    @staticmethod
+    def normalise_prompt(prompt):
+        return " ".join(str(prompt).split())
+
+    """
+    Function to look up a cached result, returning None on a miss
+    Parameters:
+        - key: cache key built with make_key
+    """
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+
+        # Fall back to the on-disk tier and promote hits back into memory
+        if self.connection is not None:
+            try:
+                row = self.connection.execute(
+                    f"SELECT expires_at, value FROM {self.name} WHERE key = ? AND expires_at > ?",
+                    (key, time.time()),
+                ).fetchone()
+            except sqlite3.OperationalError as error:
+                self.record_disk_error("read", error)
+                row = None
+            if row is not None:
+                value = json.loads(row[1])
+                with self.lock:
+                    self.disk_hits += 1
+                    self.store(key, value, now + (row[0] - time.time()))
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    """
+    Function to store a result in the cache
+    Parameters:
+        - key: cache key built with make_key
+        - value: JSON-serialisable result
+    """
+    def set(self, key, value):
+        with self.lock:
+            self.store(key, value, time.monotonic() + self.ttl_seconds)
+
+        if self.connection is None:
+            return
+        try:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO {self.name} (key, expires_at, value) VALUES (?, ?, ?)",
+                (key, time.time() + self.ttl_seconds, json.dumps(value)),
+            )
+            self.disk_writes += 1
+        except sqlite3.OperationalError as error:
+            self.record_disk_error("write", error)
+            return
+
+        # Periodically drop expired rows and trim the store to its size bound, in a thread
+        with self.lock:
+            start_trim = self.disk_writes % 1000 == 0 and not self.trimming
+            if start_trim:
+                self.trimming = True
+        if start_trim:
+            threading.Thread(target=self.trim_disk, name=f"{self.name}-trim", daemon=True).start()
+
+    """
+    Function to drop expired rows and the rows beyond max_disk_entries from the on-disk tier
+    Runs in its own thread on its own connection, which may wait for the lock as long as needed
+    """
+    def trim_disk(self):
+        try:
+            connection = open_shared_database(self.sqlite_path)
+            try:
+                connection.execute(f"DELETE FROM {self.name} WHERE expires_at <= ?", (time.time(),))
+                connection.execute(
+                    f"DELETE FROM {self.name} WHERE key IN (SELECT key FROM {self.name} ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+            finally:
+                connection.close()
+        except sqlite3.OperationalError as error:
+            self.record_disk_error("trim", error)
+        finally:
+            with self.lock:
+                self.trimming = False
+
+    """
+    Function to log and count a failed read or write of the on-disk tier
+    Parameters:
+        - operation: "read", "write" or "trim"
+        - error: error raised by SQLite
+    """
+    def record_disk_error(self, operation, error):
+        with self.lock:
+            self.disk_errors += 1
+        logger.warning("Skipping the %s of the %s cache on disk: %s", operation, self.name, error)
+
+    """
+    Function to insert an entry in memory and evict the least recently used entries (lock must be held)
+    """
+    def store(self, key, value, expires_at):
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    """
+    Function to record that a caller explicitly skipped the cache
+    """
+    def record_bypass(self):
+        with self.lock:
+            self.bypasses += 1
+
+    """
+    Function to report cache size and hit/miss counters
+    """
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypasses": self.bypasses,
+                "evictions": self.evictions,
+                "disk_enabled": self.connection is not None,
+                "disk_errors": self.disk_errors,
+            }
+
+"""
+Function to build a response cache from environment variables with the given prefix
+The on-disk tier defaults to the shared state directory when SHARED_STATE_DIR is set
+Parameters:
+    - name: cache (and SQLite table) name
+    - prefix: environment variable prefix, e.g. "RESPONSE_CACHE"
+"""
+def response_cache_from_env(name, prefix):
+    return ResponseCache(
+        name=name,
+        max_entries=int(os.environ.get(f"{prefix}_MAX_ENTRIES", "1024")),
+        ttl_seconds=float(os.environ.get(f"{prefix}_TTL_SECONDS", "3600")),
+        sqlite_path=os.environ.get(f"{prefix}_SQLITE_PATH") or shared_state_path(name),
+        max_disk_entries=int(os.environ.get(f"{prefix}_MAX_DISK_ENTRIES", "100000")),
+    )
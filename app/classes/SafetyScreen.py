@@ -0,0 +1,233 @@
+import os
+import re
+try:
+    from re import _parser as regex_parser
+except ImportError:
+    # Python before 3.11
+    import sre_parse as regex_parser
+import threading
+import unicodedata
+from .ResponseCache import ResponseCache, response_cache_from_env
+
+# Warnings returned for each category of blocked prompt
+SAFETY_WARNINGS = {
+    "person": "Child content detected and blocked. Please ensure that your prompt does not solicit inappropriate content.",
+    "celebrity": "Content depicting a celebrity or public figure detected and blocked. Please ensure that your prompt does not name or describe real, well-known people.",
+    "personal_information": "Personal information detected and blocked. Please ensure that your prompt does not contain names, contact details or other personal data.",
+    "sensitive": "Content blocked for ethical reasons. Please ensure that your prompt does not elicit drugs, violence or sensual content.",
+}
+
+# Support codes of the image generation safety filters, listed in the error message of a blocked prompt
+SAFETY_SUPPORT_CODES = {
+    # Child and people/face
+    "58061214": "person", "17301594": "person", "39322892": "person",
+    # Celebrity
+    "29310472": "celebrity", "15236754": "celebrity",
+    # Personal information
+    "92201652": "personal_information",
+    # Sexual
+    "90789179": "sensitive", "63429089": "sensitive", "43188360": "sensitive",
+    # Dangerous, hate, other, prohibited, toxic, violence and vulgar content
+    "62263041": "sensitive", "57734940": "sensitive", "22137204": "sensitive",
+    "74803281": "sensitive", "29578790": "sensitive", "42876398": "sensitive",
+    "89371032": "sensitive", "49114662": "sensitive", "72817394": "sensitive",
+    "78610348": "sensitive", "61493863": "sensitive", "56562880": "sensitive",
+    "32635315": "sensitive",
+}
+
+SUPPORT_CODES_PATTERN = re.compile(r"support codes?:\s*([\d,\s]+)", re.IGNORECASE)
+WORD_PATTERN = re.compile(r"\w+")
+
+"""
+Function to check whether a parsed regular expression refers back to a group, with \1, (?P=name) or (?(1)...)
+Parameters:
+    - node: parse tree returned by regex_parser.parse, or one of its nodes
+"""
+def has_group_reference(node):
+    if isinstance(node, regex_parser.SubPattern):
+        node = node.data
+    if not isinstance(node, (list, tuple)):
+        return False
+    # Opcodes are named constants, compared by identity so plain integers of the tree never match them
+    if node and (node[0] is regex_parser.GROUPREF or node[0] is regex_parser.GROUPREF_EXISTS):
+        return True
+    return any(has_group_reference(child) for child in node)
+
+class SafetyBlockedError(ValueError):
+    """
+    Raised when an image generation prompt is blocked, locally (blocklist or memo) or by the upstream safety filters
+    """
+    def __init__(self, category, source):
+        super().__init__(SAFETY_WARNINGS[category])
+        self.category = category
+        self.source = source
+
+"""
+Function to classify an upstream error as a safety block from its status code and support codes
+Returns the category of the block, or None for any other error
+Older model versions send no support codes, their 400 "could not be submitted" errors are told apart
+by whether the person/face generation settings caused them
+Parameters:
+    - error: exception raised by the upstream call
+"""
+def classify_safety_error(error):
+    # google.api_core exceptions expose the HTTP status as an integer "code"
+    status_code = getattr(error, "code", None)
+    if not isinstance(status_code, int):
+        status_code = getattr(error, "status_code", None)
+    if status_code != 400:
+        return None
+
+    message = str(getattr(error, "message", None) or error)
+    for codes in SUPPORT_CODES_PATTERN.findall(message):
+        for code in re.findall(r"\d+", codes):
+            if code in SAFETY_SUPPORT_CODES:
+                return SAFETY_SUPPORT_CODES[code]
+
+    message = " ".join(message.lower().split())
+    if "prompt could not be submitted" not in message:
+        return None
+    return "person" if "person/face generation" in message else "sensitive"
+
+class SafetyScreen:
+    """
+    Pre-flight screening of image generation prompts, so known-bad prompts are rejected without an upstream call
+    Prompts are matched against a blocklist index (words and phrases in sets, regular expressions compiled
+    case-insensitively one by one) and against a memo of the prompts the upstream safety filters already blocked
+    The blocklist is read from SAFETY_BLOCKLIST_PATH: one "<category>:<entry>" per line, where the category
+    is one of SAFETY_WARNINGS (person, celebrity, personal_information or sensitive) and an entry starting with "re:" is a regular expression, otherwise a word or phrase
+    Regular expressions may not use backreferences
+    The memo is a response cache configured with the SAFETY_MEMO_ environment variables
+    """
+    def __init__(self):
+        self.words = {}
+        self.phrases = {}
+        self.patterns = []
+        blocklist_path = os.environ.get("SAFETY_BLOCKLIST_PATH")
+        if blocklist_path:
+            self.load_blocklist(blocklist_path)
+
+        # Prompts blocked upstream, keyed by the normalised final prompt
+        self.memo = response_cache_from_env("blocked_prompts", "SAFETY_MEMO")
+
+        # Counters
+        self.lock = threading.Lock()
+        self.screened = 0
+        self.blocked = {"blocklist": 0, "memo": 0, "upstream": 0}
+
+    """
+    Function to build the blocklist index from a file
+    Parameters:
+        - path: blocklist file
+    """
+    def load_blocklist(self, path):
+        with open(path, encoding="utf-8") as blocklist_file:
+            for line_number, line in enumerate(blocklist_file, start=1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                category, separator, entry = line.partition(":")
+                category = category.strip().lower()
+                if not separator or category not in SAFETY_WARNINGS:
+                    raise ValueError(f"{path}:{line_number}: expected <category>:<entry> with a category in {sorted(SAFETY_WARNINGS)}")
+
+                # Regular expressions are validated here; prompts are case folded, so they ignore case too
+                if entry.startswith("re:"):
+                    try:
+                        pattern = re.compile(entry[3:], re.IGNORECASE)
+                    except re.error as error:
+                        raise ValueError(f"{path}:{line_number}: invalid regular expression: {error}")
+                    if has_group_reference(regex_parser.parse(entry[3:])):
+                        raise ValueError(f"{path}:{line_number}: backreferences are not allowed in blocklist regular expressions")
+                    self.patterns.append((pattern, category))
+                    continue
+
+                tokens = tuple(WORD_PATTERN.findall(self.normalise(entry)))
+                if len(tokens) == 1:
+                    self.words[tokens[0]] = category
+                elif tokens:
+                    self.phrases.setdefault(tokens[0], []).append((tokens, category))
+
+    """
+    Function to normalise a prompt for matching: compatibility forms folded, case folded and whitespace collapsed
+    Parameters:
+        - prompt: text prompt
+    """
+    @staticmethod
+    def normalise(prompt):
+        return " ".join(unicodedata.normalize("NFKC", str(prompt)).casefold().split())
+
+    """
+    Function to build the memo key of a prompt
+    Parameters:
+        - final_prompt: complete prompt sent to the model
+    """
+    def memo_key(self, final_prompt):
+        return ResponseCache.make_key("image_generation", self.normalise(final_prompt))
+
+    """
+    Function to find the blocklist category of a normalised prompt, returning None when nothing matches
+    Parameters:
+        - normalised_prompt: prompt returned by normalise
+    """
+    def match_blocklist(self, normalised_prompt):
+        if self.words or self.phrases:
+            tokens = WORD_PATTERN.findall(normalised_prompt)
+            for index, token in enumerate(tokens):
+                category = self.words.get(token)
+                if category is not None:
+                    return category
+                for phrase, category in self.phrases.get(token, ()):
+                    if tuple(tokens[index:index + len(phrase)]) == phrase:
+                        return category
+        for pattern, category in self.patterns:
+            if pattern.search(normalised_prompt):
+                return category
+        return None
+
+    """
+    Function to screen a prompt before the upstream call, raising SafetyBlockedError when it is known to be blocked
+    Parameters:
+        - final_prompt: complete prompt sent to the model
+    """
+    def screen(self, final_prompt):
+        normalised_prompt = self.normalise(final_prompt)
+        with self.lock:
+            self.screened += 1
+
+        category = self.match_blocklist(normalised_prompt)
+        source = "blocklist"
+        if category is None:
+            category = self.memo.get(ResponseCache.make_key("image_generation", normalised_prompt))
+            source = "memo"
+        if category is None:
+            return
+
+        with self.lock:
+            self.blocked[source] += 1
+        raise SafetyBlockedError(category, source)
+
+    """
+    Function to remember a prompt blocked by the upstream safety filters
+    Parameters:
+        - final_prompt: complete prompt sent to the model
+        - category: category returned by classify_safety_error
+    """
+    def record_upstream_block(self, final_prompt, category):
+        self.memo.set(self.memo_key(final_prompt), category)
+        with self.lock:
+            self.blocked["upstream"] += 1
+
+    """
+    Function to report the blocklist size and the screening counters
+    """
+    def stats(self):
+        with self.lock:
+            return {
+                "blocklist_words": len(self.words),
+                "blocklist_phrases": sum(len(phrases) for phrases in self.phrases.values()),
+                "blocklist_patterns": len(self.patterns),
+                "screened": self.screened,
+                "blocked": dict(self.blocked),
+                "memo": self.memo.stats(),
+            }
@@ -0,0 +1,44 @@
+import os
+import sqlite3
+
+"""
+Function to return the path of a SQLite database shared by the worker processes of a host
+Returns None when SHARED_STATE_DIR is unset, in which case state is kept per process
+Parameters:
+    - name: database name
+"""
+def shared_state_path(name):
+    state_dir = os.environ.get("SHARED_STATE_DIR")
+    if not state_dir:
+        return None
+    os.makedirs(state_dir, exist_ok=True)
+    return os.path.join(state_dir, f"{name}.sqlite3")
+
+"""
+Function to open a SQLite database that several processes read and write
+WAL lets readers run alongside the writer, and a writer waits up to SHARED_STATE_BUSY_TIMEOUT_SECONDS
+for the write lock instead of failing
+Parameters:
+    - path: database file
+"""
+def open_shared_database(path):
+    busy_timeout_seconds = float(os.environ.get("SHARED_STATE_BUSY_TIMEOUT_SECONDS", "5"))
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=busy_timeout_seconds)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+"""
+Function to check whether a process is still running
+Parameters:
+    - pid: process id
+"""
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running under another user
+        pass
+    return True
@@ -0,0 +1,233 @@
+import asyncio
+import io
+import os
+import random
+import struct
+import threading
+import zlib
+from .ModelBackend import ModelBackend
+
+# Output sizes of the image generation model for each aspect ratio
+IMAGE_SIZES = {
+    "1:1": (1024, 1024),
+    "3:4": (896, 1280),
+    "4:3": (1280, 896),
+    "9:16": (768, 1408),
+    "16:9": (1408, 768),
+}
+
+# Words the simulated text is made of
+WORDS = (
+    "the", "a", "river", "light", "morning", "song", "over", "quiet", "city", "dream", "and", "of",
+    "stone", "winter", "golden", "through", "heart", "we", "sing", "under", "sky", "old", "road", "home",
+)
+
+class SimulatedUpstreamError(Exception):
+    """
+    Error raised by the simulator, carrying an HTTP status "code" like google.api_core exceptions
+    """
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+class SimulatorBackend(ModelBackend):
+    """
+    Offline backend for load tests, answering every capability locally after a simulated upstream latency
+    Latencies follow a lognormal distribution around a per-model median, a share of calls fails with 429/503,
+    and generated images are real PNGs of the model's output size
+    Image generation prompts containing one of SIMULATOR_BLOCKED_TERMS fail like prompts blocked by the safety filters
+    Configured from environment variables:
+    SIMULATOR_SEED, SIMULATOR_<MODEL>_LATENCY_SECONDS, SIMULATOR_LATENCY_SIGMA, SIMULATOR_ERROR_RATE,
+    SIMULATOR_TEXT_WORDS, SIMULATOR_STREAM_CHUNK_WORDS, SIMULATOR_IMAGE_NOISE, SIMULATOR_IMAGE_VARIANTS
+    and SIMULATOR_BLOCKED_TERMS
+    """
+    def __init__(self):
+        seed = os.environ.get("SIMULATOR_SEED")
+        self.random = random.Random(int(seed) if seed else None)
+        self.median_latency_seconds = {}
+        for model_name, latency_seconds in (
+            ("gemini_model", 2.0),
+            ("vertex_pro_vision_model", 2.5),
+            ("vertex_text_model", 1.5),
+            ("vertex_image_captioning_model", 0.8),
+            ("vertex_image_generation_model", 8.0),
+        ):
+            self.median_latency_seconds[model_name] = float(os.environ.get(f"SIMULATOR_{model_name.upper()}_LATENCY_SECONDS", str(latency_seconds)))
+        self.latency_sigma = float(os.environ.get("SIMULATOR_LATENCY_SIGMA", "0.35"))
+        self.error_rate = float(os.environ.get("SIMULATOR_ERROR_RATE", "0"))
+        self.text_words = int(os.environ.get("SIMULATOR_TEXT_WORDS", "300"))
+        self.stream_chunk_words = int(os.environ.get("SIMULATOR_STREAM_CHUNK_WORDS", "20"))
+        self.image_noise = float(os.environ.get("SIMULATOR_IMAGE_NOISE", "16"))
+        self.image_variants = int(os.environ.get("SIMULATOR_IMAGE_VARIANTS", "3"))
+        self.blocked_terms = [term.strip().lower() for term in os.environ.get("SIMULATOR_BLOCKED_TERMS", "").split(",") if term.strip()]
+
+        # PNGs are rendered once per aspect ratio and variant, then stamped with a unique chunk per call
+        self.images = {}
+        self.images_lock = threading.Lock()
+        self.images_generated = 0
+
+        # Counters
+        self.calls = {model_name: 0 for model_name in self.median_latency_seconds}
+        self.errors = {model_name: 0 for model_name in self.median_latency_seconds}
+
+    """
+    Function to draw the latency of one call
+    Parameters:
+        - model_name: name of the simulated model
+    """
+    def sample_latency(self, model_name):
+        return self.median_latency_seconds[model_name] * self.random.lognormvariate(0, self.latency_sigma)
+
+    """
+    Function to simulate an upstream round trip: wait, then fail with the configured error rate
+    Parameters:
+        - model_name: name of the simulated model
+        - latency_seconds: time to wait (defaults to a sampled latency)
+    """
+    async def simulate_call(self, model_name, latency_seconds=None):
+        self.calls[model_name] += 1
+        if latency_seconds is None:
+            latency_seconds = self.sample_latency(model_name)
+        await asyncio.sleep(latency_seconds)
+        if self.random.random() < self.error_rate:
+            self.errors[model_name] += 1
+            if self.random.random() < 0.5:
+                raise SimulatedUpstreamError(429, "Resource exhausted (simulated)")
+            raise SimulatedUpstreamError(503, "Service unavailable (simulated)")
+
+    """
+    Function to produce the simulated text of a prompt
+    Parameters:
+        - prompt: prompt sent to the model
+    """
+    def make_text(self, prompt):
+        words = [self.random.choice(WORDS) for _ in range(self.text_words)]
+        return f"**{prompt[:40].strip()}**\n\n" + " ".join(words)
+
+    """
+    Function to yield the simulated text in chunks, spreading the latency over the stream
+    Parameters:
+        - model_name: name of the simulated model
+        - prompt: prompt sent to the model
+    """
+    async def stream_chunks(self, model_name, prompt):
+        latency_seconds = self.sample_latency(model_name)
+        words = self.make_text(prompt).split(" ")
+        chunks = [
+            " ".join(words[index:index + self.stream_chunk_words])
+            for index in range(0, len(words), self.stream_chunk_words)
+        ]
+
+        # Time to first chunk is a fifth of the call, the rest is spread between the chunks
+        await self.simulate_call(model_name, latency_seconds * 0.2)
+        for index, chunk in enumerate(chunks):
+            if index:
+                await asyncio.sleep(latency_seconds * 0.8 / len(chunks))
+            yield chunk if index == 0 else " " + chunk
+
+    async def generate_text(self, prompt, generation_config=None, model_name="vertex_pro_vision_model"):
+        await self.simulate_call(model_name)
+        return [self.make_text(prompt)]
+
+    async def stream_text(self, prompt, generation_config=None, model_name="vertex_pro_vision_model"):
+        async for chunk in self.stream_chunks(model_name, prompt):
+            yield chunk
+
+    async def generate_text_from_image(self, prompt, image_bytes, mime_type, model_name="gemini_model"):
+        await self.simulate_call(model_name)
+        return [self.make_text(prompt)]
+
+    async def stream_text_from_image(self, prompt, image_bytes, mime_type, model_name="gemini_model"):
+        async for chunk in self.stream_chunks(model_name, prompt):
+            yield chunk
+
+    async def count_tokens(self, prompt, model_name):
+        # Roughly four characters per token, like the Gemini tokenizer on English text
+        return max(1, len(prompt) // 4)
+
+    async def get_captions(self, image_bytes, number_of_results, language):
+        await self.simulate_call("vertex_image_captioning_model")
+        return [
+            " ".join(self.random.choice(WORDS) for _ in range(8))
+            for _ in range(number_of_results)
+        ]
+
+    async def generate_images(self, prompt, number_of_images, aspect_ratio, safety_filter_level, person_generation):
+        await self.simulate_call("vertex_image_generation_model")
+        if any(term in prompt.lower() for term in self.blocked_terms):
+            raise SimulatedUpstreamError(400, "Image generation failed with the following error: The prompt could not be submitted. This prompt contains sensitive words that violate Google's Responsible AI practices. Try rephrasing the prompt. If you think this was an error, send feedback. Support codes: 42876398")
+        images_bytes = []
+        for index in range(number_of_images):
+            template = await asyncio.to_thread(self.get_image, aspect_ratio, index % self.image_variants)
+            images_bytes.append(self.stamp_image(template))
+        return images_bytes
+
+    """
+    Function to return the rendered PNG of an aspect ratio and variant, rendering it on first use
+    Parameters:
+        - aspect_ratio: image aspect ratio
+        - variant: index of the variant
+    """
+    def get_image(self, aspect_ratio, variant):
+        key = (aspect_ratio, variant)
+        with self.images_lock:
+            if key not in self.images:
+                width, height = IMAGE_SIZES.get(aspect_ratio, IMAGE_SIZES["1:1"])
+                self.images[key] = self.render_image(width, height, variant)
+                self.images_generated += 1
+            return self.images[key]
+
+    """
+    Function to render a PNG that compresses like a generated photo: a smooth gradient with soft noise
+    (noise drawn at a third of the resolution, about 1.5 MB for 1024x1024 at the default noise level)
+    Parameters:
+        - width, height: image size
+        - variant: seed of the variant
+    """
+    def render_image(self, width, height, variant):
+        from PIL import Image, ImageChops
+        gradient = Image.linear_gradient("L").resize((width, height))
+        channels = []
+        for channel in range(3):
+            base = gradient.rotate(90 * ((variant + channel) % 4)).resize((width, height))
+            noise = Image.effect_noise((width // 3, height // 3), self.image_noise).resize((width, height), Image.BILINEAR)
+            channels.append(ImageChops.add(base, noise, scale=1.0, offset=-128))
+        image = Image.merge("RGB", channels)
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+        return output.getvalue()
+
+    """
+    Function to make a PNG unique by inserting a tEXt chunk with a random value before its IEND chunk
+    so every generated image gets its own content hash, as real generations do
+    Parameters:
+        - png_bytes: PNG image
+    """
+    def stamp_image(self, png_bytes):
+        data = b"simulator\x00" + format(self.random.getrandbits(64), "016x").encode("ascii")
+        chunk = struct.pack(">I", len(data)) + b"tEXt" + data + struct.pack(">I", zlib.crc32(b"tEXt" + data))
+        # IEND is always the last 12 bytes of a PNG
+        return png_bytes[:-12] + chunk + png_bytes[-12:]
+
+    """
+    Function to report the simulated models as ready
+    """
+    def model_status(self):
+        return {
+            model_name: {
+                "ready": True,
+                "error": None,
+                "load_seconds": 0.0,
+            }
+            for model_name in self.median_latency_seconds
+        }
+
+    """
+    Function to report simulated calls and errors
+    """
+    def stats(self):
+        return {
+            "calls": dict(self.calls),
+            "errors": dict(self.errors),
+            "images_generated": self.images_generated,
+        }
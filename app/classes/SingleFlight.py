@@ -0,0 +1,50 @@
+import asyncio
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls so that only one upstream call runs per key
+    Every caller that arrives while a call is in flight awaits the same task and gets the same result or error
+    The shared call runs in its own task, so a caller disconnecting does not cancel it for the others
+    """
+    def __init__(self, name):
+        self.name = name
+        self.in_flight = {}
+        self.upstream_calls = 0
+        self.coalesced_calls = 0
+
+    """
+    Function to run a coroutine function once per key among concurrent callers
+    Parameters:
+        - key: identity of the call (e.g. hash of the normalised prompt and parameters)
+        - function: coroutine function with no arguments that performs the upstream call
+    """
+    async def run(self, key, function):
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced_calls += 1
+        else:
+            self.upstream_calls += 1
+            task = asyncio.ensure_future(function())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda finished_task: self.finish(key, finished_task))
+        return await asyncio.shield(task)
+
+    """
+    Function to remove a finished call from the in-flight table
+    """
+    def finish(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        # Mark the exception as retrieved in case every caller went away before the call finished
+        if not task.cancelled():
+            task.exception()
+
+    """
+    Function to report how many upstream calls were saved by coalescing
+    """
+    def stats(self):
+        return {
+            "in_flight": len(self.in_flight),
+            "upstream_calls": self.upstream_calls,
+            "coalesced_calls": self.coalesced_calls,
+        }
@@ -0,0 +1,191 @@
+import datetime
+import json
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+class MultipartImageSniffer:
+    """
+    Follows a multipart/form-data body as it arrives and checks the head of the first file part with the image validator
+    (magic bytes, header and pixel count), so a file that is not an acceptable image is rejected before the rest
+    of the body is received and spooled. Parsing stops once that file's header has been checked
+    """
+    def __init__(self, boundary, image_validator):
+        self.image_validator = image_validator
+        self.warning = None
+        self.done = False
+        self.header_field = b""
+        self.headers = {}
+        self.is_file = False
+        self.head = bytearray()
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+        })
+
+    def on_part_begin(self):
+        self.headers = {}
+        self.header_field = b""
+        self.is_file = False
+
+    # Header names and values may be split across body chunks, so the parts are appended until the header ends
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end].lower()
+
+    def on_header_value(self, data, start, end):
+        self.headers[self.header_field] = self.headers.get(self.header_field, b"") + data[start:end]
+
+    def on_header_end(self):
+        self.header_field = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        self.is_file = b"filename" in options
+
+    def on_part_data(self, data, start, end):
+        if not self.is_file or self.done:
+            return
+        self.head += data[start:end]
+        header, warning = self.image_validator.check_header(self.head)
+        if warning is not None:
+            self.warning = warning
+        if header is not None or warning is not None:
+            self.done = True
+
+    """
+    Function to feed a chunk of the body, returning the warning once the file is found to be invalid
+    Parameters:
+        - chunk: bytes of the request body
+    """
+    def feed(self, chunk):
+        if self.done or not chunk:
+            return self.warning
+        try:
+            self.parser.write(chunk)
+        except Exception:
+            # Malformed bodies are left to the form parser of the endpoint
+            self.done = True
+        return self.warning
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI middleware that rejects oversized request bodies on the upload endpoints before they are spooled
+    Requests with a Content-Length above the limit are answered with 413 without reading the body,
+    and chunked bodies are counted as they arrive and cut off once the limit is crossed
+    With an image validator, the head of the uploaded file is checked as the body streams in and a file that is not
+    an acceptable image is answered with 422 without receiving the rest of the body
+    """
+    def __init__(self, app, paths, max_body_bytes, image_validator=None):
+        self.app = app
+        self.paths = set(paths)
+        self.max_body_bytes = max_body_bytes
+        self.image_validator = image_validator
+
+    """
+    Function to send a rejection in the same format as the API's warning responses
+    Parameters:
+        - send: ASGI send callable
+        - status_code: HTTP status of the response
+        - warning: warning message
+    """
+    async def send_rejection(self, send, status_code, warning):
+        body = json.dumps({
+            "warnings": [warning],
+            "timestamp": int(datetime.datetime.now().timestamp())
+        }).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    """
+    Function to send a 413 response
+    Parameters:
+        - send: ASGI send callable
+    """
+    async def send_too_large(self, send):
+        await self.send_rejection(send, 413, f"File size is too large. Choose a file of a size lower than {self.max_body_bytes // (1024 * 1024)} MB.")
+
+    """
+    Function to create the sniffer of a multipart request, or None when the body is not multipart
+    Parameters:
+        - headers: request headers
+    """
+    def make_sniffer(self, headers):
+        if self.image_validator is None:
+            return None
+        media_type, options = parse_options_header(headers.get(b"content-type", b""))
+        if media_type != b"multipart/form-data" or not options.get(b"boundary"):
+            return None
+        return MultipartImageSniffer(options[b"boundary"], self.image_validator)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        # Reject straight away when the declared body size is already over the limit
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body_bytes:
+            await self.send_too_large(send)
+            return
+
+        # Rejection (status code, warning) decided while the body streams in
+        state = {"received": 0, "rejection": None, "response_started": False}
+        sniffer = self.make_sniffer(headers)
+
+        # Count body bytes as they stream in and stop handing them on once the limit is crossed or the file is invalid
+        async def limited_receive():
+            if state["rejection"] is not None:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                state["received"] += len(body)
+                if state["received"] > self.max_body_bytes:
+                    state["rejection"] = (413, None)
+                    return {"type": "http.disconnect"}
+                if sniffer is not None:
+                    warning = sniffer.feed(body)
+                    if warning is not None:
+                        state["rejection"] = (422, warning)
+                        return {"type": "http.disconnect"}
+            return message
+
+        async def send_rejection():
+            status_code, warning = state["rejection"]
+            if status_code == 413:
+                await self.send_too_large(send)
+            else:
+                await self.send_rejection(send, status_code, warning)
+
+        # Replace whatever the app answers with the rejection once the body has been cut off
+        async def limited_send(message):
+            if state["rejection"] is not None:
+                if message["type"] == "http.response.start" and not state["response_started"]:
+                    state["response_started"] = True
+                    await send_rejection()
+                return
+            if message["type"] == "http.response.start":
+                state["response_started"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except Exception:
+            if state["rejection"] is None:
+                raise
+            if not state["response_started"]:
+                await send_rejection()
@@ -0,0 +1,144 @@
+import asyncio
+from functools import partial
+import itertools
+import math
+import os
+import time
+
+class RoundRobinClient:
+    """
+    Spreads the calls made through a model's client over a pool of clients, each with its own connection
+    Attribute lookups (e.g. generate_content) are forwarded to the next client of the pool
+    """
+    def __init__(self, clients):
+        self.clients = clients
+        self.next_client = itertools.cycle(clients)
+
+    def __getattr__(self, name):
+        return getattr(next(self.next_client), name)
+
+class UpstreamChannels:
+    """
+    Long-lived gRPC channels to the model APIs, created once per model and reused by every call
+    Each model gets its own connections (not the process-wide subchannel pool), sized from its admission limit
+    so its concurrent calls fit in the HTTP/2 streams of its connections, with keepalive pings so idle
+    connections are not silently dropped by load balancers and a dead connection is noticed before a call hangs on it
+    The channels are async (grpc.aio), so they are created and closed on the event loop
+    Configured from environment variables:
+    UPSTREAM_KEEPALIVE_SECONDS, UPSTREAM_KEEPALIVE_TIMEOUT_SECONDS, UPSTREAM_STREAMS_PER_CONNECTION,
+    UPSTREAM_MAX_CONNECTIONS_PER_MODEL and UPSTREAM_CONNECT_TIMEOUT_SECONDS
+    """
+    def __init__(self):
+        self.keepalive_seconds = float(os.environ.get("UPSTREAM_KEEPALIVE_SECONDS", "30"))
+        self.keepalive_timeout_seconds = float(os.environ.get("UPSTREAM_KEEPALIVE_TIMEOUT_SECONDS", "10"))
+        self.streams_per_connection = int(os.environ.get("UPSTREAM_STREAMS_PER_CONNECTION", "50"))
+        self.max_connections_per_model = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS_PER_MODEL", "4"))
+        self.connect_timeout_seconds = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT_SECONDS", "10"))
+
+        # Concurrency limits of the models, set from the admission limits
+        self.max_concurrency = {}
+        # Channels opened per model
+        self.channels = {}
+
+        # Counters
+        self.connect_seconds = {}
+        self.connect_failures = 0
+
+    """
+    Function to return the gRPC options of the channels
+    """
+    def channel_options(self):
+        return [
+            ("grpc.max_send_message_length", -1),
+            ("grpc.max_receive_message_length", -1),
+            ("grpc.keepalive_time_ms", int(self.keepalive_seconds * 1000)),
+            ("grpc.keepalive_timeout_ms", int(self.keepalive_timeout_seconds * 1000)),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+            # Give each channel its own connection instead of sharing one with identical channels
+            ("grpc.use_local_subchannel_pool", 1),
+        ]
+
+    """
+    Function to compute the number of connections of a model from its concurrency limit
+    Parameters:
+        - model_name: name of the model handle
+    """
+    def connections_for(self, model_name):
+        max_concurrency = self.max_concurrency.get(model_name, 1)
+        return max(1, min(self.max_connections_per_model, math.ceil(max_concurrency / self.streams_per_connection)))
+
+    """
+    Function to build a channel factory passed to a GAPIC gRPC asyncio transport
+    The transport calls it with the arguments of its own create_channel, the options are replaced with ours
+    Parameters:
+        - model_name: name of the model handle the channel belongs to
+        - transport_class: GAPIC transport class creating the authenticated channel
+    """
+    def channel_factory(self, model_name, transport_class):
+        def create_channel(host, **kwargs):
+            kwargs["options"] = self.channel_options()
+            channel = transport_class.create_channel(host, **kwargs)
+            self.channels.setdefault(model_name, []).append(channel)
+            return channel
+        return create_channel
+
+    """
+    Function to create the pooled client of a model
+    Parameters:
+        - model_name: name of the model handle
+        - client_class: GAPIC async client class
+        - transport_class: GAPIC gRPC asyncio transport class
+        - client_arguments: credentials, client_options, ... passed to every client
+    """
+    def create_client(self, model_name, client_class, transport_class, **client_arguments):
+        clients = [
+            client_class(
+                transport=partial(transport_class, channel=self.channel_factory(model_name, transport_class)),
+                **client_arguments,
+            )
+            for _ in range(self.connections_for(model_name))
+        ]
+        return clients[0] if len(clients) == 1 else RoundRobinClient(clients)
+
+    """
+    Function to open the connections (DNS, TCP, TLS and HTTP/2 set-up) of the channels before traffic arrives
+    Failures are counted and left to the first call, which reconnects
+    """
+    async def connect(self):
+        async def connect_model(model_name, channels):
+            started_at = time.perf_counter()
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*[channel.channel_ready() for channel in channels]),
+                    self.connect_timeout_seconds,
+                )
+                self.connect_seconds[model_name] = time.perf_counter() - started_at
+            except Exception:
+                self.connect_failures += 1
+
+        await asyncio.gather(*[connect_model(model_name, channels) for model_name, channels in self.channels.items()])
+
+    """
+    Function to close every channel
+    """
+    async def close(self):
+        channels = [channel for model_channels in self.channels.values() for channel in model_channels]
+        self.channels = {}
+        await asyncio.gather(*[channel.close() for channel in channels], return_exceptions=True)
+
+    """
+    Function to report the connections of each model
+    """
+    def stats(self):
+        return {
+            "keepalive_seconds": self.keepalive_seconds,
+            "connect_failures": self.connect_failures,
+            "models": {
+                model_name: {
+                    "connections": len(channels),
+                    "connect_seconds": self.connect_seconds.get(model_name),
+                }
+                for model_name, channels in self.channels.items()
+            },
+        }
@@ -0,0 +1,385 @@
+import asyncio
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+import os
+import threading
+from .AdmissionController import hold_slot_until
+from .ModelBackend import ModelBackend
+from .ModelHandle import ModelHandle
+from .UpstreamChannels import UpstreamChannels
+
+# The vertexai and google.generativeai SDKs are imported lazily by the model loaders below,
+# so importing this module (and starting a worker) does not pay for loading them
+
+# Credentials decoded by preload_clients in the parent of forked worker processes (see app/serve.py)
+preloaded_credentials = None
+
+"""
+Function to decode the service account key into credentials
+Parameters:
+    - gcp_sa_key_string: base 64 encoded service account key
+"""
+def load_credentials(gcp_sa_key_string):
+    from google.oauth2 import service_account
+    gcp_decoded_sa_key_string = base64.b64decode(gcp_sa_key_string)
+    gcp_sa_key_json = json.loads(gcp_decoded_sa_key_string)
+    return service_account.Credentials.from_service_account_info(gcp_sa_key_json)
+
+"""
+Function to import the SDKs, decode the credentials and initialise the SDKs once before forking worker processes
+The workers inherit the result instead of repeating it; only configuration is prepared here, no connection
+or thread is started, since those do not survive a fork
+"""
+def preload_clients():
+    global preloaded_credentials
+    import vertexai
+    import google.generativeai as genai
+    from vertexai.generative_models import GenerativeModel
+    from vertexai.preview.vision_models import ImageCaptioningModel, ImageGenerationModel
+    preloaded_credentials = load_credentials(os.environ.get("GCP_SA_KEY_STRING"))
+    vertexai.init(project=os.environ.get("GCP_PROJECT_ID"), credentials=preloaded_credentials, location=os.environ.get("GCP_LOCATION"))
+    genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+
+class VertexBackend(ModelBackend):
+    """
+    Backend calling Vertex AI (text, captioning and image generation) and Google AI (text about an image)
+    """
+    def __init__(self, vertex_pro_vision_model_name, vertex_text_model_name):
+        self.GCP_SA_KEY_STRING = os.environ.get("GCP_SA_KEY_STRING")
+        self.project_id = os.environ.get("GCP_PROJECT_ID")
+        self.location = os.environ.get("GCP_LOCATION")
+        self.GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+        self.credentials = None
+        self.clients_lock = threading.Lock()
+        self.vertex_initialised = False
+        self.google_ai_initialised = False
+
+        # Model handles are loaded on first use or by warm_up, not at construction
+        self.vertex_pro_vision_model_name = vertex_pro_vision_model_name
+        self.vertex_text_model_name = vertex_text_model_name
+        self.gemini_model = ModelHandle("gemini_model", self.load_gemini_model)
+        self.vertex_pro_vision_model = ModelHandle("vertex_pro_vision_model", self.load_vertex_pro_vision_model)
+        self.vertex_text_model = ModelHandle("vertex_text_model", self.load_vertex_text_model)
+        self.vertex_image_captioning_model = ModelHandle("vertex_image_captioning_model", self.load_vertex_image_captioning_model)
+        self.vertex_image_generation_model = ModelHandle("vertex_image_generation_model", self.load_vertex_image_generation_model)
+        self.model_handles = [
+            self.gemini_model,
+            self.vertex_pro_vision_model,
+            self.vertex_text_model,
+            self.vertex_image_captioning_model,
+            self.vertex_image_generation_model,
+        ]
+
+        # Bounded thread pool for SDK calls that have no async variant (captioning and image generation)
+        # so that blocking network calls never run on the event loop
+        self.model_thread_pool_size = int(os.environ.get("MODEL_THREAD_POOL_SIZE", "32"))
+        self.model_executor = ThreadPoolExecutor(
+            max_workers=self.model_thread_pool_size,
+            thread_name_prefix="model-call",
+        )
+
+        # Backoff of the background retries of failed model loads
+        self.load_retry_base_seconds = float(os.environ.get("MODEL_LOAD_RETRY_BASE_SECONDS", "1"))
+        self.load_retry_max_seconds = float(os.environ.get("MODEL_LOAD_RETRY_MAX_SECONDS", "60"))
+
+        # Handles of the models that can be routed to
+        self.handles = {handle.name: handle for handle in self.model_handles}
+
+        # Long-lived keepalive channels used by the async generate_content calls instead of the SDK defaults
+        # (captioning and image generation keep the SDK's own client, reused through their model handles)
+        self.upstream_channels = UpstreamChannels()
+        self.pooled_models = set()
+
+    """
+    Function to decode the service account key and initialise the Vertex AI SDK (once)
+    Skipped when the parent process already did it before forking the workers
+    """
+    def initialise_vertex(self):
+        with self.clients_lock:
+            if self.vertex_initialised:
+                return
+            if preloaded_credentials is not None:
+                self.credentials = preloaded_credentials
+            else:
+                import vertexai
+                self.credentials = load_credentials(self.GCP_SA_KEY_STRING)
+                vertexai.init(project = self.project_id, credentials = self.credentials, location = self.location)
+            self.vertex_initialised = True
+
+    """
+    Function to configure the Google AI SDK (once)
+    Skipped when the parent process already did it before forking the workers
+    """
+    def initialise_google_ai(self):
+        with self.clients_lock:
+            if self.google_ai_initialised:
+                return
+            if preloaded_credentials is None:
+                import google.generativeai as genai
+                genai.configure(api_key=self.GEMINI_API_KEY)
+            self.google_ai_initialised = True
+
+    """
+    Model loaders used by the lazy model handles
+    """
+    def load_gemini_model(self):
+        self.initialise_google_ai()
+        import google.generativeai as genai
+        return genai.GenerativeModel('gemini-pro-vision')
+
+    def load_vertex_pro_vision_model(self):
+        self.initialise_vertex()
+        from vertexai.generative_models import GenerativeModel
+        return GenerativeModel(model_name=self.vertex_pro_vision_model_name)
+
+    def load_vertex_text_model(self):
+        self.initialise_vertex()
+        from vertexai.generative_models import GenerativeModel
+        return GenerativeModel(model_name=self.vertex_text_model_name)
+
+    def load_vertex_image_captioning_model(self):
+        self.initialise_vertex()
+        from vertexai.preview.vision_models import ImageCaptioningModel
+        return ImageCaptioningModel.from_pretrained("imagetext@001")
+
+    def load_vertex_image_generation_model(self):
+        self.initialise_vertex()
+        from vertexai.preview.vision_models import ImageGenerationModel
+        return ImageGenerationModel.from_pretrained("imagegeneration@006")
+
+    """
+    Function to load every model handle in the background so the first requests do not pay for it
+    Failures are recorded on the handles (and reported by readiness) instead of being raised
+    """
+    async def warm_up(self):
+        await asyncio.gather(
+            *[handle.get_async(self.model_executor) for handle in self.model_handles],
+            return_exceptions=True,
+        )
+
+        # Create the pooled clients of the loaded models and open their connections before traffic arrives
+        for model_name in set(self.text_models + self.image_text_models):
+            if self.handles[model_name].model is not None:
+                await self.async_model(model_name)
+        await self.upstream_channels.connect()
+
+    """
+    Function to retry the model loads that failed, in the background, with exponential backoff
+    Without it a model that failed to load (e.g. a transient error at startup) would only be retried by a request,
+    which a load balancer gating on readiness never sends
+    Runs until cancelled at shutdown
+    """
+    async def retry_failed_loads(self):
+        delay_seconds = self.load_retry_base_seconds
+        while True:
+            await asyncio.sleep(delay_seconds)
+            failed = [handle for handle in self.model_handles if handle.model is None and handle.error is not None]
+            if not failed:
+                delay_seconds = self.load_retry_base_seconds
+                continue
+            await asyncio.gather(
+                *[handle.get_async(self.model_executor) for handle in failed],
+                return_exceptions=True,
+            )
+            if any(handle.model is None for handle in failed):
+                delay_seconds = min(2 * delay_seconds, self.load_retry_max_seconds)
+            else:
+                delay_seconds = self.load_retry_base_seconds
+
+    """
+    Function to size the connection pools of the models from their admission limits
+    Parameters:
+        - max_concurrency: dict of model handle name to the calls it may have in flight
+    """
+    def size_connection_pools(self, max_concurrency):
+        self.upstream_channels.max_concurrency = dict(max_concurrency)
+
+    """
+    Function to return a model used with async calls, attaching its pooled client on first use
+    Runs on the event loop since the gRPC asyncio channels belong to it
+    Parameters:
+        - model_name: one of text_models or image_text_models
+    """
+    async def async_model(self, model_name):
+        model = await self.handles[model_name].get_async(self.model_executor)
+        if model_name not in self.pooled_models:
+            self.attach_pooled_client(model_name, model)
+            self.pooled_models.add(model_name)
+        return model
+
+    """
+    Function to replace the client a model creates lazily on its first async call with a pooled one
+    The SDKs keep that client in a private attribute; if it is not there, the model keeps its default client
+    Parameters:
+        - model_name: name of the model handle
+        - model: loaded model
+    """
+    def attach_pooled_client(self, model_name, model):
+        if model_name == "gemini_model":
+            import google.ai.generativelanguage as glm
+            from google.ai.generativelanguage_v1beta.services.generative_service.transports import GenerativeServiceGrpcAsyncIOTransport
+            if hasattr(model, "_async_client"):
+                model._async_client = self.upstream_channels.create_client(
+                    model_name,
+                    glm.GenerativeServiceAsyncClient,
+                    GenerativeServiceGrpcAsyncIOTransport,
+                    client_options={"api_key": self.GEMINI_API_KEY},
+                )
+            return
+
+        from google.cloud.aiplatform import initializer
+        from google.cloud.aiplatform_v1.services.prediction_service import PredictionServiceAsyncClient
+        from google.cloud.aiplatform_v1.services.prediction_service.transports import PredictionServiceGrpcAsyncIOTransport
+        if hasattr(type(model), "_prediction_async_client"):
+            model._prediction_async_client = self.upstream_channels.create_client(
+                model_name,
+                PredictionServiceAsyncClient,
+                PredictionServiceGrpcAsyncIOTransport,
+                credentials=self.credentials,
+                client_options=initializer.global_config.get_client_options(location_override=self.location, prediction_client=True),
+            )
+
+    """
+    Function to report which models are loaded
+    """
+    def model_status(self):
+        return {handle.name: handle.status() for handle in self.model_handles}
+
+    """
+    Function to release the model thread pool
+    """
+    def shutdown(self):
+        self.model_executor.shutdown(wait=False, cancel_futures=True)
+
+    """
+    Function to report the pooled connections
+    """
+    def stats(self):
+        return {
+            "upstream_connections": self.upstream_channels.stats(),
+        }
+
+    """
+    Function to close the pooled channels
+    """
+    async def close(self):
+        await self.upstream_channels.close()
+
+    """
+    Function to run a blocking SDK call in the bounded model thread pool without blocking the event loop
+    The admission slot of the call is kept until the thread ends, even if the caller stops waiting for it
+    Parameters:
+        - function: blocking callable to run
+        - args, kwargs: arguments passed to the callable
+    """
+    async def run_blocking(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.model_executor, partial(function, *args, **kwargs))
+        hold_slot_until(future)
+        # Shielded so that a cancelled caller leaves the future pending until the thread actually ends
+        return await asyncio.shield(future)
+
+    """
+    Function to extract the text parts of a generate_content response
+    Parameters:
+        - response: model response
+    """
+    def response_texts(self, response):
+        response_texts = []
+
+        for candidate in response.candidates:
+            response_texts = [part.text for part in candidate.content.parts]
+
+        return response_texts
+
+    """
+    Function to yield the text of each chunk of a streamed generate_content response
+    The upstream stream is closed when the consumer stops iterating (e.g. the client disconnected)
+    Parameters:
+        - response_stream: async iterable of partial model responses
+    """
+    async def stream_texts(self, response_stream):
+        try:
+            async for response in response_stream:
+                for candidate in response.candidates:
+                    for part in candidate.content.parts:
+                        if part.text:
+                            yield part.text
+        finally:
+            close_stream = getattr(response_stream, "aclose", None)
+            if close_stream is not None:
+                await close_stream()
+
+    """
+    Function to build the contents of a prompt with an image for the given model
+    Google AI takes the image as an inline blob dict, Vertex as a Part
+    Parameters:
+        - prompt: complete prompt sent to the model
+        - image_bytes: encoded image
+        - mime_type: mime type of the image
+        - model_name: one of image_text_models
+    """
+    def image_contents(self, prompt, image_bytes, mime_type, model_name):
+        if model_name == "gemini_model":
+            return [prompt, {"mime_type": mime_type, "data": image_bytes}]
+        from vertexai.generative_models import Part
+        return [prompt, Part.from_data(data=image_bytes, mime_type=mime_type)]
+
+    async def count_tokens(self, prompt, model_name):
+        model = await self.async_model(model_name)
+        response = await model.count_tokens_async(prompt)
+        return response.total_tokens
+
+    async def generate_text(self, prompt, generation_config=None, model_name="vertex_pro_vision_model"):
+        text_model = await self.async_model(model_name)
+        response = await text_model.generate_content_async(prompt, generation_config=generation_config)
+        return self.response_texts(response)
+
+    async def stream_text(self, prompt, generation_config=None, model_name="vertex_pro_vision_model"):
+        text_model = await self.async_model(model_name)
+        response_stream = await text_model.generate_content_async(
+            prompt,
+            generation_config=generation_config,
+            stream=True,
+        )
+        async for text in self.stream_texts(response_stream):
+            yield text
+
+    async def generate_text_from_image(self, prompt, image_bytes, mime_type, model_name="gemini_model"):
+        # Pass the image inline, so it is never written to disk or decoded here
+        vision_model = await self.async_model(model_name)
+        response = await vision_model.generate_content_async(self.image_contents(prompt, image_bytes, mime_type, model_name))
+        return self.response_texts(response)
+
+    async def stream_text_from_image(self, prompt, image_bytes, mime_type, model_name="gemini_model"):
+        vision_model = await self.async_model(model_name)
+        response_stream = await vision_model.generate_content_async(self.image_contents(prompt, image_bytes, mime_type, model_name), stream=True)
+        async for text in self.stream_texts(response_stream):
+            yield text
+
+    async def get_captions(self, image_bytes, number_of_results, language):
+        vertex_image_captioning_model = await self.vertex_image_captioning_model.get_async(self.model_executor)
+        # Hand the bytes straight to vertex (no temp file round trip)
+        from vertexai.preview.vision_models import Image
+        image = Image(image_bytes=image_bytes)
+        return await self.run_blocking(
+            vertex_image_captioning_model.get_captions,
+            image=image,
+            number_of_results=number_of_results,
+            language=language,
+        )
+
+    async def generate_images(self, prompt, number_of_images, aspect_ratio, safety_filter_level, person_generation):
+        vertex_image_generation_model = await self.vertex_image_generation_model.get_async(self.model_executor)
+        images = await self.run_blocking(
+            vertex_image_generation_model.generate_images,
+            prompt=prompt,
+            number_of_images=number_of_images,
+            language="en",
+            aspect_ratio=aspect_ratio,
+            safety_filter_level=safety_filter_level,
+            person_generation=person_generation,
+        )
+        return [image._image_bytes for image in images]
@@ -1,37 +1,125 @@
-import base64
+import time
+IMPORT_STARTED_AT = time.perf_counter()
+
+import asyncio
+from contextlib import asynccontextmanager
 import datetime 
-from fastapi import FastAPI, File, Form, UploadFile
-from fastapi.responses import HTMLResponse
-import google.generativeai as genai
-from google.oauth2 import service_account
+from fastapi import FastAPI, File, Form, Header, Response, UploadFile
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 import json
-import PIL.Image
+import logging
 from pydantic import BaseModel, Field
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
-from vertexai.preview.vision_models import Image, ImageCaptioningModel, ImageTextModel
 import os
 from dotenv import load_dotenv
 load_dotenv()
-from typing_extensions import Annotated
-from uuid_extensions import uuid7, uuid7str
+from typing_extensions import Annotated, Literal, Optional
+from .classes.AdmissionController import ModelSaturatedError
 from .classes.ContentGenerator import ContentGenerator
+from .classes.ImagePostprocessor import IMAGE_VARIANTS
+from .classes.MetricsMiddleware import MetricsMiddleware
+from .classes.RequestProfiler import RequestProfiler
+from .classes.RequestTiming import record_outcome
+from .classes.UploadSizeLimitMiddleware import UploadSizeLimitMiddleware
+
+logger = logging.getLogger(__name__)
 
 content_generator = ContentGenerator()
+request_profiler = RequestProfiler()
+MODEL_WARM_UP = os.environ.get("MODEL_WARM_UP", "true").lower() != "false"
+
+"""
+Function to manage the application lifespan
+Starts loading the models in the background (unless MODEL_WARM_UP is "false") so the worker accepts
+traffic immediately, keeps retrying the loads that failed, and releases the worker pools on shutdown
+"""
+@asynccontextmanager
+async def lifespan(app):
+    background_tasks = [asyncio.create_task(content_generator.retry_failed_loads())]
+    if MODEL_WARM_UP:
+        background_tasks.append(asyncio.create_task(content_generator.warm_up()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    content_generator.image_jobs.shutdown()
+    await content_generator.backend.close()
+    content_generator.backend.shutdown()
+    content_generator.image_preprocessor.process_executor.shutdown(wait=False, cancel_futures=True)
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+"""
+Function to answer requests rejected by admission control with a real 429/503 and Retry-After
+"""
+@app.exception_handler(ModelSaturatedError)
+async def model_saturated_handler(request, error):
+    record_outcome("rejected")
+    return JSONResponse(
+        status_code=error.status_code,
+        headers={"Retry-After": str(error.retry_after)},
+        content={
+            "error": str(error),
+            "timestamp": int(datetime.datetime.now().timestamp())
+        }
+    )
+
+# Reject oversized uploads and files that are not acceptable images before FastAPI spools the multipart body
+# The allowance on top of the image cap covers the multipart boundaries and the other form fields
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    paths=["/generate-image-captions", "/generate-text-from-image", "/generate-text-from-image-stream"],
+    max_body_bytes=content_generator.image_validator.max_image_bytes + 64 * 1024,
+    image_validator=content_generator.image_validator,
+)
+
+# Time every request (outermost, so rejected uploads are counted too), add Server-Timing and feed /metrics
+app.add_middleware(
+    MetricsMiddleware,
+    metrics=content_generator.metrics,
+    profiler=request_profiler,
+)
+
+"""
+Function to record whether a content generator result is a response, warnings or an error
+Parameters:
+    - response: dict returned by the content generator
+"""
+def record_response_outcome(response):
+    if "response" in response:
+        record_outcome("response")
+    elif "warnings" in response:
+        record_outcome("warnings")
+    else:
+        record_outcome("error")
 
 
 # Class that provides prompt for text generation
 class TextPrompt(BaseModel):
     prompt: str = Field(description="Field for text prompt")
     content_type: str = Field(description="Field for generated text content type (story, poem or song)")
+    bypass_cache: bool = Field(default=False, description="Field to skip cached results and force a fresh generation")
+
+# Class that provides an asynchronous image generation job
+class ImageGenerationJobRequest(BaseModel):
+    prompt: str = Field(description="Field for text prompt to generate image")
+    style: str = Field(description="Field for key generated image style")
+    orientation: str = Field(description="Field for key of generated image orientation")
+    webhook_url: Optional[str] = Field(default=None, description="Field for an http(s) URL notified with the job status when the job ends")
+
+# Class that provides a batch of prompts for text generation
+class TextPromptBatch(BaseModel):
+    items: list[TextPrompt] = Field(
+        min_length=1,
+        max_length=int(os.environ.get("BATCH_MAX_ITEMS", "500")),
+        description="Field for the prompts to generate text content for"
+    )
 
 # Class that provides prompt for image generation
 class ImageGenerationPrompt(BaseModel):
     prompt: str = Field(description="Field for text prompt to generate image")
     style: str = Field(description="Field for key generated image style")
     orientation: str = Field(description="Field for key of generated image orientation")
+    delivery: Literal["base64", "url"] = Field(default="base64", description="Field for how images are returned (inline base 64 strings or URLs of the image route)")
+    variants: Optional[list[Literal[IMAGE_VARIANTS]]] = Field(default=None, min_length=1, description="Field for the variants returned for each image (original, stripped, webp, avif, thumbnail)")
 
 @app.get("/", response_class=HTMLResponse)
 async def root():
@@ -46,6 +134,134 @@ async def root():
     </html>
     """
 
+"""
+GET Request for liveness: the worker is up and serving requests
+"""
+@app.get("/healthz")
+async def liveness_endpoint():
+    return {
+        "status": "ok",
+        "timestamp": int(datetime.datetime.now().timestamp())
+    }
+
+"""
+GET Request for readiness: reports which models are loaded and whether the image process pool works
+503 until all models are loaded (with MODEL_WARM_UP "false", while a model has failed to load, since models
+not tried yet load on first use), or while the process pool cannot run a task
+Failed loads are retried in the background, so the worker becomes ready without needing traffic
+"""
+@app.get("/readyz")
+async def readiness_endpoint():
+    models = content_generator.model_status()
+    process_pool_healthy = await content_generator.image_preprocessor.check_process_pool()
+    if MODEL_WARM_UP:
+        models_ready = all(model["ready"] for model in models.values())
+    else:
+        models_ready = all(model["ready"] or model["error"] is None for model in models.values())
+    ready = models_ready and process_pool_healthy
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "models": models,
+            "image_process_pool": {
+                "healthy": process_pool_healthy,
+                "restarts": content_generator.image_preprocessor.process_pool_restarts,
+            },
+            "import_seconds": IMPORT_SECONDS,
+            "timestamp": int(datetime.datetime.now().timestamp())
+        }
+    )
+
+"""
+Function to format a server-sent event
+Parameters:
+    - event: event name
+    - data: JSON-serialisable event payload
+"""
+def format_server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+"""
+Function to convert a stream of content generator chunks into server-sent events
+Each text chunk is sent as a "response" event, followed by a final "done", "warnings" or "error" event
+Parameters:
+    - first_chunk: chunk already read from the generator (None if it was empty)
+    - chunks: async iterator of dicts yielded by the content generator
+"""
+async def stream_server_sent_events(first_chunk, chunks):
+    async def all_chunks():
+        if first_chunk is not None:
+            yield first_chunk
+        async for chunk in chunks:
+            yield chunk
+
+    async for chunk in all_chunks():
+        if "response" in chunk:
+            yield format_server_sent_event("response", {"response": chunk["response"]})
+        elif "warnings" in chunk:
+            record_outcome("warnings")
+            yield format_server_sent_event("warnings", {"warnings": chunk["warnings"], "timestamp": int(datetime.datetime.now().timestamp())})
+            return
+        else:
+            record_outcome("error")
+            yield format_server_sent_event("error", {"error": chunk["error"], "timestamp": int(datetime.datetime.now().timestamp())})
+            return
+    yield format_server_sent_event("done", {"timestamp": int(datetime.datetime.now().timestamp())})
+
+"""
+Function to build a server-sent event response from a content generator stream
+The first chunk is read before the response starts, so a saturated model is answered with 429/503
+instead of a stream that fails after the 200 status has been sent
+Parameters:
+    - chunks: async iterator of dicts yielded by the content generator
+"""
+async def server_sent_event_response(chunks):
+    first_chunk = await anext(chunks, None)
+    return StreamingResponse(
+        stream_server_sent_events(first_chunk, chunks),
+        media_type="text/event-stream",
+        headers=SERVER_SENT_EVENT_HEADERS,
+    )
+
+# Headers that stop proxies from buffering server-sent events
+SERVER_SENT_EVENT_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+"""
+GET Request to expose the Prometheus metrics
+"""
+@app.get("/metrics")
+async def metrics_endpoint():
+    body, media_type = content_generator.metrics.render()
+    return Response(content=body, media_type=media_type)
+
+"""
+GET Request to report runtime statistics of the content generation pipeline
+"""
+@app.get("/stats")
+async def stats_endpoint():
+    return {
+        "admission": content_generator.admission.stats(),
+        "resilience": content_generator.resilience.stats(),
+        "routing": content_generator.router.stats(),
+        "image_preprocessing": content_generator.image_preprocessor.stats(),
+        "text_response_cache": content_generator.text_response_cache.stats(),
+        "image_result_cache": content_generator.image_result_cache.stats(),
+        "image_blob_store": await content_generator.image_blob_store.stats(),
+        "text_coalescing": content_generator.text_single_flight.stats(),
+        "image_generation_coalescing": content_generator.image_generation_single_flight.stats(),
+        "image_jobs": content_generator.image_jobs.stats(),
+        "safety": content_generator.safety_screen.stats(),
+        "image_postprocessing": content_generator.image_postprocessor.stats(),
+        "profiler": request_profiler.stats(),
+        "backend": content_generator.backend.stats(),
+        "worker_pid": os.getpid(),
+        "timestamp": int(datetime.datetime.now().timestamp())
+    }
+
 """
 POST Request to generate text content with given prompt
 Payload Type: Application/JSON
@@ -57,7 +273,8 @@ Payload Type: Application/JSON
 async def generate_text_content_endpoint(prompt: TextPrompt):
     try:
         # Get text content generated from prompt
-        response = content_generator.generate_text_content(prompt.prompt, prompt.content_type)
+        response = await content_generator.generate_text_content(prompt.prompt, prompt.content_type, prompt.bypass_cache)
+        record_response_outcome(response)
 
         # Return successful response
         if "response" in response.keys():
@@ -69,7 +286,7 @@ async def generate_text_content_endpoint(prompt: TextPrompt):
         # Return warning response
         elif "warnings" in response.keys():
             return {
-                "warnings": response["response"],
+                "warnings": response["warnings"],
                 "timestamp": int(datetime.datetime.now().timestamp())
             }
         
@@ -80,13 +297,64 @@ async def generate_text_content_endpoint(prompt: TextPrompt):
                 "timestamp": int(datetime.datetime.now().timestamp())
             }
 
+    # Let saturation errors reach the 429/503 handler
+    except ModelSaturatedError:
+        raise
+
     # Return exception error response
     except Exception as error:
+        record_outcome("error")
         return {
             "error": str(error),
             "timestamp": int(datetime.datetime.now().timestamp())
         }
 
+"""
+POST Request to stream generated text content for a given prompt as server-sent events
+Payload Type: Application/JSON (same as /generate-text)
+Response Type: text/event-stream
+    - "response" events carry partial text as soon as the model produces it
+    - a final "done", "warnings" or "error" event ends the stream
+Disconnecting the client cancels the upstream model stream
+"""
+@app.post("/generate-text-stream")
+async def generate_text_content_stream_endpoint(prompt: TextPrompt):
+    chunks = content_generator.stream_text_content(prompt.prompt, prompt.content_type, prompt.bypass_cache)
+    return await server_sent_event_response(chunks)
+
+"""
+POST Request to generate text content for a batch of prompts
+Payload Type: Application/JSON
+    {
+        "items": list of /generate-text payloads
+    }
+Response Type: application/x-ndjson, one JSON line per item in completion order:
+    - {"index": position of the item, "response" | "warnings" | "error": ...}
+      (items still saturated after the batch retries also carry "status_code" and "retry_after")
+    - a final {"summary": {"items", "responses", "warnings", "errors"}, "timestamp"} line
+Items are generated with bounded concurrency in the batch admission lane, behind interactive traffic
+"""
+@app.post("/generate-text-batch")
+async def generate_text_batch_endpoint(batch: TextPromptBatch):
+    items = [(item.prompt, item.content_type, item.bypass_cache) for item in batch.items]
+
+    async def ndjson_lines():
+        summary = {"items": len(items), "responses": 0, "warnings": 0, "errors": 0}
+        async for result in content_generator.generate_text_batch(items):
+            if "response" in result:
+                summary["responses"] += 1
+            elif "warnings" in result:
+                summary["warnings"] += 1
+            else:
+                summary["errors"] += 1
+            yield json.dumps(result) + "\n"
+        yield json.dumps({
+            "summary": summary,
+            "timestamp": int(datetime.datetime.now().timestamp())
+        }) + "\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
 """
 POST Request to generate captions for a provided image
 Payload Type: Multipart/form-data
@@ -98,11 +366,13 @@ async def generate_image_captions_endpoint(image: Annotated[UploadFile, Form()])
     try:
         # Get response for image captions
         response = await content_generator.generate_image_captions(image)
+        record_response_outcome(response)
 
         # Return successful response
         if "response" in response.keys():
             return {
                 "response": response["response"],
+                "image_bytes": response["image_bytes"],
                 "timestamp": int(datetime.datetime.now().timestamp())
             }
         
@@ -120,8 +390,13 @@ async def generate_image_captions_endpoint(image: Annotated[UploadFile, Form()])
                 "timestamp": int(datetime.datetime.now().timestamp())
             }
 
+    # Let saturation errors reach the 429/503 handler
+    except ModelSaturatedError:
+        raise
+
     # Return exception error response
     except Exception as error:
+        record_outcome("error")
         return {
             "error": str(error),
             "timestamp": int(datetime.datetime.now().timestamp())
@@ -144,11 +419,13 @@ async def generate_text_from_image_endpoint(
     try:
         # Get response for image captions
         response = await content_generator.generate_text_from_image(image, content_type, prompt)
+        record_response_outcome(response)
 
         # Return successful response
         if "response" in response.keys():
             return {
                 "response": response["response"],
+                "image_bytes": response["image_bytes"],
                 "timestamp": int(datetime.datetime.now().timestamp())
             }
         
@@ -166,30 +443,84 @@ async def generate_text_from_image_endpoint(
                 "timestamp": int(datetime.datetime.now().timestamp())
             }
 
+    # Let saturation errors reach the 429/503 handler
+    except ModelSaturatedError:
+        raise
+
     # Return exception error response
     except Exception as error:
+        record_outcome("error")
         return {
             "error": str(error),
             "timestamp": int(datetime.datetime.now().timestamp())
         }
     
+"""
+POST Request to stream generated text for a provided image as server-sent events
+Payload Type: Multipart/form-data (same as /generate-text-from-image)
+Response Type: text/event-stream (same events as /generate-text-stream)
+"""
+@app.post("/generate-text-from-image-stream")
+async def generate_text_from_image_stream_endpoint(
+    image: Annotated[UploadFile, Form()], 
+    content_type: Annotated[str, Form()], 
+    prompt: Annotated[str, Form()]
+):
+    # Read and validate the upload before the response starts, while the file is still open
+    upload = await content_generator.image_validator.read_upload(image)
+    chunks = content_generator.stream_text_from_image(upload, content_type, prompt)
+    return await server_sent_event_response(chunks)
+
 """
 POST Request to generate image for a provided text
 Payload Type: Application/JSON
 {
     "prompt": represents text prompt to assist in generating text content,
     "style": represents key for art style,
-    "orientation": represents key for image orientation
+    "orientation": represents key for image orientation,
+    "delivery": optional, "base64" (default) for inline images or "url" for {id, url} entries served by GET /images/{id},
+    "variants": optional list of "original", "stripped", "webp", "avif" and "thumbnail"; each image is then returned as
+                {variant: {"media_type", "data"}} (base64) or {variant: {"media_type", "id", "url"}} (url) with only those variants
 }
 """
 @app.post("/generate-image-from-text")
 async def generate_image_from_text_endpoint(prompt: ImageGenerationPrompt):
     try:
         # Get response for image captions
-        response = await content_generator.generate_image_from_text(prompt.prompt, prompt.style, prompt.orientation)
+        response = await content_generator.generate_image_from_text(prompt.prompt, prompt.style, prompt.orientation, prompt.delivery, prompt.variants)
+        record_response_outcome(response)
+
+        # Return successful response with the URLs of each image's variants when images are delivered from the image route
+        if "response" in response.keys() and prompt.delivery == "url" and prompt.variants is not None:
+            return {
+                "response": [
+                    {
+                        variant: {
+                            **entry,
+                            "url": f"/images/{entry['id']}"
+                        }
+                        for variant, entry in image.items()
+                    }
+                    for image in response["response"]
+                ],
+                "timestamp": int(datetime.datetime.now().timestamp())
+            }
+
+        # Return successful response with the image URLs when images are delivered from the image route
+        elif "response" in response.keys() and prompt.delivery == "url":
+            return {
+                "response": [
+                    {
+                        "id": image_id,
+                        "url": f"/images/{image_id}"
+                    }
+                    for image_id in response["response"]
+                ],
+                "timestamp": int(datetime.datetime.now().timestamp())
+            }
 
         # Return successful response
-        if "response" in response.keys():
+        elif "response" in response.keys():
             return {
                 "response": response["response"],
                 "timestamp": int(datetime.datetime.now().timestamp())
@@ -209,9 +540,132 @@ async def generate_image_from_text_endpoint(prompt: ImageGenerationPrompt):
                 "timestamp": int(datetime.datetime.now().timestamp())
             }
 
+    # Let saturation errors reach the 429/503 handler
+    except ModelSaturatedError:
+        raise
+
     # Return exception error response
     except Exception as error:
+        record_outcome("error")
         return {
             "error": str(error),
             "timestamp": int(datetime.datetime.now().timestamp())
-        }
\ No newline at end of file
+        }
+
+"""
+POST Request to submit an image generation job
+Payload Type: Application/JSON
+{
+    "prompt", "style", "orientation": same as /generate-image-from-text,
+    "webhook_url": optional URL that receives a POST with the job status (as returned by GET /image-jobs/{job_id}) when the job ends
+}
+Returns 202 with the job id and status URL straight away; 429 with Retry-After when too many jobs are queued;
+422 with warnings when the webhook URL is not allowed (or resolves to a loopback, private or link-local address) or the prompt is known to be blocked by the safety filters
+"""
+@app.post("/image-jobs", status_code=202)
+async def submit_image_job_endpoint(prompt: ImageGenerationJobRequest, response: Response):
+    try:
+        # Prompts known to be blocked are rejected before taking a place in the queue
+        content_generator.screen_image_prompt(prompt.prompt, prompt.style, prompt.orientation)
+        job = await content_generator.image_jobs.submit(
+            {
+                "prompt": prompt.prompt,
+                "style": prompt.style,
+                "orientation": prompt.orientation,
+            },
+            prompt.webhook_url,
+        )
+    except ValueError as error:
+        record_outcome("warnings")
+        return JSONResponse(
+            status_code=422,
+            content={
+                "warnings": [str(error)],
+                "timestamp": int(datetime.datetime.now().timestamp())
+            }
+        )
+
+    response.headers["Location"] = f"/image-jobs/{job['job_id']}"
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "status_url": f"/image-jobs/{job['job_id']}",
+        "timestamp": int(datetime.datetime.now().timestamp())
+    }
+
+"""
+GET Request to poll an image generation job
+Returns the status (queued, running, succeeded or failed), the images finished so far as {id, url} entries
+served by GET /images/{id}, and warnings or an error; 404 once the job is unknown or expired
+While the job is queued or running a Retry-After header suggests when to poll again
+"""
+@app.get("/image-jobs/{job_id}")
+async def image_job_status_endpoint(job_id: str, response: Response):
+    job = await content_generator.image_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "error": "Job not found or expired.",
+                "timestamp": int(datetime.datetime.now().timestamp())
+            }
+        )
+
+    if job["status"] in ("queued", "running"):
+        response.headers["Retry-After"] = "2"
+    return {
+        **content_generator.image_jobs.describe(job),
+        "timestamp": int(datetime.datetime.now().timestamp())
+    }
+
+"""
+Function to check whether an If-None-Match header matches an entity tag
+The header is a comma-separated list of entity tags, compared weakly (W/ prefixes are ignored), or "*"
+Parameters:
+    - if_none_match: value of the If-None-Match header
+    - entity_tag: opaque tag of the resource, without quotes
+"""
+def if_none_match_matches(if_none_match, entity_tag):
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if len(candidate) >= 2 and candidate.startswith('"') and candidate.endswith('"') and candidate[1:-1] == entity_tag:
+            return True
+    return False
+
+"""
+GET Request to download a generated image delivered by URL
+The image id is the SHA-256 of its bytes, so the content never changes and can be cached indefinitely
+"""
+@app.get("/images/{image_id}")
+async def get_image_endpoint(image_id: str, if_none_match: Annotated[str | None, Header()] = None):
+    blob = await content_generator.image_blob_store.get(image_id)
+    if blob is None:
+        return Response(status_code=404)
+
+    headers = {
+        "Cache-Control": f"public, max-age={int(content_generator.image_blob_store.ttl_seconds)}, immutable",
+        "ETag": f'"{image_id}"',
+    }
+
+    # Tell clients that already have the image to reuse it
+    if if_none_match is not None and if_none_match_matches(if_none_match, image_id):
+        return Response(status_code=304, headers=headers)
+
+    # Stream the image in chunks from the stored buffer without copying it
+    image_buffer = memoryview(blob["data"])
+    def iterate_chunks():
+        for offset in range(0, len(image_buffer), 64 * 1024):
+            yield image_buffer[offset:offset + 64 * 1024]
+
+    headers["Content-Length"] = str(len(image_buffer))
+    return StreamingResponse(iterate_chunks(), media_type=blob["media_type"], headers=headers)
+
+# Measure how long importing the application took and warn when it exceeds the cold start budget
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED_AT
+IMPORT_TIME_BUDGET_SECONDS = float(os.environ.get("IMPORT_TIME_BUDGET_SECONDS", "1.0"))
+if IMPORT_SECONDS > IMPORT_TIME_BUDGET_SECONDS:
+    logger.warning("Importing the application took %.3fs, above the %.3fs budget", IMPORT_SECONDS, IMPORT_TIME_BUDGET_SECONDS)
@@ -0,0 +1,161 @@
+"""
+Multi-process server: prepares the read-only state once, then forks uvicorn workers that share one listening socket
+
+    python -m app.serve --workers 4 --host 0.0.0.0 --port 8000
+
+The parent imports the application modules and the model SDKs, decodes the service account key and initialises
+the SDKs before forking, so the workers inherit them instead of repeating the work. Nothing that holds
+connections, threads or processes (model clients, pools, SQLite connections) is created before the fork: each
+worker builds its own when it imports app.main
+
+State that must be consistent across workers (result caches, generated images, admission slots and the image job
+table) is kept in SQLite databases in WAL mode under SHARED_STATE_DIR. Workers that exit unexpectedly are replaced
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import time
+
+logger = logging.getLogger("app.serve")
+
+"""
+Function to parse the command line
+"""
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Serve the API with several pre-forked worker processes")
+    parser.add_argument("--host", default=os.environ.get("HOST", "127.0.0.1"), help="address to listen on")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")), help="port to listen on")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", str(os.cpu_count() or 1))), help="worker processes")
+    parser.add_argument("--state-dir", default=os.environ.get("SHARED_STATE_DIR", "state"), help="directory of the state shared by the workers")
+    parser.add_argument("--backlog", type=int, default=2048, help="listen backlog of the shared socket")
+    parser.add_argument("--log-level", default="info", help="uvicorn log level")
+    return parser.parse_args()
+
+"""
+Function to prepare the state inherited by the workers
+Parameters:
+    - arguments: parsed command line
+"""
+def preload(arguments):
+    # Shared state and pool sizes are read from the environment when the workers build the application
+    os.environ["SHARED_STATE_DIR"] = arguments.state_dir
+    os.environ.setdefault("IMAGE_PROCESS_POOL_SIZE", str(max(1, (os.cpu_count() or 1) // arguments.workers)))
+    os.makedirs(arguments.state_dir, exist_ok=True)
+
+    # Import the web framework and the application modules without building the application
+    import fastapi
+    import uvicorn
+    from .classes import ContentGenerator
+
+    if os.environ.get("MODEL_BACKEND", "vertex").strip().lower() == "vertex":
+        from .classes.VertexBackend import preload_clients
+        started_at = time.perf_counter()
+        preload_clients()
+        logger.info("Preloaded model SDKs and credentials in %.3fs", time.perf_counter() - started_at)
+
+"""
+Function to create the listening socket shared by the workers
+Parameters:
+    - arguments: parsed command line
+"""
+def bind_socket(arguments):
+    family = socket.AF_INET6 if ":" in arguments.host else socket.AF_INET
+    listening_socket = socket.socket(family, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind((arguments.host, arguments.port))
+    listening_socket.listen(arguments.backlog)
+    listening_socket.set_inheritable(True)
+    return listening_socket
+
+"""
+Function run in a forked worker: build the application and serve it on the shared socket
+Parameters:
+    - arguments: parsed command line
+    - listening_socket: socket created by the parent
+"""
+def run_worker(arguments, listening_socket):
+    import uvicorn
+
+    # Let uvicorn install its own handlers for a graceful shutdown
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    from .main import app
+    config = uvicorn.Config(app, log_level=arguments.log_level, lifespan="on")
+    uvicorn.Server(config).run(sockets=[listening_socket])
+
+"""
+Function to fork a worker and return its pid
+Parameters:
+    - arguments: parsed command line
+    - listening_socket: socket created by the parent
+"""
+def start_worker(arguments, listening_socket):
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            run_worker(arguments, listening_socket)
+        except BaseException:
+            logger.exception("Worker %s failed", os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    logger.info("Started worker %s", pid)
+    return pid
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    arguments = parse_arguments()
+    preload(arguments)
+    listening_socket = bind_socket(arguments)
+    logger.info("Listening on %s:%s with %s workers", arguments.host, arguments.port, arguments.workers)
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    workers = {start_worker(arguments, listening_socket) for _ in range(arguments.workers)}
+    restarts = []
+
+    # Replace workers that exit while serving, backing off when they keep failing
+    while not stopping:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        workers.discard(pid)
+        if stopping:
+            break
+        logger.warning("Worker %s exited with status %s, starting a new one", pid, status)
+        now = time.monotonic()
+        restarts = [restarted_at for restarted_at in restarts if now - restarted_at < 60] + [now]
+        if len(restarts) > 2 * arguments.workers:
+            time.sleep(5)
+        workers.add(start_worker(arguments, listening_socket))
+
+    # Stop the workers gracefully (uvicorn drains the open requests), then wait for them
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    listening_socket.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Micro-benchmark of the per-call overhead of upstream clients, before and after pooling
+
+Two measurements, both local so no model quota or network access is needed:
+    - setup: the client set-up that used to run on every text generation call (genai.configure and a new
+      GenerativeModel, which also drops the cached Google AI clients) against reusing the loaded model
+    - connection: a unary call to a local TLS gRPC server over a new channel per call (DNS, TCP, TLS and
+      HTTP/2 set-up on every call) against one long-lived channel with the options of UpstreamChannels
+
+    python benchmarks/client_overhead.py --calls 200
+    python benchmarks/client_overhead.py --calls 500 --json overhead.json
+
+The connection numbers are a lower bound: on a real network every handshake round trip adds the latency to the API
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+"""
+Function to parse the command line
+"""
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Measure the per-call overhead of upstream clients")
+    parser.add_argument("--calls", type=int, default=200, help="calls measured per variant")
+    parser.add_argument("--payload-bytes", type=int, default=2048, help="size of the request sent to the local server")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this JSON file")
+    return parser.parse_args()
+
+"""
+Function to summarise per-call durations in milliseconds
+Parameters:
+    - name: variant name
+    - durations: per-call durations in seconds
+"""
+def summarise(name, durations):
+    durations = sorted(durations)
+    return {
+        "variant": name,
+        "calls": len(durations),
+        "mean_ms": round(statistics.fmean(durations) * 1000, 3),
+        "p50_ms": round(durations[len(durations) // 2] * 1000, 3),
+        "p95_ms": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000, 3),
+    }
+
+"""
+Function to time the client set-up removed from the text generation hot path
+Parameters:
+    - calls: number of calls measured per variant
+"""
+def measure_setup(calls):
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        import google.generativeai as genai
+        from google.generativeai import client
+
+    # Before: configure the SDK and build a model on every call (configure drops the cached clients)
+    before = []
+    for _ in range(calls):
+        started_at = time.perf_counter()
+        genai.configure(api_key="benchmark")
+        genai.GenerativeModel("gemini-pro-vision")
+        client.get_default_generative_async_client()
+        before.append(time.perf_counter() - started_at)
+
+    # After: the loaded model and its client are reused
+    model = genai.GenerativeModel("gemini-pro-vision")
+    model._async_client = client.get_default_generative_async_client()
+    after = []
+    for _ in range(calls):
+        started_at = time.perf_counter()
+        model._async_client
+        after.append(time.perf_counter() - started_at)
+
+    return [summarise("setup_per_call", before), summarise("setup_reused", after)]
+
+"""
+Function to create a self-signed certificate for localhost
+Returns (certificate PEM, private key PEM)
+"""
+def make_certificate():
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=1))
+        .not_valid_after(now + datetime.timedelta(hours=1))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost")]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    return (
+        certificate.public_bytes(serialization.Encoding.PEM),
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()),
+    )
+
+"""
+Function to time unary calls to a local TLS gRPC server over new and long-lived channels
+Parameters:
+    - calls: number of calls measured per variant
+    - payload_bytes: size of each request
+"""
+async def measure_connection(calls, payload_bytes):
+    import grpc
+    from app.classes.UpstreamChannels import UpstreamChannels
+
+    certificate, private_key = make_certificate()
+
+    async def echo(request, context):
+        return request
+
+    server = grpc.aio.server()
+    server.add_generic_rpc_handlers((
+        grpc.method_handlers_generic_handler("benchmark.Echo", {"Call": grpc.unary_unary_rpc_method_handler(echo)}),
+    ))
+    port = server.add_secure_port("localhost:0", grpc.ssl_server_credentials([(private_key, certificate)]))
+    await server.start()
+
+    target = f"localhost:{port}"
+    channel_credentials = grpc.ssl_channel_credentials(root_certificates=certificate)
+    payload = os.urandom(payload_bytes)
+
+    async def call(channel):
+        started_at = time.perf_counter()
+        await channel.unary_unary("/benchmark.Echo/Call")(payload)
+        return time.perf_counter() - started_at
+
+    try:
+        # Before: a new channel per call pays for the TCP, TLS and HTTP/2 set-up every time
+        before = []
+        for _ in range(calls):
+            started_at = time.perf_counter()
+            channel = grpc.aio.secure_channel(target, channel_credentials)
+            await call(channel)
+            before.append(time.perf_counter() - started_at)
+            await channel.close()
+
+        # After: one long-lived channel opened before the calls, as warm_up does
+        channel = grpc.aio.secure_channel(target, channel_credentials, options=UpstreamChannels().channel_options())
+        await channel.channel_ready()
+        after = [await call(channel) for _ in range(calls)]
+        await channel.close()
+    finally:
+        await server.stop(None)
+
+    return [summarise("connection_per_call", before), summarise("connection_reused", after)]
+
+async def main(arguments):
+    results = measure_setup(arguments.calls) + await measure_connection(arguments.calls, arguments.payload_bytes)
+
+    print(f"{'variant':<22}{'calls':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for result in results:
+        print(f"{result['variant']:<22}{result['calls']:>7}{result['mean_ms']:>10}{result['p50_ms']:>10}{result['p95_ms']:>10}")
+    by_variant = {result["variant"]: result for result in results}
+    for kind in ("setup", "connection"):
+        saved = by_variant[f"{kind}_per_call"]["mean_ms"] - by_variant[f"{kind}_reused"]["mean_ms"]
+        print(f"{kind} overhead removed per call: {saved:.3f} ms")
+
+    if arguments.json_path:
+        with open(arguments.json_path, "w") as json_file:
+            json.dump({"calls": arguments.calls, "results": results}, json_file, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_arguments()))
@@ -0,0 +1,327 @@
+"""
+Load test of the generation endpoints
+
+By default the application is driven in-process through httpx.ASGITransport with MODEL_BACKEND=simulator,
+so no model quota is used and the numbers are reproducible on a plain Linux box:
+
+    python benchmarks/load_test.py --concurrency 32 --requests 200
+    python benchmarks/load_test.py --scenario text --unique --json results.json
+
+Pass --url to drive a running server instead (its backend is whatever that server was started with):
+
+    python benchmarks/load_test.py --url http://localhost:8000 --concurrency 8
+
+Reports throughput, p50/p95/p99 latency and errors per scenario, the peak RSS of the process and, for in-process
+runs on Linux, the largest peak RSS of the image preprocessing workers. The workers are started by a fork server,
+so they are not children of this process and getrusage(RUSAGE_CHILDREN) never sees them: the descendants of the
+process are found in /proc and their peak RSS (VmHWM) is sampled while the scenarios run
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+SCENARIOS = ("text", "text_batch", "captions", "text_from_image", "image_generation")
+
+# Simulator latencies used by default, a tenth of the real medians so a run takes seconds
+DEFAULT_SIMULATOR_ENVIRONMENT = {
+    "MODEL_BACKEND": "simulator",
+    "MODEL_WARM_UP": "false",
+    "SIMULATOR_GEMINI_MODEL_LATENCY_SECONDS": "0.2",
+    "SIMULATOR_VERTEX_PRO_VISION_MODEL_LATENCY_SECONDS": "0.25",
+    "SIMULATOR_VERTEX_TEXT_MODEL_LATENCY_SECONDS": "0.15",
+    "SIMULATOR_VERTEX_IMAGE_CAPTIONING_MODEL_LATENCY_SECONDS": "0.08",
+    "SIMULATOR_VERTEX_IMAGE_GENERATION_MODEL_LATENCY_SECONDS": "0.8",
+}
+
+# Prompt of each scenario, so that a scenario never hits the results cached by another one
+# (text and text_batch items share the text result cache)
+PROMPTS = {
+    "text": "a lighthouse on a cliff at dawn, variation {variant}",
+    "text_batch": "a harbour market at dusk, batch item {variant}",
+    "captions": "a lighthouse on a cliff at dawn, variation {variant}",
+    "text_from_image": "describe the shapes in this picture, variation {variant}",
+    "image_generation": "a lighthouse on a cliff at dawn, variation {variant}",
+}
+
+"""
+Function to parse the command line
+"""
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Load test the generation endpoints")
+    parser.add_argument("--url", help="base URL of a running server (default: drive the app in-process with the simulator)")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all", help="endpoint to drive")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight per scenario")
+    parser.add_argument("--requests", type=int, default=100, help="requests (items for text_batch) sent per scenario")
+    parser.add_argument("--batch-size", type=int, default=50, help="items per /generate-text-batch request")
+    parser.add_argument("--unique", action="store_true", help="make every prompt and image unique so caches and coalescing never hit")
+    parser.add_argument("--image-size", type=int, default=1024, help="longer side of the uploaded test images")
+    parser.add_argument("--seed", type=int, default=1234, help="seed of the request payloads (and of the simulator)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="per-request timeout in seconds")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this JSON file")
+    return parser.parse_args()
+
+"""
+Function to render a JPEG test image
+Parameters:
+    - rng: random generator
+    - size: longer side of the image
+"""
+def make_test_image(rng, size):
+    from PIL import Image, ImageDraw
+    width, height = size, size * 3 // 4
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle([x, y, x + rng.randrange(20, width // 3), y + rng.randrange(20, height // 3)], fill=colour)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+"""
+Function to build the payloads of a scenario, rendered before the clock starts
+Parameters:
+    - scenario: name of the scenario
+    - arguments: parsed command line
+    - rng: random generator
+"""
+def build_payloads(scenario, arguments, rng):
+    distinct = arguments.requests if arguments.unique else min(arguments.requests, 8)
+    payloads = []
+    if scenario in ("captions", "text_from_image"):
+        images = [make_test_image(rng, arguments.image_size) for _ in range(distinct)]
+    for index in range(arguments.requests):
+        variant = index % distinct
+        prompt = PROMPTS[scenario].format(variant=variant)
+        if scenario == "text":
+            payloads.append(("/generate-text", {"json": {"prompt": prompt, "content_type": "1"}}))
+        elif scenario == "text_batch":
+            if index % arguments.batch_size == 0:
+                payloads.append(("/generate-text-batch", {"json": {"items": []}}))
+            payloads[-1][1]["json"]["items"].append({"prompt": prompt, "content_type": "1"})
+        elif scenario == "captions":
+            payloads.append(("/generate-image-captions", {"files": {"image": ("image.jpg", images[variant], "image/jpeg")}}))
+        elif scenario == "text_from_image":
+            payloads.append((
+                "/generate-text-from-image",
+                {
+                    "files": {"image": ("image.jpg", images[variant], "image/jpeg")},
+                    "data": {"content_type": "2", "prompt": prompt},
+                },
+            ))
+        else:
+            payloads.append(("/generate-image-from-text", {"json": {"prompt": prompt, "style": "1", "orientation": "1"}}))
+    return payloads
+
+"""
+Function to return the value at a percentile of sorted samples (nearest rank)
+Parameters:
+    - samples: sorted latencies
+    - percentile: percentile between 0 and 100
+"""
+def percentile_of(samples, percentile):
+    if not samples:
+        return 0.0
+    rank = max(1, int(round(percentile / 100 * len(samples) + 0.5)))
+    return samples[min(rank, len(samples)) - 1]
+
+"""
+Function to send the requests of one scenario with bounded concurrency and summarise them
+Parameters:
+    - client: httpx.AsyncClient
+    - scenario: name of the scenario
+    - payloads: list of (path, request keyword arguments)
+    - concurrency: requests in flight
+"""
+async def run_scenario(client, scenario, payloads, concurrency):
+    queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+    latencies = []
+    errors = {}
+    response_bytes = 0
+
+    async def worker():
+        nonlocal response_bytes
+        while not queue.empty():
+            path, request_arguments = queue.get_nowait()
+            started_at = time.perf_counter()
+            try:
+                response = await client.post(path, **request_arguments)
+                body = response.content
+                latencies.append(time.perf_counter() - started_at)
+                response_bytes += len(body)
+                if response.status_code != 200:
+                    kind = f"http_{response.status_code}"
+                elif response.headers.get("content-type", "").startswith("application/x-ndjson"):
+                    # Batches end with a summary line counting the items that failed
+                    summary = json.loads(body.splitlines()[-1])["summary"]
+                    if summary["warnings"] == 0 and summary["errors"] == 0:
+                        continue
+                    kind = "error_body"
+                elif b'"error"' in body or b'"warnings"' in body:
+                    kind = "error_body"
+                else:
+                    continue
+            except Exception as error:
+                latencies.append(time.perf_counter() - started_at)
+                kind = type(error).__name__
+            errors[kind] = errors.get(kind, 0) + 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed_seconds = time.perf_counter() - started_at
+
+    latencies.sort()
+    items = sum(len(request_arguments.get("json", {}).get("items", [None])) for _, request_arguments in payloads)
+    return {
+        "scenario": scenario,
+        "requests": len(payloads),
+        "items": items,
+        "items_per_second": round(items / elapsed_seconds, 2) if elapsed_seconds else 0.0,
+        "concurrency": concurrency,
+        "errors": errors,
+        "elapsed_seconds": round(elapsed_seconds, 3),
+        "throughput_per_second": round(len(payloads) / elapsed_seconds, 2) if elapsed_seconds else 0.0,
+        "p50_ms": round(percentile_of(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile_of(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile_of(latencies, 99) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        "response_megabytes": round(response_bytes / 1024 / 1024, 2),
+    }
+
+"""
+Function to list the processes descending from a process, read from /proc (empty where /proc is unavailable)
+Parameters:
+    - root_pid: pid of the ancestor
+"""
+def descendant_pids(root_pid):
+    parents = {}
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat_file:
+                # The command name is in parentheses and may contain spaces; the parent pid follows the state
+                parents[int(entry)] = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    descendants, frontier = set(), {root_pid}
+    while frontier:
+        frontier = {pid for pid, parent in parents.items() if parent in frontier and pid not in descendants}
+        descendants |= frontier
+    return descendants
+
+"""
+Function to read the peak resident set size (VmHWM) of a process in kilobytes, or None once it has exited
+Parameters:
+    - pid: process id
+"""
+def process_peak_rss_kilobytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        return None
+    return None
+
+"""
+Function to sample the peak RSS of the descendants of this process until stopped, run in a thread
+Parameters:
+    - peaks: dict updated with the largest peak RSS seen per pid, in kilobytes
+    - stop: threading.Event ending the sampling
+    - interval_seconds: time between samples
+"""
+def sample_descendants_peak_rss(peaks, stop, interval_seconds=0.25):
+    while True:
+        for pid in descendant_pids(os.getpid()):
+            peak = process_peak_rss_kilobytes(pid)
+            if peak is not None:
+                peaks[pid] = max(peaks.get(pid, 0), peak)
+        # Stopping wakes the wait, and the loop takes one last sample before returning
+        if stop.is_set():
+            return
+        stop.wait(interval_seconds)
+
+"""
+Function to report the peak resident set size in megabytes of this process and of its largest descendant
+Parameters:
+    - descendant_peaks: largest peak RSS sampled per descendant pid, in kilobytes
+"""
+def peak_rss_megabytes(descendant_peaks):
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "process": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "children": round(max(descendant_peaks.values(), default=0) / 1024, 1),
+        "child_processes": len(descendant_peaks),
+    }
+
+async def main(arguments):
+    import httpx
+
+    if arguments.url:
+        transport = None
+        base_url = arguments.url.rstrip("/")
+    else:
+        # Configure the simulator before the application is imported, keeping explicit overrides
+        for name, value in DEFAULT_SIMULATOR_ENVIRONMENT.items():
+            os.environ.setdefault(name, value)
+        os.environ.setdefault("SIMULATOR_SEED", str(arguments.seed))
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from app.main import app, content_generator
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://benchmark"
+
+    scenarios = SCENARIOS if arguments.scenario == "all" else (arguments.scenario,)
+    rng = random.Random(arguments.seed)
+    results = []
+    limits = httpx.Limits(max_connections=arguments.concurrency, max_keepalive_connections=arguments.concurrency)
+    descendant_peaks, stop_sampling = {}, threading.Event()
+    sampler = threading.Thread(target=sample_descendants_peak_rss, args=(descendant_peaks, stop_sampling), daemon=True)
+    sampler.start()
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=arguments.timeout, limits=limits) as client:
+        for scenario in scenarios:
+            payloads = build_payloads(scenario, arguments, rng)
+            results.append(await run_scenario(client, scenario, payloads, arguments.concurrency))
+
+    # Take a last sample while the workers are still alive
+    stop_sampling.set()
+    sampler.join()
+
+    if transport is not None:
+        content_generator.backend.shutdown()
+        content_generator.image_preprocessor.process_executor.shutdown(wait=True)
+
+    report = {
+        "target": arguments.url or "in-process simulator",
+        "unique": arguments.unique,
+        "seed": arguments.seed,
+        "results": results,
+        "peak_rss_megabytes": peak_rss_megabytes(descendant_peaks),
+    }
+
+    print(f"{'scenario':<18}{'requests':>9}{'errors':>8}{'req/s':>9}{'items/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for result in results:
+        print(
+            f"{result['scenario']:<18}{result['requests']:>9}{sum(result['errors'].values()):>8}"
+            f"{result['throughput_per_second']:>9}{result['items_per_second']:>9}"
+            f"{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}"
+        )
+    print(f"peak RSS: {report['peak_rss_megabytes']['process']} MB (process), {report['peak_rss_megabytes']['children']} MB (largest of {report['peak_rss_megabytes']['child_processes']} child processes)")
+
+    if arguments.json_path:
+        with open(arguments.json_path, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_arguments()))
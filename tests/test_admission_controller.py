@@ -0,0 +1,70 @@
+import asyncio
+import sqlite3
+import time
+from app.classes.AdmissionController import ModelAdmission, SharedSlots
+
+def test_locked_database_is_not_acquired_and_does_not_raise(tmp_path):
+    path = str(tmp_path / "admission.sqlite3")
+    slots = SharedSlots(path, busy_timeout_seconds=0.005)
+
+    # Another worker holds the write lock
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    started_at = time.monotonic()
+    assert slots.try_acquire("vertex_text_model", 1) is False
+    assert time.monotonic() - started_at < 0.5
+    assert slots.busy == {"vertex_text_model": 1}
+    other.execute("COMMIT")
+
+    assert slots.try_acquire("vertex_text_model", 1) is True
+    assert slots.try_acquire("vertex_text_model", 1) is False
+
+def test_slot_is_admitted_once_the_lock_is_released_and_released_after_use(tmp_path):
+    path = str(tmp_path / "admission.sqlite3")
+    slots = SharedSlots(path, busy_timeout_seconds=0.005)
+    admission = ModelAdmission("vertex_text_model", 1, 4, 2.0, shared_slots=slots, shared_poll_seconds=0.01)
+    other = sqlite3.connect(path, isolation_level=None)
+
+    async def scenario():
+        other.execute("BEGIN IMMEDIATE")
+        asyncio.get_running_loop().call_later(0.1, other.execute, "COMMIT")
+        async with admission.slot(0):
+            assert slots.held("vertex_text_model") == 1
+        assert slots.held("vertex_text_model") == 0
+        assert admission.active == 0
+
+    asyncio.run(scenario())
+    assert slots.busy["vertex_text_model"] > 0
+
+def test_slot_is_kept_until_an_abandoned_thread_ends():
+    import threading
+    from app.classes.AdmissionController import hold_slot_until
+
+    admission = ModelAdmission("vertex_image_generation_model", 1, 4, 2.0)
+    finish = threading.Event()
+
+    async def call_model():
+        async with admission.slot(0):
+            future = asyncio.get_running_loop().run_in_executor(None, finish.wait)
+            hold_slot_until(future)
+            return await asyncio.shield(future)
+
+    async def scenario():
+        # The attempt times out while its thread is still calling the model
+        try:
+            await asyncio.wait_for(call_model(), timeout=0.05)
+        except asyncio.TimeoutError:
+            pass
+        assert admission.active == 1
+        assert admission.abandoned == 1
+
+        # Another call waits until the thread has ended
+        waiter = asyncio.ensure_future(admission.acquire(0))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        finish.set()
+        await asyncio.wait_for(waiter, timeout=1)
+        await admission.release()
+        assert admission.active == 0
+
+    asyncio.run(scenario())
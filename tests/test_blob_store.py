@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+from app.classes.BlobStore import BlobStore
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, monkeypatch, tmp_path):
+    monkeypatch.delenv("SHARED_STATE_DIR", raising=False)
+    monkeypatch.setenv("BLOB_STORE_MAX_BYTES", "3000")
+    if request.param == "sqlite":
+        monkeypatch.setenv("BLOB_STORE_SQLITE_PATH", str(tmp_path / "blobs.sqlite3"))
+    else:
+        monkeypatch.delenv("BLOB_STORE_SQLITE_PATH", raising=False)
+    return BlobStore()
+
+def put(store, data, pinned_seconds=0):
+    return asyncio.run(store.put(data, "image/png", pinned_seconds))
+
+def get(store, blob_id):
+    return asyncio.run(store.get(blob_id))
+
+def fill(store, count, size=1000):
+    blob_ids = []
+    for index in range(count):
+        blob_ids.append(put(store, bytes([index]) * size))
+        if store.connection is not None:
+            with store.lock:
+                store.evict_shared()
+    return blob_ids
+
+def test_oldest_blobs_are_evicted_above_the_budget(store):
+    blob_ids = fill(store, 5)
+    assert get(store, blob_ids[0]) is None
+    assert get(store, blob_ids[-1]) is not None
+
+def test_pinned_blobs_are_not_evicted_above_the_budget(store):
+    pinned_id = put(store, b"\xff" * 1000, pinned_seconds=60)
+    blob_ids = fill(store, 5)
+    assert get(store, pinned_id)["data"] == b"\xff" * 1000
+    assert get(store, blob_ids[0]) is None
+    assert get(store, blob_ids[-1]) is not None
+
+def test_pinning_extends_the_ttl(store):
+    store.ttl_seconds = 1
+    pinned_id = put(store, b"\xff" * 10, pinned_seconds=60)
+    unpinned_id = put(store, b"\x00" * 10)
+    assert get(store, pinned_id)["expires_at"] > get(store, unpinned_id)["expires_at"] + 30
+
+def test_stats_report_the_stored_bytes(store):
+    fill(store, 2)
+    stats = asyncio.run(store.stats())
+    assert (stats["blobs"], stats["total_bytes"]) == (2, 2000)
@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from app.classes.ImageJobQueue import ImageJobQueue
+
+async def no_runner(job):
+    return {}
+
+@pytest.fixture
+def queue(monkeypatch):
+    monkeypatch.delenv("IMAGE_JOB_WEBHOOK_ALLOWED_HOSTS", raising=False)
+    monkeypatch.delenv("IMAGE_JOB_WEBHOOK_ALLOW_PRIVATE_ADDRESSES", raising=False)
+    monkeypatch.delenv("SHARED_STATE_DIR", raising=False)
+    return ImageJobQueue(no_runner)
+
+@pytest.mark.parametrize("webhook_url", [
+    "http://127.0.0.1/hook",
+    "http://localhost:8080/hook",
+    "http://10.0.0.5/hook",
+    "http://192.168.1.1/hook",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://0.0.0.0/hook",
+    "http://[::1]/hook",
+    "http://[fe80::1]/hook",
+    "http://[::ffff:127.0.0.1]/hook",
+    "http://100.64.0.1/hook",
+])
+def test_webhook_to_non_public_address_is_refused(queue, webhook_url):
+    with pytest.raises(ValueError):
+        asyncio.run(queue.validate_webhook_url(webhook_url))
+
+@pytest.mark.parametrize("webhook_url", ["ftp://93.184.216.34/hook", "http:///hook"])
+def test_webhook_must_be_http_with_a_host(queue, webhook_url):
+    with pytest.raises(ValueError):
+        asyncio.run(queue.validate_webhook_url(webhook_url))
+
+def test_webhook_to_public_address_is_accepted(queue):
+    asyncio.run(queue.validate_webhook_url("https://93.184.216.34/hook"))
+
+def test_allow_list_still_refuses_private_addresses(queue):
+    queue.webhook_allowed_hosts = {"127.0.0.1"}
+    with pytest.raises(ValueError):
+        asyncio.run(queue.validate_webhook_url("http://127.0.0.1/hook"))
+
+def test_private_addresses_can_be_allowed_for_local_development(queue):
+    queue.webhook_allow_private_addresses = True
+    asyncio.run(queue.validate_webhook_url("http://127.0.0.1/hook"))
+
+def test_webhook_delivery_connects_to_the_checked_address(queue, monkeypatch):
+    import socket
+    import httpx
+
+    # The host resolves to a public address when checked and to a private one afterwards
+    answers = iter(["93.184.216.34", "127.0.0.1"])
+    def getaddrinfo(host, port, *args, **kwargs):
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (next(answers), port))]
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+
+    requests = []
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200)
+    queue.webhook_transport = httpx.MockTransport(handler)
+
+    job = {
+        "job_id": "job", "status": "succeeded", "images": [], "warnings": [], "error": None, "created_at": 0,
+        "started_at": 0, "finished_at": 0, "expires_at": None, "webhook_url": "https://hooks.example.com:8443/hook?a=1",
+    }
+    asyncio.run(queue.notify_webhook(job))
+    assert len(requests) == 1
+    assert str(requests[0].url) == "https://93.184.216.34:8443/hook?a=1"
+    assert requests[0].headers["Host"] == "hooks.example.com:8443"
+    assert requests[0].extensions["sni_hostname"] == "hooks.example.com"
+    assert queue.webhook_failures == 0
+
+def test_pinned_webhook_request_brackets_ipv6_addresses(queue):
+    url, headers, extensions = queue.pin_webhook_request("http://hooks.example.com/hook", "2606:2800:220:1::1")
+    assert url == "http://[2606:2800:220:1::1]/hook"
+    assert headers == {"Host": "hooks.example.com"}
+    assert extensions == {}
@@ -0,0 +1,74 @@
+import asyncio
+import io
+import os
+import signal
+import PIL.Image
+from app.classes.ImagePreprocessor import ImagePreprocessor, compute_perceptual_fingerprint, flatten_onto_white, preprocess_image_bytes
+
+def encode_png(image):
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+def decode(image_bytes):
+    image = PIL.Image.open(io.BytesIO(image_bytes))
+    image.load()
+    return image
+
+def test_16_bit_png_is_scaled_not_clipped_to_white():
+    image_bytes = encode_png(PIL.Image.new("I;16", (400, 300), 30000))
+    assert decode(image_bytes).mode.startswith("I")
+
+    processed_bytes, mime_type = preprocess_image_bytes(image_bytes, 200, "JPEG", 90)
+    processed = decode(processed_bytes)
+    assert mime_type == "image/jpeg"
+    assert processed.size == (200, 150)
+    for low, high in processed.getextrema():
+        assert 110 <= low <= high <= 125
+
+def test_16_bit_png_is_scaled_for_webp():
+    image_bytes = encode_png(PIL.Image.new("I;16", (400, 300), 30000))
+    processed_bytes, _ = preprocess_image_bytes(image_bytes, 200, "WEBP", 90)
+    for low, high in decode(processed_bytes).convert("RGB").getextrema():
+        assert 110 <= low <= high <= 125
+
+def test_transparent_palette_alpha_image_is_flattened_onto_white():
+    # PNG has no PA mode, the image is flattened the way preprocess_image_bytes flattens it
+    image = PIL.Image.new("PA", (40, 30))
+    image.putpalette([0, 0, 0] * 256)
+    flattened = flatten_onto_white(image)
+    assert flattened.mode == "RGB"
+    assert flattened.getextrema() == ((255, 255), (255, 255), (255, 255))
+
+def test_transparent_image_is_flattened_onto_white():
+    processed_bytes, _ = preprocess_image_bytes(encode_png(PIL.Image.new("LA", (400, 300), (0, 0))), 200, "JPEG", 90)
+    for low, high in decode(processed_bytes).getextrema():
+        assert low >= 250
+
+def test_small_upright_image_is_sent_unchanged():
+    assert preprocess_image_bytes(encode_png(PIL.Image.new("RGB", (100, 100))), 200, "JPEG", 90) == (None, None)
+
+def test_near_constant_image_has_no_fingerprint():
+    assert compute_perceptual_fingerprint(encode_png(PIL.Image.new("I;16", (64, 64), 30000)), 8, 8) is None
+
+def test_broken_process_pool_is_replaced_and_the_task_retried(monkeypatch):
+    monkeypatch.setenv("IMAGE_PROCESS_POOL_SIZE", "1")
+    preprocessor = ImagePreprocessor()
+    image_bytes = encode_png(PIL.Image.new("RGB", (2000, 1500), (200, 10, 10)))
+
+    async def scenario():
+        try:
+            assert (await preprocessor.preprocess(image_bytes, "image/png"))["mime_type"] == "image/jpeg"
+
+            # A worker is killed, as by the OOM killer
+            for pid in list(preprocessor.process_executor._processes):
+                os.kill(pid, signal.SIGKILL)
+            await asyncio.sleep(0.5)
+
+            assert (await preprocessor.preprocess(image_bytes, "image/png"))["mime_type"] == "image/jpeg"
+            assert preprocessor.process_pool_restarts == 1
+            assert await preprocessor.check_process_pool()
+        finally:
+            preprocessor.process_executor.shutdown(cancel_futures=True)
+
+    asyncio.run(scenario())
@@ -0,0 +1,66 @@
+import io
+import pytest
+from PIL import Image
+from app.classes.ImageValidator import ImageValidator
+
+def encode(width, height, image_format, **options):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 120, 40)).save(output, format=image_format, **options)
+    return output.getvalue()
+
+@pytest.fixture
+def validator(monkeypatch):
+    monkeypatch.delenv("MAX_IMAGE_PIXELS", raising=False)
+    monkeypatch.delenv("MAX_IMAGE_HEADER_BYTES", raising=False)
+    return ImageValidator()
+
+def test_png_header_reports_format_and_dimensions(validator):
+    assert validator.check_header(encode(640, 480, "PNG")) == (("png", (640, 480)), None)
+
+@pytest.mark.parametrize("options", [{}, {"progressive": True}, {"exif": Image.Exif()}])
+def test_jpeg_frame_header_is_found_after_the_other_segments(validator, options):
+    # Baseline (SOF0) and progressive (SOF2) frames, after the JFIF, EXIF and quantisation table segments
+    data = encode(800, 600, "JPEG", **options)
+    assert validator.check_header(data) == (("jpeg", (800, 600)), None)
+
+def test_jpeg_fill_bytes_before_a_marker_are_skipped(validator):
+    data = encode(320, 200, "JPEG")
+    # Markers may be preceded by any number of 0xFF fill bytes
+    assert validator.check_header(data[:2] + b"\xff\xff" + data[2:]) == (("jpeg", (320, 200)), None)
+
+def test_more_bytes_are_needed_until_the_frame_header_is_received(validator):
+    data = encode(800, 600, "JPEG", exif=Image.Exif())
+    assert validator.check_header(data[:4]) == (None, None)
+    assert validator.check_header(data[:20]) == (None, None)
+    assert validator.check_header(encode(64, 64, "PNG")[:20]) == (None, None)
+
+@pytest.mark.parametrize("data", [
+    b"GIF89a\x01\x00\x01\x00\x00\x00\x00",
+    b"<svg xmlns='http://www.w3.org/2000/svg'/>",
+    b"\x00" * 64,
+])
+def test_other_formats_are_refused_by_their_magic_bytes(validator, data):
+    header, warning = validator.check_header(data)
+    assert header is None
+    assert "jpeg, jpg and png" in warning
+
+def test_corrupt_headers_are_refused(validator):
+    png = bytearray(encode(64, 64, "PNG"))
+    png[12:16] = b"IDAT"
+    assert validator.check_header(bytes(png))[1] == "The uploaded file is not a valid jpeg or png image."
+    # A JPEG whose segments do not start with 0xFF
+    assert validator.check_header(b"\xff\xd8\xff\xe0\x00\x10JFIF\x00" + b"\x00" * 16)[1] == "The uploaded file is not a valid jpeg or png image."
+
+def test_jpeg_without_a_frame_header_in_the_first_bytes_is_refused(validator):
+    validator.max_header_bytes = 1024
+    # A comment segment (COM) repeated past the scanned prefix
+    comment = b"\xff\xfe" + (1000).to_bytes(2, "big") + b"x" * 998
+    data = b"\xff\xd8" + comment * 3
+    assert validator.check_header(data)[1] == "The uploaded file is not a valid jpeg or png image."
+
+def test_too_many_pixels_are_refused_from_the_header(validator):
+    validator.max_image_pixels = 640 * 480 - 1
+    for image_format in ("PNG", "JPEG"):
+        header, warning = validator.check_header(encode(640, 480, image_format))
+        assert header is None
+        assert warning == "Image resolution is too large. Choose an image with fewer pixels."
@@ -0,0 +1,65 @@
+import asyncio
+import pytest
+from app.classes.ModelRouter import ModelRouter
+from app.classes.ResilienceLayer import ResilienceLayer
+from app.classes.ResponseCache import ResponseCache
+from app.classes.SimulatorBackend import SimulatorBackend
+
+@pytest.fixture
+def router(monkeypatch):
+    for name in ("ROUTING_TEXT_CANDIDATES", "ROUTING_CONTENT_TYPE_MODELS", "ROUTING_MIN_CALLS", "ROUTING_EWMA_ALPHA", "ROUTING_SLOW_SECONDS"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("ROUTING_STATS_QUIET_SECONDS", "0.1")
+    resilience = ResilienceLayer({"vertex_text_model": 60, "vertex_pro_vision_model": 60, "gemini_model": 60})
+    return ModelRouter(SimulatorBackend(), resilience, ResponseCache("token_counts", 16, 60), {
+        "vertex_text_model": 30720,
+        "vertex_pro_vision_model": 12288,
+        "gemini_model": 12288,
+    })
+
+def route(router):
+    return asyncio.run(router.route("text", "Write a poem about the sea"))
+
+def wait(seconds):
+    asyncio.run(asyncio.sleep(seconds))
+
+def test_failing_model_is_demoted(router):
+    for _ in range(5):
+        router.record("vertex_text_model", 1.0, False)
+    assert route(router) == ["vertex_pro_vision_model", "vertex_text_model"]
+
+def test_demoted_model_is_tried_again_after_a_quiet_period(router):
+    for _ in range(10):
+        router.record("vertex_text_model", 1.0, False)
+    assert route(router)[0] == "vertex_pro_vision_model"
+    wait(0.15)
+    assert route(router) == ["vertex_text_model", "vertex_pro_vision_model"]
+
+def test_model_that_keeps_failing_stays_degraded(router):
+    # Calls keep arriving more often than the quiet period, so the record is never forgotten
+    for call in range(20):
+        router.record("vertex_text_model", 1.0, False)
+        wait(0.03)
+        if call >= router.min_calls - 1:
+            assert route(router)[0] == "vertex_pro_vision_model"
+
+def test_model_that_stays_slow_stays_degraded(router):
+    for _ in range(20):
+        router.record("vertex_text_model", 1.25 * router.slow_seconds, True)
+        wait(0.03)
+    assert route(router)[0] == "vertex_pro_vision_model"
+    assert router.route_stats["vertex_text_model"].latency_seconds == pytest.approx(1.25 * router.slow_seconds)
+
+def test_forgotten_model_is_demoted_again_by_its_next_calls(router):
+    for _ in range(10):
+        router.record("vertex_text_model", 1.0, False)
+    wait(0.15)
+    assert route(router)[0] == "vertex_text_model"
+    for _ in range(5):
+        router.record("vertex_text_model", 1.0, False)
+    assert route(router)[0] == "vertex_pro_vision_model"
+
+    wait(0.15)
+    for _ in range(5):
+        router.record("vertex_text_model", 1.25 * router.slow_seconds, True)
+    assert route(router)[0] == "vertex_pro_vision_model"
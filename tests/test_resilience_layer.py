@@ -0,0 +1,129 @@
+import asyncio
+import pytest
+from app.classes.ResilienceLayer import CircuitBreaker, CircuitOpenError, ResilientCaller
+
+class FakeUpstreamError(Exception):
+    """
+    Transient error of the fake upstream, carrying an HTTP status "code" like google.api_core exceptions
+    """
+    def __init__(self, code):
+        super().__init__(f"{code} fake upstream error")
+        self.code = code
+
+class FakeUpstream:
+    """
+    Fake model call that fails, succeeds or hangs until released, as set by the test
+    """
+    def __init__(self):
+        self.mode = "fail"
+        self.calls = 0
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        self.started.set()
+        if self.mode == "fail":
+            raise FakeUpstreamError(503)
+        if self.mode == "hang":
+            await self.release.wait()
+        return ["text"]
+
+def make_caller(reset_seconds=0.05):
+    return ResilientCaller(
+        "fake_model",
+        timeout_seconds=5,
+        max_attempts=1,
+        base_delay_seconds=0,
+        max_delay_seconds=0,
+        hedge_after_seconds=0,
+        circuit_breaker=CircuitBreaker(failure_threshold=2, reset_seconds=reset_seconds),
+    )
+
+async def open_circuit(caller, upstream):
+    for _ in range(2):
+        with pytest.raises(FakeUpstreamError):
+            await caller.call(upstream)
+    assert caller.circuit_breaker.state == "open"
+
+def test_circuit_opens_and_fails_fast():
+    async def scenario():
+        caller, upstream = make_caller(reset_seconds=30), FakeUpstream()
+        await open_circuit(caller, upstream)
+        with pytest.raises(CircuitOpenError):
+            await caller.call(upstream)
+        assert upstream.calls == 2
+
+    asyncio.run(scenario())
+
+def test_half_open_trial_closes_the_circuit_on_success():
+    async def scenario():
+        caller, upstream = make_caller(), FakeUpstream()
+        await open_circuit(caller, upstream)
+        await asyncio.sleep(0.06)
+        upstream.mode = "succeed"
+        assert await caller.call(upstream) == ["text"]
+        assert caller.circuit_breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+def test_cancelled_half_open_trial_does_not_wedge_the_breaker():
+    async def scenario():
+        caller, upstream = make_caller(), FakeUpstream()
+        await open_circuit(caller, upstream)
+        await asyncio.sleep(0.06)
+
+        # The trial call is cancelled while in flight, as on a client disconnect
+        upstream.mode = "hang"
+        upstream.started.clear()
+        trial = asyncio.ensure_future(caller.call(upstream))
+        await upstream.started.wait()
+        assert caller.circuit_breaker.state == "half_open"
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        assert not caller.circuit_breaker.trial_in_flight
+
+        # The next call is let through as a new trial and closes the circuit
+        upstream.mode = "succeed"
+        assert await caller.call(upstream) == ["text"]
+        assert caller.circuit_breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+def test_trial_timed_out_by_the_caller_does_not_wedge_the_breaker():
+    async def scenario():
+        caller, upstream = make_caller(), FakeUpstream()
+        await open_circuit(caller, upstream)
+        await asyncio.sleep(0.06)
+
+        upstream.mode = "hang"
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(caller.call(upstream), 0.05)
+
+        upstream.mode = "succeed"
+        assert await caller.call(upstream) == ["text"]
+
+    asyncio.run(scenario())
+
+def test_timeouts_are_not_retried_when_disabled():
+    async def scenario():
+        upstream = FakeUpstream()
+        upstream.mode = "hang"
+        caller = make_caller()
+        caller.max_attempts = 3
+        caller.timeout_seconds = 0.05
+        caller.retry_timeouts = False
+        caller.circuit_breaker.failure_threshold = 10
+        with pytest.raises(asyncio.TimeoutError):
+            await caller.call(upstream)
+        assert upstream.calls == 1
+        assert caller.retries == 0
+        assert caller.timeouts == 1
+
+        caller.retry_timeouts = True
+        with pytest.raises(asyncio.TimeoutError):
+            await caller.call(upstream)
+        assert upstream.calls == 4
+
+    asyncio.run(scenario())
@@ -0,0 +1,37 @@
+import sqlite3
+import time
+from app.classes.ResponseCache import ResponseCache
+
+def test_locked_disk_tier_is_skipped_quickly_and_counted(tmp_path, monkeypatch):
+    monkeypatch.setenv("SHARED_STATE_BUSY_TIMEOUT_SECONDS", "5")
+    monkeypatch.delenv("CACHE_SQLITE_BUSY_TIMEOUT_SECONDS", raising=False)
+    path = str(tmp_path / "cache.sqlite3")
+    cache = ResponseCache("text_responses", 16, 60, sqlite_path=path)
+
+    # Another worker holds the write lock
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+    key = ResponseCache.make_key("text", "a poem")
+    started_at = time.monotonic()
+    cache.set(key, {"response": "text"})
+    assert time.monotonic() - started_at < 0.5
+    assert cache.get(key) == {"response": "text"}
+
+    # Readers are not blocked in WAL mode
+    assert cache.get(ResponseCache.make_key("text", "a song")) is None
+    assert cache.stats()["disk_errors"] == 1
+    other.execute("COMMIT")
+
+    cache.set(key, {"response": "text"})
+    assert cache.stats()["disk_errors"] == 1
+
+def test_disk_tier_is_trimmed_in_the_background(tmp_path):
+    cache = ResponseCache("text_responses", 16, 60, sqlite_path=str(tmp_path / "cache.sqlite3"), max_disk_entries=10)
+    for index in range(1000):
+        cache.set(ResponseCache.make_key("text", index), {"response": index})
+    for _ in range(100):
+        if not cache.trimming:
+            break
+        time.sleep(0.01)
+    (rows,) = cache.connection.execute("SELECT COUNT(*) FROM text_responses").fetchone()
+    assert rows == 10
@@ -0,0 +1,58 @@
+import pytest
+from app.classes.SafetyScreen import SAFETY_WARNINGS, SafetyBlockedError, classify_safety_error
+from app.classes.SimulatorBackend import SimulatedUpstreamError
+
+def blocked(support_code):
+    return SimulatedUpstreamError(400, f"Image generation failed with the following error: The prompt could not be submitted. Support codes: {support_code}")
+
+@pytest.mark.parametrize("support_code, category", [
+    ("58061214", "person"),
+    ("29310472", "celebrity"),
+    ("15236754", "celebrity"),
+    ("92201652", "personal_information"),
+    ("90789179", "sensitive"),
+    ("43188360", "sensitive"),
+    ("63429089", "sensitive"),
+    ("61493863", "sensitive"),
+])
+def test_support_codes_are_classified(support_code, category):
+    assert classify_safety_error(blocked(support_code)) == category
+
+def test_every_category_has_its_own_warning():
+    warnings = [str(SafetyBlockedError(category, "upstream")) for category in SAFETY_WARNINGS]
+    assert len(set(warnings)) == len(warnings)
+    assert "Child" not in str(SafetyBlockedError("celebrity", "upstream"))
+    assert "Child" not in str(SafetyBlockedError("personal_information", "upstream"))
+
+def test_other_errors_are_not_safety_blocks():
+    assert classify_safety_error(SimulatedUpstreamError(503, "Service unavailable. Support codes: 29310472")) is None
+    assert classify_safety_error(SimulatedUpstreamError(400, "Invalid aspect ratio")) is None
+
+def make_screen(tmp_path, monkeypatch, lines):
+    from app.classes.SafetyScreen import SafetyScreen
+    blocklist_path = tmp_path / "blocklist.txt"
+    blocklist_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    monkeypatch.setenv("SAFETY_BLOCKLIST_PATH", str(blocklist_path))
+    monkeypatch.delenv("SHARED_STATE_DIR", raising=False)
+    monkeypatch.delenv("SAFETY_MEMO_SQLITE_PATH", raising=False)
+    return SafetyScreen()
+
+def test_blocklist_patterns_ignore_case_and_keep_their_category(tmp_path, monkeypatch):
+    screen = make_screen(tmp_path, monkeypatch, [
+        "celebrity:re:Famous\\s+Singer",
+        "person:re:(a|b)+child",
+        "sensitive:example phrase",
+    ])
+    assert screen.match_blocklist(screen.normalise("a FAMOUS singer on stage")) == "celebrity"
+    assert screen.match_blocklist(screen.normalise("abchild")) == "person"
+    assert screen.match_blocklist(screen.normalise("An Example Phrase")) == "sensitive"
+    assert screen.match_blocklist(screen.normalise("a lighthouse")) is None
+
+@pytest.mark.parametrize("pattern", ["(a)\\1", "(?P<word>a)(?P=word)", "(a)?(?(1)b|c)", "(x)[\\1]|(y)\\2"])
+def test_blocklist_patterns_with_backreferences_are_refused(tmp_path, monkeypatch, pattern):
+    with pytest.raises(ValueError, match="blocklist.txt:2: backreferences"):
+        make_screen(tmp_path, monkeypatch, ["sensitive:word", f"person:re:{pattern}"])
+
+def test_blocklist_pattern_with_escapes_is_not_taken_for_a_backreference(tmp_path, monkeypatch):
+    screen = make_screen(tmp_path, monkeypatch, ["sensitive:re:[\\x01-\\x20]{3}\\d"])
+    assert screen.match_blocklist("\x10\x11\x12" + "5") == "sensitive"
@@ -0,0 +1,100 @@
+import asyncio
+import io
+import httpx
+from PIL import Image
+from app.classes.ImageValidator import ImageValidator
+from app.classes.UploadSizeLimitMiddleware import MultipartImageSniffer, UploadSizeLimitMiddleware
+
+class BodyReadingApp:
+    """
+    ASGI app that reads the whole body and answers 200 with its size, recording how many bytes it received
+    """
+    def __init__(self):
+        self.received = 0
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise OSError("client disconnected")
+            self.received += len(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": str(self.received).encode("ascii")})
+
+def png_bytes(width=64, height=48):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height)).save(output, format="PNG")
+    return output.getvalue()
+
+def multipart(file_bytes, boundary="test-boundary"):
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"content_type\"\r\n\r\n2\r\n"
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"image.png\"\r\n"
+        "Content-Type: image/png\r\n\r\n"
+    ).encode("ascii") + file_bytes + f"\r\n--{boundary}--\r\n".encode("ascii")
+    return body, {"content-type": f"multipart/form-data; boundary={boundary}"}
+
+def post(middleware, content, headers, path="/generate-image-captions"):
+    async def scenario():
+        transport = httpx.ASGITransport(app=middleware)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post(path, content=content, headers=headers)
+    return asyncio.run(scenario())
+
+def chunks(body, size=1024):
+    async def stream():
+        for start in range(0, len(body), size):
+            yield body[start:start + size]
+    return stream()
+
+def make_middleware(max_body_bytes=64 * 1024):
+    app = BodyReadingApp()
+    return app, UploadSizeLimitMiddleware(app, ["/generate-image-captions"], max_body_bytes, ImageValidator())
+
+def test_declared_oversize_body_is_refused_without_reading_it():
+    app, middleware = make_middleware()
+    body, headers = multipart(png_bytes() + b"\x00" * 70000)
+    response = post(middleware, body, headers)
+    assert response.status_code == 413
+    assert response.json()["warnings"][0].startswith("File size is too large.")
+    assert app.received == 0
+
+def test_streamed_oversize_body_is_cut_off():
+    app, middleware = make_middleware()
+    body, headers = multipart(png_bytes() + b"\x00" * 200000)
+    response = post(middleware, chunks(body), headers)
+    assert response.status_code == 413
+    assert app.received <= 64 * 1024
+
+def test_file_that_is_not_an_image_is_refused_from_its_first_bytes():
+    app, middleware = make_middleware(max_body_bytes=1024 * 1024)
+    body, headers = multipart(b"GIF89a" + b"\x00" * 200000)
+    response = post(middleware, chunks(body), headers)
+    assert response.status_code == 422
+    assert "jpeg, jpg and png" in response.json()["warnings"][0]
+    assert app.received < 200000
+
+def test_valid_upload_and_other_paths_pass_through():
+    app, middleware = make_middleware()
+    body, headers = multipart(png_bytes())
+    response = post(middleware, chunks(body), headers)
+    assert response.status_code == 200
+    assert int(response.text) == len(body)
+
+    oversize, headers = multipart(b"\x00" * 200000)
+    assert post(middleware, oversize, headers, path="/generate-text").status_code == 200
+
+def test_sniffer_checks_only_the_file_part():
+    validator = ImageValidator()
+    body, _ = multipart(png_bytes(640, 480))
+    sniffer = MultipartImageSniffer(b"test-boundary", validator)
+    # Feed the body a few bytes at a time, as it would arrive from the network
+    for start in range(0, len(body), 7):
+        assert sniffer.feed(body[start:start + 7]) is None
+    assert sniffer.done
+
+    validator.max_image_pixels = 640 * 480 - 1
+    sniffer = MultipartImageSniffer(b"test-boundary", validator)
+    assert sniffer.feed(body) == "Image resolution is too large. Choose an image with fewer pixels."
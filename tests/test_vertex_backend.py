@@ -0,0 +1,46 @@
+import asyncio
+import pytest
+from app.classes.VertexBackend import VertexBackend
+
+@pytest.fixture
+def backend(monkeypatch):
+    monkeypatch.setenv("MODEL_LOAD_RETRY_BASE_SECONDS", "0.01")
+    monkeypatch.setenv("MODEL_LOAD_RETRY_MAX_SECONDS", "0.04")
+    backend = VertexBackend("gemini-1.0-pro-vision", "gemini-1.0-pro")
+    yield backend
+    backend.shutdown()
+
+def test_failed_load_is_retried_in_the_background(backend):
+    handle = backend.vertex_text_model
+    attempts = []
+
+    def flaky_loader():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError("transient load failure")
+        return "model"
+    handle.loader = flaky_loader
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            handle.get()
+        assert handle.status()["ready"] is False
+        task = asyncio.ensure_future(backend.retry_failed_loads())
+        for _ in range(100):
+            if handle.model is not None:
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert handle.status() == {"ready": True, "error": None, "load_seconds": handle.load_seconds}
+    assert len(attempts) == 3
+
+def test_models_not_tried_yet_are_not_loaded_by_the_retries(backend):
+    async def scenario():
+        task = asyncio.ensure_future(backend.retry_failed_loads())
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert all(handle.model is None and handle.error is None for handle in backend.model_handles)